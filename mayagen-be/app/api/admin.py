@@ -4,12 +4,13 @@ from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlmodel import select, col, desc, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import case, text
+from sqlalchemy import text
 from ..database import get_session
 from ..models import User, Image, ActivityLog, JobStatus, BatchJob, BatchJobStatus, EditBatchJob
 from ..core import config
 from .deps import get_current_admin_user
 from ..helpers import api_response_helper as responses
+from ..services import job_events, job_queue
 
 router = APIRouter()
 
@@ -64,11 +65,9 @@ async def get_queue(
         select(Image)
         .where(Image.status == JobStatus.QUEUED)
         .order_by(
-            case(
-                (Image.batch_job_id.is_(None), 0),
-                else_=1
-            ).asc(),
-            Image.created_at.asc()
+            job_queue.queue_priority.asc(),
+            Image.fair_key.asc(),
+            Image.id.asc()
         )
         .offset(skip)
         .limit(limit)
@@ -228,6 +227,107 @@ async def update_user_role(
     
     return responses.api_success(message="User role updated", data=u_dict)
 
+@router.patch("/users/{user_id}/queue-weight")
+async def update_user_queue_weight(
+    user_id: int,
+    weight: float,
+    session: AsyncSession = Depends(get_session),
+    admin: User = Depends(get_current_admin_user)
+):
+    """Set a user's fair-share weight: a weight of 2 gets twice the batch throughput of a weight of 1."""
+    if weight <= 0:
+        return responses.api_error(status_code=400, message="Invalid weight", error="Weight must be greater than 0")
+        
+    user = await session.get(User, user_id)
+    if not user:
+        return responses.api_error(status_code=404, message="User not found")
+        
+    user.queue_weight = weight
+    session.add(user)
+    await session.commit()
+    await session.refresh(user)
+    
+    return responses.api_success(
+        message="User queue weight updated",
+        data={"id": user.id, "queue_weight": user.queue_weight}
+    )
+
+# --- Workers ---
+
+@router.post("/workers/drain")
+async def drain_workers(
+    target: Optional[str] = None,
+    session: AsyncSession = Depends(get_session),
+    admin: User = Depends(get_current_admin_user)
+):
+    """
+    Ask worker processes to drain: stop claiming, finish or hand back in-flight jobs
+    and exit. `target` is a worker id or hostname; without it every worker drains.
+    """
+    payload = f"drain:{target}" if target else "drain"
+    await job_events.notify(session, job_events.WORKER_CONTROL, payload)
+    await session.commit()
+
+    return responses.api_success(
+        message="Drain requested",
+        data={"target": target or "all", "drain_timeout": config.WORKER["drain_timeout"]}
+    )
+
+# --- Dead Letter ---
+
+@router.get("/dead-letter")
+async def list_dead_letter_jobs(
+    skip: int = 0,
+    limit: int = 50,
+    provider: Optional[str] = None,
+    session: AsyncSession = Depends(get_session),
+    admin: User = Depends(get_current_admin_user)
+):
+    """Jobs that kept failing with retryable errors until they ran out of attempts."""
+    query = select(Image).where(Image.status == JobStatus.DEAD_LETTER)
+    count_query = select(func.count()).select_from(Image).where(Image.status == JobStatus.DEAD_LETTER)
+
+    if provider:
+        query = query.where(Image.provider == provider)
+        count_query = count_query.where(Image.provider == provider)
+
+    total_result = await session.execute(count_query)
+    total = total_result.scalar()
+
+    query = query.order_by(desc(Image.updated_at)).offset(skip).limit(limit)
+    result = await session.execute(query)
+    jobs = result.scalars().all()
+
+    items = [{
+        "id": job.id,
+        "user_id": job.user_id,
+        "prompt": job.prompt,
+        "provider": job.provider,
+        "model": job.model,
+        "attempts": job.attempts,
+        "error_message": job.error_message,
+        "batch_job_id": job.batch_job_id,
+        "edit_batch_job_id": job.edit_batch_job_id,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None
+    } for job in jobs]
+
+    return responses.api_success(message="Dead-lettered jobs retrieved", data={"items": items, "total": total})
+
+@router.post("/dead-letter/{image_id}/requeue")
+async def requeue_dead_letter_job(
+    image_id: int,
+    session: AsyncSession = Depends(get_session),
+    admin: User = Depends(get_current_admin_user)
+):
+    """Put a dead-lettered job back on the queue with a fresh set of attempts."""
+    requeued = await job_queue.requeue_dead_letters(session, [image_id])
+    if not requeued:
+        return responses.api_error(status_code=404, message="Dead-lettered job not found")
+
+    await session.commit()
+    return responses.api_success(message="Job requeued", data={"id": image_id, "status": JobStatus.QUEUED})
+
 # --- Activity Logs ---
 
 @router.get("/activity")
@@ -349,8 +449,10 @@ async def delete_image(
     else:
         print(f"File not found at {file_path}, deleting DB record only.")
     
-    # Delete from database
+    # Delete from database (a worker still rendering it stops)
     await session.delete(image)
+    if image.status == JobStatus.PROCESSING:
+        await job_events.notify(session, job_events.JOB_CANCELLED, f"image:{image_id}")
     await session.commit()
     
     return responses.api_success(message="Image deleted successfully", data={"id": image_id})
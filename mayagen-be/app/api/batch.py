@@ -13,7 +13,9 @@ from typing import Optional, Dict, List, Any
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 from sqlmodel import select, func
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
 import os
 import uuid
 
@@ -21,18 +23,49 @@ from ..database import get_session
 from ..models import BatchJob, BatchJobStatus, User, Image, JobStatus
 from ..helpers import api_response_helper as responses
 from ..services.prompt_generator import generate_prompts, get_sample_prompts, estimate_unique_combinations, DEFAULT_VARIATIONS
+from ..services import job_events
 from . import deps
 from ..core import config
 
 router = APIRouter()
 
+# Rows per DELETE when a batch is hard-deleted
+HARD_DELETE_CHUNK_SIZE = 5000
+
+DELETE_BATCH_IMAGES_SQL = text("""
+    DELETE FROM image
+    WHERE id IN (
+        SELECT id FROM image
+        WHERE batch_job_id = :batch_id
+        LIMIT :limit
+    )
+    RETURNING category, filename;
+""")
+
+
+def _remove_image_files(rows) -> int:
+    """Delete the files of deleted image rows. Returns how many were removed."""
+    removed = 0
+    for row in rows:
+        if not (row.filename and row.category):
+            continue
+        # category comes from the DB, not from user input
+        file_path = os.path.join(config.OUTPUT_FOLDER, row.category, row.filename)
+        if os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+                removed += 1
+            except Exception as e:
+                print(f"Error deleting file {file_path}: {e}")
+    return removed
+
 
 # Request/Response Models
 class BatchJobCreate(BaseModel):
     name: str = "Untitled Batch"
     category: str
     target_subject: str
-    total_images: int = Field(ge=1, le=10000)  # Max 10k images per batch
+    total_images: int = Field(ge=1, le=config.BATCH_EXPANSION["max_images"])  # Expanded incrementally by the batch manager
     variations: Dict[str, List[str]] = {}
     base_prompt_template: Optional[str] = None
     model: str = "sd15"
@@ -40,6 +73,7 @@ class BatchJobCreate(BaseModel):
     width: int = 512
     height: int = 512
     is_public: bool = True
+    use_cache: bool = True  # False renders every image fresh, even repeats
 
 
 class BatchJobPreviewRequest(BaseModel):
@@ -71,10 +105,12 @@ async def create_batch_job(
             height=data.height,
             user_id=current_user.id,
             status=BatchJobStatus.QUEUED,
-            is_public=data.is_public
+            is_public=data.is_public,
+            use_cache=data.use_cache
         )
         
         session.add(batch)
+        await job_events.notify(session, job_events.BATCH_QUEUED, "batch")
         await session.commit()
         await session.refresh(batch)
         
@@ -245,15 +281,17 @@ async def delete_batch_job(
             # Cancel Logic
             batch.status = BatchJobStatus.CANCELLED
             
-            # Cancel all queued images
+            # Cancel queued and running images; workers running one stop it
+            # (ComfyUI interrupt / queue delete) and free the slot
             from sqlalchemy import update
             image_stmt = (
                 update(Image)
                 .where(Image.batch_job_id == batch_id)
-                .where(Image.status == JobStatus.QUEUED)
-                .values(status=JobStatus.CANCELLED)
+                .where(Image.status.in_([JobStatus.QUEUED, JobStatus.PROCESSING]))
+                .values(status=JobStatus.CANCELLED, worker_id=None, lease_expires_at=None)
             )
             await session.execute(image_stmt)
+            await job_events.notify(session, job_events.JOB_CANCELLED, f"batch:{batch_id}")
             await session.commit()
             
             return responses.api_success(
@@ -262,39 +300,30 @@ async def delete_batch_job(
             )
             
         # Hard Delete Logic
-        # 1. Get all images
-        images_stmt = select(Image).where(Image.batch_job_id == batch_id)
-        images_result = await session.execute(images_stmt)
-        images = images_result.scalars().all()
-        
-        # 2. Delete files from disk
-        # We need to be careful. Typically images are in `synthetic_dataset/{category}/{filename}`
-        # If we delete the file, we should check if other records use it (unlikely for batch gen, but good practice).
-        # For now, we assume 1:1 mapping for generated images.
-        
-        base_path = config.OUTPUT_FOLDER # "synthetic_dataset"
-        
+        # 1. Stop the batch first: no further chunks are expanded and running
+        #    images are stopped while the rows are being deleted
+        batch.status = BatchJobStatus.CANCELLED
+        session.add(batch)
+        await job_events.notify(session, job_events.JOB_CANCELLED, f"batch:{batch_id}")
+        await session.commit()
+
+        # 2. Delete Image Records in chunks (a batch can hold a million rows),
+        #    removing each chunk's files from disk as we go.
+        #    We assume a 1:1 mapping of generated images to files.
         deleted_files_count = 0
-        for img in images:
-            if img.filename and img.category:
-                # Construct path (careful with separators)
-                # category might trigger directory traversal check if we were accepting input, but this is from DB
-                file_path = os.path.join(base_path, img.category, img.filename)
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                        deleted_files_count += 1
-                    except Exception as e:
-                        print(f"Error deleting file {file_path}: {e}")
-                        
-        # 3. Delete Image Records
-        # SQLAlchemy cascade might handle this if configured, but explicit is safer here
-        for img in images:
-            await session.delete(img)
-            
-        # 4. Delete Batch Record
+        while True:
+            result = await session.execute(DELETE_BATCH_IMAGES_SQL, {
+                "batch_id": batch_id,
+                "limit": HARD_DELETE_CHUNK_SIZE,
+            })
+            rows = result.all()
+            await session.commit()
+            if not rows:
+                break
+            deleted_files_count += await asyncio.to_thread(_remove_image_files, rows)
+
+        # 3. Delete Batch Record
         await session.delete(batch)
-        
         await session.commit()
         
         return responses.api_success(
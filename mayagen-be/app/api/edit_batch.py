@@ -25,6 +25,7 @@ from ..database import get_session
 from ..models import EditBatchJob, BatchJobStatus, User, Image, JobStatus
 from ..helpers import api_response_helper as responses
 from ..services.prompt_generator import generate_prompts, estimate_unique_combinations
+from ..services import job_events
 from . import deps
 from ..core import config
 
@@ -112,6 +113,7 @@ async def create_edit_batch_job(
         )
         
         session.add(edit_batch)
+        await job_events.notify(session, job_events.BATCH_QUEUED, "edit_batch")
         await session.commit()
         await session.refresh(edit_batch)
         
@@ -336,15 +338,17 @@ async def delete_edit_batch_job(
         if is_active and not force:
             batch.status = BatchJobStatus.CANCELLED
             
-            # Cancel all queued images for this batch
+            # Cancel queued and running images; workers running one stop it
+            # (ComfyUI interrupt / queue delete) and free the slot
             from sqlalchemy import update
             image_stmt = (
                 update(Image)
                 .where(Image.edit_batch_job_id == batch_id)
-                .where(Image.status == JobStatus.QUEUED)
-                .values(status=JobStatus.CANCELLED)
+                .where(Image.status.in_([JobStatus.QUEUED, JobStatus.PROCESSING]))
+                .values(status=JobStatus.CANCELLED, worker_id=None, lease_expires_at=None)
             )
             await session.execute(image_stmt)
+            await job_events.notify(session, job_events.JOB_CANCELLED, f"edit_batch:{batch_id}")
             await session.commit()
             
             return responses.api_success(
@@ -379,6 +383,8 @@ async def delete_edit_batch_job(
         # 4. Delete Batch Record
         await session.delete(batch)
         
+        # Stop any of its images still rendering
+        await job_events.notify(session, job_events.JOB_CANCELLED, f"edit_batch:{batch_id}")
         await session.commit()
         
         return responses.api_success(
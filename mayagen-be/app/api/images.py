@@ -11,6 +11,7 @@ from ..database import get_session
 from ..models import Image, User, JobStatus
 from ..models import Image, User, JobStatus
 from ..helpers import api_response_helper as responses
+from ..services import job_events, job_queue
 from . import deps
 
 router = APIRouter()
@@ -19,7 +20,7 @@ from sqlalchemy import case
 
 # ...
 
-from sqlalchemy import func, or_
+from sqlalchemy import func, or_, tuple_
 
 @router.get("/images")
 async def list_images(
@@ -344,47 +345,16 @@ async def calculate_queue_position(session: AsyncSession, image: Image) -> Optio
     if image.status != JobStatus.QUEUED:
         return None
 
-    # 1. Count Processing (Starts at 0 or 1? If 0 is processing, line starts at 1)
-    # Actually, if I am next, waiting for the 1 processing item, am I #1 or #2?
-    # Usually #1 means "First in waiting line".
-    # So we don't count processing in the "Queue Position", but maybe we say "Behind X items".
-    # User asked for "Queue Number". (#4 approx 2 mins).
-    # If 1 is processing, and I am next, I am #1 in queue.
-    
-    # Priority Rules:
-    # 1. Single Images (batch_job_id is NULL) sorted by created_at
-    # 2. Batch Images (batch_job_id is NOT NULL) sorted by created_at
-    
-    # Count ahead in my priority group
-    if image.batch_job_id is None:
-        # I am Priority 1
-        # Count other Priority 1 images older than me
-        statement = select(func.count()).select_from(Image).where(
-            Image.status == JobStatus.QUEUED,
-            Image.batch_job_id == None,
-            Image.created_at < image.created_at
-        )
-        ahead = (await session.execute(statement)).scalar_one()
-        return ahead + 1
-        
-    else:
-        # I am Priority 2
-        # Count ALL Priority 1 images (they are all ahead)
-        statement_p1 = select(func.count()).select_from(Image).where(
-            Image.status == JobStatus.QUEUED,
-            Image.batch_job_id == None
-        )
-        p1_ahead = (await session.execute(statement_p1)).scalar_one()
-        
-        # Count Priority 2 images older than me
-        statement_p2 = select(func.count()).select_from(Image).where(
-            Image.status == JobStatus.QUEUED,
-            Image.batch_job_id != None,
-            Image.created_at < image.created_at
-        )
-        p2_ahead = (await session.execute(statement_p2)).scalar_one()
-        
-        return p1_ahead + p2_ahead + 1
+    # Position = QUEUED jobs the claim query would pick before this one:
+    # same worker queue (provider), ordered by (priority, fair_key, id).
+    # One COUNT over idx_image_queue_claim; consistent with both the "fair" and "fifo" schedulers.
+    statement = select(func.count()).select_from(Image).where(
+        Image.status == JobStatus.QUEUED,
+        Image.provider.in_(job_queue.providers_for(image.provider)),
+        tuple_(job_queue.queue_priority, Image.fair_key, Image.id) < tuple_(image.priority, image.fair_key, image.id)
+    )
+    ahead = (await session.execute(statement)).scalar_one()
+    return ahead + 1
 
 
 @router.get("/images/{image_id}")
@@ -577,6 +547,7 @@ async def edit_image(
         )
         
         session.add(new_image)
+        await job_events.notify(session, job_events.IMAGE_QUEUED, new_image.provider)
         await session.commit()
         await session.refresh(new_image)
         
@@ -8,6 +8,7 @@ from ..models import Image, User, JobStatus
 from ..models import Image, User, JobStatus
 from . import deps
 from ..helpers import api_response_helper as responses
+from ..services import job_events
 
 router = APIRouter()
 
@@ -20,6 +21,7 @@ class GenerateRequest(BaseModel):
     model: str = "sd15" 
     category: str = "uncategorized"
     is_public: bool = True
+    use_cache: bool = True  # False forces a fresh render even if an identical one exists
 
 @router.post("/generate")
 async def generate_image(
@@ -47,9 +49,11 @@ async def generate_image(
             category=safe_category,
             user_id=current_user.id,
             status=JobStatus.QUEUED,
-            is_public=req.is_public
+            is_public=req.is_public,
+            use_cache=req.use_cache
         )
         session.add(db_image)
+        await job_events.notify(session, job_events.IMAGE_QUEUED, req.provider)
         await session.commit()
         await session.refresh(db_image)
         
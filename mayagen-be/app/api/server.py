@@ -1,5 +1,5 @@
 import os
-from fastapi import FastAPI, HTTPException, APIRouter
+from fastapi import FastAPI, HTTPException, APIRouter, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
@@ -8,9 +8,12 @@ import asyncio
 from ..core import config
 from ..database import init_db
 from ..services.worker import start_all_workers
+from ..services import job_queue, metrics
 from ..helpers import api_response_helper as responses
 from . import auth, images, jobs, batch, edit_batch, admin
 from app.middleware.activity_logger import ActivityLoggerMiddleware
+from app.middleware.metrics import MetricsMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 def create_app() -> FastAPI:
     app = FastAPI(title="MayaGen API", version="1.0.0")
@@ -62,6 +65,9 @@ def create_app() -> FastAPI:
     # Activity Logging
     app.add_middleware(ActivityLoggerMiddleware)
 
+    # Per-route latency (outermost, so it times the whole stack)
+    app.add_middleware(MetricsMiddleware)
+
     return app
 
 app = create_app()
@@ -84,12 +90,31 @@ app.mount("/images", StaticFiles(directory=config.OUTPUT_FOLDER), name="images")
 @app.on_event("startup")
 async def on_startup():
     await init_db()
-    # Reset any stuck jobs from previous run
-    from ..services.worker import reset_stuck_jobs
-    await reset_stuck_jobs()
+    # Queue depth gauges for /metrics are refreshed here, off the scrape path
+    app.state.metrics_task = asyncio.create_task(metrics.queue_depth_loop())
+    # Jobs left PROCESSING by a previous run are requeued by the lease reaper
+    # once their lease expires; nothing is reset blindly at startup.
     
-    # Start Background Workers (Parallel)
-    asyncio.create_task(start_all_workers())
+    # Start Background Workers (Parallel), unless a separate worker tier runs them
+    if config.API_RUN_WORKERS:
+        app.state.workers_task = asyncio.create_task(start_all_workers())
+    else:
+        print("[System] API_RUN_WORKERS=false: background workers not started in the API process.")
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.metrics_task.cancel()
+    # Drain: stop claiming, hand buffered jobs back and give in-flight jobs
+    # WORKER_DRAIN_TIMEOUT seconds to finish before they are requeued
+    workers_task = getattr(app.state, "workers_task", None)
+    if workers_task:
+        job_queue.start_drain()
+        await asyncio.gather(workers_task, return_exceptions=True)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    # Async so it runs on the event loop: values are in memory, nothing is queried here
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/health")
 def health_check():
@@ -1,6 +1,11 @@
 import os
+import sys
 import time
+import asyncio
+import logging
+import signal
 import argparse
+import multiprocessing
 from pathlib import Path
 from sqlalchemy import create_engine, text
 from .core import config
@@ -10,6 +15,35 @@ def load_prompts(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return [line.strip() for line in f if line.strip() and not line.startswith('#')]
 
+async def _generate_prompts(args, prompts, output_dir, workflow_path):
+    provider = ComfyUIProvider(config.COMFYUI["server_address"])
+    try:
+        for i, prompt_text in enumerate(prompts):
+            print(f"\n[{i+1}/{len(prompts)}] Generating: {prompt_text[:50]}...")
+
+            # Categorize based on simple keyword matching (optional logic)
+            category = "uncategorized"
+            # Create a safe filename
+            safe_prompt = "".join([c for c in prompt_text[:30] if c.isalnum() or c in (' ', '_')]).strip().replace(" ", "_")
+            timestamp = int(time.time())
+            filename = f"{args.model}_{timestamp}_{safe_prompt}.png"
+
+            # Subfolder logic (optional, keep flat for script default or mimic API structure?)
+            if "portrait" in prompt_text.lower(): category = "Portraits"
+            elif "landscape" in prompt_text.lower(): category = "Landscapes"
+
+            cat_dir = output_dir / category
+            cat_dir.mkdir(exist_ok=True)
+            final_path = cat_dir / filename
+
+            try:
+                await provider.generate(prompt_text, str(final_path), width=512, height=512 if args.model == "lcm" else 512, workflow_path=workflow_path)
+                print(f"   -> Saved to {category}/{filename}")
+            except Exception as e:
+                print(f"[Error] Generation failed: {e}")
+    finally:
+        await provider.aclose()
+
 def cmd_generate(args):
     print("============================================")
     print(f" MAYAGEN AUTOMATION | Model: {args.model.upper()}")
@@ -19,8 +53,6 @@ def cmd_generate(args):
     output_dir = Path(args.output)
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    provider = ComfyUIProvider(config.COMFYUI["server_address"])
-    
     # Resolve Workflow
     workflow_path = config.WORKFLOWS.get(args.model)
     if not workflow_path or not workflow_path.exists():
@@ -40,29 +72,7 @@ def cmd_generate(args):
     print(f"[System] Loaded {len(prompts)} prompts from {prompts_file.name}\n")
 
     # 3. Generate Loop
-    for i, prompt_text in enumerate(prompts):
-        print(f"\n[{i+1}/{len(prompts)}] Generating: {prompt_text[:50]}...")
-        
-        # Categorize based on simple keyword matching (optional logic)
-        category = "uncategorized"
-        # Create a safe filename
-        safe_prompt = "".join([c for c in prompt_text[:30] if c.isalnum() or c in (' ', '_')]).strip().replace(" ", "_")
-        timestamp = int(time.time())
-        filename = f"{args.model}_{timestamp}_{safe_prompt}.png"
-        
-        # Subfolder logic (optional, keep flat for script default or mimic API structure?)
-        if "portrait" in prompt_text.lower(): category = "Portraits"
-        elif "landscape" in prompt_text.lower(): category = "Landscapes"
-        
-        cat_dir = output_dir / category
-        cat_dir.mkdir(exist_ok=True)
-        final_path = cat_dir / filename
-        
-        try:
-            provider.generate(prompt_text, str(final_path), width=512, height=512 if args.model == "lcm" else 512, workflow_path=workflow_path)
-            print(f"   -> Saved to {category}/{filename}")
-        except Exception as e:
-            print(f"[Error] Generation failed: {e}")
+    asyncio.run(_generate_prompts(args, prompts, output_dir, workflow_path))
 
     print("\n[System] Batch complete.")
 
@@ -135,6 +145,76 @@ def cmd_create_admin(args):
     except Exception as e:
         print(f"[Error] Database connection failed: {e}")
 
+def cmd_reconcile_batches(args):
+    print("============================================")
+    print(" MAYAGEN BATCH PROGRESS RECONCILE")
+    print("============================================")
+
+    # Imported lazily: pulls in the async engine, which needs DATABASE_URL
+    from .services.worker import reconcile_batch_progress
+
+    reconciled = asyncio.run(reconcile_batch_progress(args.batch_id, args.edit_batch_id))
+    for table, count in reconciled.items():
+        print(f"[Success] Recounted {count} row(s) in '{table}'.")
+
+def _run_worker_process(roles, shard_index, shard_count):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(processName)s] %(name)s %(levelname)s: %(message)s"
+    )
+    # Imported lazily: pulls in the async engine, which needs DATABASE_URL
+    from .services.worker import serve_workers
+
+    if config.METRICS["worker_port"]:
+        from prometheus_client import start_http_server
+        start_http_server(config.METRICS["worker_port"] + shard_index)
+
+    # SIGTERM / Ctrl+C drain the workers: in-flight jobs finish or are handed back
+    asyncio.run(serve_workers(roles, shard_index, shard_count, handle_signals=True))
+
+def cmd_worker(args):
+    roles = [role.strip() for role in args.roles.split(",") if role.strip()]
+    unknown = [role for role in roles if role not in config.WORKER_ROLES]
+    if not roles or unknown:
+        print(f"[Error] Invalid role(s): {', '.join(unknown) or args.roles}. Choose from: {', '.join(config.WORKER_ROLES)}")
+        return
+
+    print("============================================")
+    print(f" MAYAGEN WORKER | Roles: {', '.join(roles)} | Processes: {args.processes}")
+    print("============================================")
+
+    if args.processes <= 1:
+        _run_worker_process(roles, 0, 1)
+        return
+
+    # Each process is an independent queue consumer; the comfy role is sharded by node
+    processes = [
+        multiprocessing.Process(
+            target=_run_worker_process,
+            args=(roles, index, args.processes),
+            name=f"mayagen-worker-{index + 1}"
+        )
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    # Forward SIGTERM so every child drains; Ctrl+C already reaches the whole process group
+    def forward_sigterm(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward_sigterm)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.join()
+
+    failed = [process.name for process in processes if process.exitcode]
+    if failed:
+        print(f"[Error] Worker process(es) exited with an error: {', '.join(failed)}")
+        sys.exit(1)
+
 def main():
     parser = argparse.ArgumentParser(description="MayaGen CLI Tool")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
@@ -151,6 +231,21 @@ def main():
     parser_admin.add_argument("--id", type=int, dest="user_id", help="Specific User ID to promote")
     parser_admin.set_defaults(func=cmd_create_admin)
 
+    # Reconcile Batches Command
+    parser_reconcile = subparsers.add_parser("reconcile-batches", help="Recount batch progress counters from image rows")
+    parser_reconcile.add_argument("--batch-id", type=int, dest="batch_id", help="Only recount this batch job")
+    parser_reconcile.add_argument("--edit-batch-id", type=int, dest="edit_batch_id", help="Only recount this edit batch job")
+    parser_reconcile.set_defaults(func=cmd_reconcile_batches)
+
+    # Worker Command
+    parser_worker = subparsers.add_parser("worker", help="Run background worker loops (separately from the API)")
+    parser_worker.add_argument(
+        "--roles", type=str, default=",".join(config.WORKER_ROLES),
+        help=f"Comma-separated roles to run: {', '.join(config.WORKER_ROLES)}"
+    )
+    parser_worker.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+    parser_worker.set_defaults(func=cmd_worker)
+
     args = parser.parse_args()
     
     if hasattr(args, "func"):
@@ -39,7 +39,132 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 COMFYUI = {
     "server_address": os.getenv("COMFYUI_SERVER_ADDRESS", "127.0.0.1:8188"),
     "output_dir": "comfy_output", # Temporary folder on server if needed
-    "timeout": 3000 
+    "timeout": 3000,
+    # Opt-in: have ComfyUI push finished images over the websocket (SaveImageWebsocket node,
+    # custom_nodes/websocket_image_save.py) instead of fetching them through /history and /view
+    "websocket_images": os.getenv("COMFYUI_WS_IMAGES", "false").lower() in ("1", "true", "yes"),
+}
+
+# ComfyUI Worker Pool
+# COMFYUI_NODES: comma-separated "host:port=slots" entries, e.g. "10.0.0.5:8188=2,10.0.0.6:8188=4".
+# Falls back to COMFYUI_SERVER_ADDRESS with COMFYUI_SLOTS slots.
+# Each slot claims, runs and finalizes jobs independently, so nodes that can
+# pipeline several prompts are kept busy while a slow render is in flight.
+COMFYUI_DEFAULT_SLOTS = int(os.getenv("COMFYUI_SLOTS", "1"))
+# COMFYUI_PIPELINE_DEPTH: prompts kept queued ahead inside ComfyUI per node (0-2), on top of
+# its slots. The next render starts as soon as the GPU frees up, while the previous job is
+# still downloading and committing. 0 disables pipelining.
+COMFYUI_PIPELINE_DEPTH = min(2, max(0, int(os.getenv("COMFYUI_PIPELINE_DEPTH", "1"))))
+
+def _parse_comfy_nodes(raw: str) -> list:
+    nodes = []
+    for entry in raw.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        address, _, slots = entry.partition("=")
+        nodes.append({
+            "server_address": address.strip(),
+            "slots": max(1, int(slots)) if slots.strip() else COMFYUI_DEFAULT_SLOTS,
+            "pipeline_depth": COMFYUI_PIPELINE_DEPTH,
+        })
+    return nodes
+
+COMFYUI_NODES = _parse_comfy_nodes(os.getenv("COMFYUI_NODES", "")) or [
+    {"server_address": COMFYUI["server_address"], "slots": COMFYUI_DEFAULT_SLOTS, "pipeline_depth": COMFYUI_PIPELINE_DEPTH}
+]
+
+# ComfyUI node health: every probe_interval seconds each node's /queue is polled for load.
+# failure_threshold consecutive failures (probes or node-level job errors) open the node's
+# circuit breaker: it stops claiming until a probe succeeds after reset_timeout seconds.
+COMFYUI_HEALTH = {
+    "probe_interval": float(os.getenv("COMFYUI_PROBE_INTERVAL", "5")),
+    "probe_timeout": float(os.getenv("COMFYUI_PROBE_TIMEOUT", "5")),
+    "failure_threshold": int(os.getenv("COMFYUI_BREAKER_FAILURES", "3")),
+    "reset_timeout": float(os.getenv("COMFYUI_BREAKER_RESET", "30")),
+}
+
+# Background Worker Settings
+# The API process runs every worker loop in-process unless API_RUN_WORKERS=false;
+# then run them separately with `python main.py worker`.
+API_RUN_WORKERS = os.getenv("API_RUN_WORKERS", "true").lower() in ("1", "true", "yes")
+WORKER_ROLES = ["comfy", "azure", "batch-manager"]
+
+WORKER = {
+    # Loops block on Postgres LISTEN/NOTIFY; this is the fallback poll interval (seconds)
+    "poll_interval": float(os.getenv("WORKER_POLL_INTERVAL", "5")),
+    # How often (seconds) the LISTEN connection is pinged to detect a dead socket
+    "listener_keepalive": 30,
+    # Jobs reserved per claim round-trip (0 = one per worker slot)
+    "claim_batch_size": int(os.getenv("WORKER_CLAIM_BATCH_SIZE", "0")),
+    # Rows per multi-row INSERT when expanding batches into image jobs
+    "insert_chunk_size": int(os.getenv("WORKER_INSERT_CHUNK_SIZE", "1000")),
+    # Claimed jobs are leased; a job whose lease expires is requeued by any node's reaper
+    "lease_seconds": int(os.getenv("WORKER_LEASE_SECONDS", "60")),
+    "heartbeat_interval": int(os.getenv("WORKER_HEARTBEAT_INTERVAL", "15")),
+    "reaper_interval": int(os.getenv("WORKER_REAPER_INTERVAL", "30")),
+    # On drain (SIGTERM / admin request), in-flight jobs get this long (seconds) to finish
+    # before they are handed back to the queue
+    "drain_timeout": int(os.getenv("WORKER_DRAIN_TIMEOUT", "120")),
+}
+
+# Azure Foundry Worker
+# Up to `concurrency` edit requests run at once. Requests are paced by a token bucket
+# that starts at `initial_rate` req/s and adapts to 429s: +rate_increase per success,
+# x rate_decrease_factor per throttle (AIMD), pausing for any Retry-After.
+AZURE_WORKER = {
+    "concurrency": int(os.getenv("AZURE_WORKER_CONCURRENCY", "16")),
+    "initial_rate": float(os.getenv("AZURE_RATE_LIMIT", "4")),
+    "min_rate": float(os.getenv("AZURE_RATE_LIMIT_MIN", "0.1")),
+    "max_rate": float(os.getenv("AZURE_RATE_LIMIT_MAX", "20")),
+    "rate_increase": 0.1,
+    "rate_decrease_factor": 0.5,
+    # A throttled (429) request is retried in place this many times, after the limiter's pause
+    "throttle_retries": int(os.getenv("AZURE_THROTTLE_RETRIES", "3")),
+}
+
+# Generation Cache
+# Identical ComfyUI renders (same final workflow and model) reuse the earlier output file.
+# Jobs and batches can opt out individually with use_cache=false.
+GENERATION_CACHE = {
+    "enabled": os.getenv("GENERATION_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"),
+}
+
+# Metrics (Prometheus)
+# The API serves GET /metrics; worker processes serve theirs on WORKER_METRICS_PORT + shard index (0 = off)
+METRICS = {
+    "queue_depth_interval": float(os.getenv("METRICS_QUEUE_DEPTH_INTERVAL", "15")),
+    "worker_port": int(os.getenv("WORKER_METRICS_PORT", "0")),
+}
+
+# Job Retries
+# Retryable failures are requeued with exponential backoff (seconds, with jitter);
+# a job that fails max_attempts times is moved to DEAD_LETTER for an admin to inspect.
+RETRY = {
+    "max_attempts": int(os.getenv("RETRY_MAX_ATTEMPTS", "5")),
+    "base_delay": float(os.getenv("RETRY_BASE_DELAY", "10")),
+    "max_delay": float(os.getenv("RETRY_MAX_DELAY", "600")),
+}
+
+# Queue Scheduling
+# "fair": batch jobs are interleaved across users by weighted fair queuing (User.queue_weight)
+# "fifo": jobs run in submission order
+QUEUE = {
+    "scheduler": os.getenv("QUEUE_SCHEDULER", "fair"),
+    # Model affinity: ComfyUI nodes prefer jobs for the model they ran last (avoids checkpoint
+    # swaps), for at most affinity_max_streak jobs / affinity_max_seconds before taking the queue head
+    "model_affinity": os.getenv("QUEUE_MODEL_AFFINITY", "true").lower() in ("1", "true", "yes"),
+    "affinity_max_streak": int(os.getenv("QUEUE_AFFINITY_MAX_STREAK", "20")),
+    "affinity_max_seconds": float(os.getenv("QUEUE_AFFINITY_MAX_SECONDS", "120")),
+}
+
+# Batch Expansion
+# Batches are materialized into Image rows one chunk at a time, whenever the
+# batch's QUEUED backlog drops below the low watermark.
+BATCH_EXPANSION = {
+    "chunk_size": int(os.getenv("BATCH_EXPANSION_CHUNK_SIZE", "1000")),
+    "low_watermark": int(os.getenv("BATCH_EXPANSION_LOW_WATERMARK", "500")),
+    "max_images": int(os.getenv("BATCH_MAX_IMAGES", "1000000")),
 }
 
 WORKFLOWS = {
@@ -1,7 +1,9 @@
+import time
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 from enum import Enum
 from sqlmodel import SQLModel, Field, Column, JSON, Relationship, select
+from sqlalchemy import Index, SmallInteger, text
 from sqlalchemy.dialects.postgresql import JSONB
 
 class JobStatus(str, Enum):
@@ -10,6 +12,7 @@ class JobStatus(str, Enum):
     COMPLETED = "COMPLETED"
     FAILED = "FAILED"
     CANCELLED = "CANCELLED"
+    DEAD_LETTER = "DEAD_LETTER"  # Retryable failure that exhausted its attempts
 
 class BatchJobStatus(str, Enum):
     QUEUED = "queued"
@@ -35,6 +38,10 @@ class User(SQLModel, table=True):
     location: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     
+    # Fair-share scheduling: relative share of the queue and the user's virtual clock
+    queue_weight: float = Field(default=1.0)
+    queue_vtime: Optional[float] = None
+    
     # Relationships
     images: List["Image"] = Relationship(back_populates="user")
     batch_jobs: List["BatchJob"] = Relationship(back_populates="user")
@@ -42,6 +49,21 @@ class User(SQLModel, table=True):
     activity_logs: List["ActivityLog"] = Relationship(back_populates="user")
 
 class Image(SQLModel, table=True):
+    __table_args__ = (
+        # Serves the worker claim query and the queue-position COUNT: only QUEUED rows,
+        # in scheduler order, so both stay flat however many completed images exist.
+        Index(
+            "idx_image_queue_claim",
+            "provider", "priority", "fair_key", "id",
+            postgresql_where=text("status = 'QUEUED'")
+        ),
+        Index(
+            "idx_image_cache_key",
+            "cache_key",
+            postgresql_where=text("cache_key IS NOT NULL AND status = 'COMPLETED'")
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     filename: Optional[str] = None # Nullable until processed
     file_path: Optional[str] = None # Nullable until processed
@@ -68,6 +90,27 @@ class Image(SQLModel, table=True):
     status: JobStatus = Field(default=JobStatus.QUEUED, index=True)
     error_message: Optional[str] = None
     
+    # Scheduling: jobs are claimed by (priority, fair_key). Defaults to enqueue time (FIFO);
+    # batch expansion stamps weighted fair-queuing keys instead.
+    # priority: 0 for interactive jobs, 1 for batch jobs (set by job_queue.queued_image_row).
+    priority: int = Field(
+        default=0,
+        sa_column=Column(SmallInteger, nullable=False, server_default=text("0"))
+    )
+    fair_key: float = Field(default_factory=time.time)
+    
+    # Generation cache: hash of the final workflow + model (see generation_cache), and the opt-out
+    cache_key: Optional[str] = None
+    use_cache: bool = Field(default=True)
+
+    # Retries: failed attempts so far, and the earliest time the job may be claimed again
+    attempts: int = Field(default=0)
+    not_before: Optional[datetime] = None
+
+    # Lease (set while PROCESSING): owning worker process and when its claim runs out
+    worker_id: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    
     # Relationships
     user_id: Optional[int] = Field(default=None, foreign_key="user.id")
     user: Optional[User] = Relationship(back_populates="images")
@@ -109,6 +152,10 @@ class BatchJob(SQLModel, table=True):
     status: BatchJobStatus = Field(default=BatchJobStatus.QUEUED, index=True)
     generated_count: int = Field(default=0)
     failed_count: int = Field(default=0)
+    # Expansion cursor: prompts [0, expanded_count) already exist as Image rows
+    expanded_count: int = Field(default=0)
+    # Reuse identical earlier renders for this batch's images (generation cache)
+    use_cache: bool = Field(default=True)
     
     # Generation Settings
     model: str = "sd15"
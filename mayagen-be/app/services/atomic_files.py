@@ -0,0 +1,108 @@
+"""
+Atomic Files - write generated images so a partial file is never visible.
+
+Data goes to a hidden temp file in the destination directory, is fsynced and
+then renamed over the final path (atomic on POSIX within one filesystem). A
+crash mid-write leaves at most a `.*.tmp` file behind, never a truncated image
+at a path the gallery serves. `stream_to_file()` writes chunks as they arrive,
+so a large output never has to sit in memory whole. `link_file()` and
+`copy_file()` place an existing file the same way.
+"""
+
+import asyncio
+import os
+import shutil
+import uuid
+from typing import AsyncIterable
+
+
+def temp_path_for(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.tmp")
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _commit(temp_path: str, path: str):
+    os.replace(temp_path, path)
+    # Persist the rename itself
+    directory = os.path.dirname(path) or "."
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return # e.g. Windows: directories cannot be opened
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _flush_and_sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def write_bytes(path: str, data: bytes):
+    """Blocking atomic write of `data` to `path`; run it with asyncio.to_thread."""
+    temp_path = temp_path_for(path)
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            _flush_and_sync(f)
+        _commit(temp_path, path)
+    except BaseException:
+        _remove_quietly(temp_path)
+        raise
+
+
+def link_file(source: str, path: str):
+    """Blocking: hard-link `source` to `path` via a unique temp name, atomically. OSError if links are unsupported."""
+    temp_path = temp_path_for(path)
+    os.link(source, temp_path)
+    try:
+        _commit(temp_path, path)
+    except BaseException:
+        _remove_quietly(temp_path)
+        raise
+
+
+def copy_file(source: str, path: str):
+    """Blocking atomic copy of `source` to `path`; run it with asyncio.to_thread."""
+    temp_path = temp_path_for(path)
+    try:
+        with open(source, "rb") as src, open(temp_path, "wb") as f:
+            shutil.copyfileobj(src, f)
+            _flush_and_sync(f)
+        _commit(temp_path, path)
+    except BaseException:
+        _remove_quietly(temp_path)
+        raise
+
+
+async def stream_to_file(chunks: AsyncIterable[bytes], path: str) -> int:
+    """
+    Write `chunks` to `path` atomically as they arrive. Returns the number of bytes written.
+    Every write, the fsync and the rename run off the event loop: a slow disk must not
+    stall websocket dispatch or lease heartbeats.
+    """
+    temp_path = temp_path_for(path)
+    size = 0
+    try:
+        f = await asyncio.to_thread(open, temp_path, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(f.write, chunk)
+                size += len(chunk)
+            await asyncio.to_thread(_flush_and_sync, f)
+        finally:
+            f.close()
+        await asyncio.to_thread(_commit, temp_path, path)
+    except BaseException:
+        _remove_quietly(temp_path)
+        raise
+    return size
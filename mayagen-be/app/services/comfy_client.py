@@ -1,122 +1,419 @@
-import websocket
+import asyncio
 import uuid
 import json
-import urllib.request
-import urllib.parse
-import time
-import os
+import struct
+from collections import OrderedDict
 from pathlib import Path
+from typing import Callable, Optional
+
+import httpx
+from websockets.asyncio.client import connect as ws_connect
+
 from ..core import config
+from . import atomic_files, workflow_templates
+from .job_errors import JobCancelled, PermanentError, RetryableError
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Messages kept for prompts nobody waits on yet (they can beat the /prompt response)
+EARLY_MESSAGE_PROMPTS = 256
+
+# Binary websocket frames: event type, then image format, then the image bytes
+BINARY_PREVIEW_IMAGE = 1
+IMAGE_FORMAT_PNG = 2
+
+
+def http_client(server_address: str) -> httpx.AsyncClient:
+    """
+    Pooled keep-alive HTTP session for one ComfyUI server.
+    Share it between every provider talking to that server; the owner closes it.
+    """
+    return httpx.AsyncClient(
+        base_url=f"http://{server_address}",
+        timeout=httpx.Timeout(30.0, read=120.0),
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=32),
+    )
+
+
+def _validation_message(response: httpx.Response) -> str:
+    """Summary of a /prompt 400: the top-level error plus each failing node's errors."""
+    try:
+        body = response.json()
+    except ValueError:
+        return response.text[:500]
+    error = body.get("error") or {}
+    parts = [error.get("message") or "invalid prompt"] if isinstance(error, dict) else [str(error)]
+    for node_id, node in (body.get("node_errors") or {}).items():
+        messages = "; ".join(
+            f"{e.get('message')}: {e.get('details')}" if e.get("details") else str(e.get("message"))
+            for e in node.get("errors", [])
+        )
+        parts.append(f"node {node_id} ({node.get('class_type')}): {messages}")
+    return " | ".join(parts)
+
+
+class _PromptWaiter:
+    """Completion state of one queued prompt, fed by the node's websocket dispatcher."""
+
+    def __init__(self, prompt_id: str, capture_nodes: Optional[set] = None):
+        self.prompt_id = prompt_id
+        self.started = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.error: Optional[Exception] = None
+        self.progress = (0, 0)
+        # Websocket delivery: PNGs pushed by these (SaveImageWebsocket) nodes
+        self.capture_nodes = capture_nodes or set()
+        self.images: list = []
+
+    def finish(self, error: Optional[Exception] = None):
+        if self.finished.is_set():
+            return
+        self.error = error
+        self.started.set()
+        self.finished.set()
+
+    def handle(self, message: dict):
+        kind = message.get('type')
+        data = message.get('data') or {}
+        if kind in ('execution_start', 'executing', 'progress', 'execution_cached'):
+            self.started.set()
+        if kind == 'binary':
+            self._capture(message['node'], message['frame'])
+        elif kind == 'progress':
+            self.progress = (data.get('value', 0), data.get('max', 0))
+        elif (kind == 'executing' and data.get('node') is None) or kind == 'execution_success':
+            self.finish()
+        elif kind == 'execution_error':
+            # A node raised while running the workflow: the same prompt fails again
+            self.finish(PermanentError(
+                f"ComfyUI execution error in node {data.get('node_id')}: "
+                f"{data.get('exception_type')}: {data.get('exception_message')}"
+            ))
+        elif kind == 'execution_interrupted':
+            self.finish(RetryableError(f"Prompt {self.prompt_id} was interrupted on the ComfyUI server"))
+
+    def _capture(self, node_id: Optional[str], frame: bytes):
+        # Sampler previews arrive the same way; only frames sent while an output node runs count
+        if node_id not in self.capture_nodes or len(frame) < 8:
+            return
+        event, image_format = struct.unpack(">II", frame[:8])
+        if event == BINARY_PREVIEW_IMAGE and image_format == IMAGE_FORMAT_PNG:
+            self.images.append(frame[8:])
+
 
 class ComfyUIProvider:
-    def __init__(self, server_address):
+    """
+    asyncio ComfyUI client for one node. Every call is a coroutine: an in-flight
+    generation is an awaiting coroutine, not a thread. HTTP requests reuse a pooled
+    keep-alive session, and a single long-lived websocket (one client_id) carries
+    the progress of every prompt this provider queued. A dispatcher routes each
+    message to the waiter of its prompt_id, so any number of concurrent worker
+    slots can share one provider.
+    The websocket reconnects on its own; after a reconnect, prompts still being
+    waited on are checked against /queue and /history, so completions missed while
+    it was down are not lost. Call `aclose()` when done.
+    """
+
+    def __init__(self, server_address, http: Optional[httpx.AsyncClient] = None):
         self.server_address = server_address
         self.client_id = str(uuid.uuid4())
-        self.ws = websocket.WebSocket()
+        self.http = http or http_client(server_address)
+        self._owns_http = http is None
+        self._waiters: dict = {}
+        self._early = OrderedDict()
+        self._connected = asyncio.Event()
+        self._reader: Optional[asyncio.Task] = None
+        # (prompt_id, node_id) ComfyUI is executing; binary frames carry no prompt_id
+        self._executing = (None, None)
+
+    async def aclose(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._owns_http:
+            await self.http.aclose()
+
+    # --- Websocket ---
+
+    async def connect(self, timeout: float = 30.0):
+        """Start the node's websocket (once) and wait until it is connected."""
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read_forever())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Could not connect to the ComfyUI websocket at {self.server_address}")
+
+    async def _read_forever(self):
+        delay = 1
+        url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        while True:
+            try:
+                async with ws_connect(url, max_size=None) as ws:
+                    print(f"[ComfyUI] Websocket connected to {self.server_address}.")
+                    self._connected.set()
+                    delay = 1
+                    if self._waiters:
+                        asyncio.create_task(self._resubscribe())
+                    async for out in ws:
+                        if isinstance(out, str):
+                            self._dispatch(json.loads(out))
+                        else:
+                            self._dispatch_binary(out)
+            except asyncio.CancelledError:
+                self._connected.clear()
+                raise
+            except Exception as e:
+                print(f"[ComfyUI] Websocket to {self.server_address} lost: {e}")
+            self._connected.clear()
+            self._executing = (None, None)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _dispatch(self, message: dict):
+        data = message.get('data')
+        prompt_id = data.get('prompt_id') if isinstance(data, dict) else None
+        if not prompt_id:
+            return # Server-wide status
+        if message.get('type') == 'executing':
+            self._executing = (prompt_id, data.get('node'))
+        waiter = self._waiters.get(prompt_id)
+        if waiter is not None:
+            waiter.handle(message)
+            return
+        self._early.setdefault(prompt_id, []).append(message)
+        while len(self._early) > EARLY_MESSAGE_PROMPTS:
+            self._early.popitem(last=False)
 
-    def load_workflow(self, workflow_path: Path):
-        with open(workflow_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    def _dispatch_binary(self, frame: bytes):
+        """Binary frames belong to whatever node is executing (previews, websocket outputs)."""
+        prompt_id, node_id = self._executing
+        if prompt_id is None:
+            return
+        waiter = self._waiters.get(prompt_id)
+        if waiter is not None and not waiter.capture_nodes:
+            return # Not capturing: a preview nobody needs
+        self._dispatch({"type": "binary", "node": node_id, "frame": frame, "data": {"prompt_id": prompt_id}})
 
-    def queue_prompt(self, prompt_workflow):
+    def _subscribe(self, prompt_id: str, capture_nodes: Optional[set] = None) -> _PromptWaiter:
+        waiter = _PromptWaiter(prompt_id, capture_nodes)
+        self._waiters[prompt_id] = waiter
+        for message in self._early.pop(prompt_id, []):
+            waiter.handle(message)
+        return waiter
+
+    async def _resubscribe(self):
+        """After a reconnect: recover what in-flight prompts missed while the socket was down."""
+        try:
+            queue = await self.get_queue()
+            running = {item[1] for item in queue.get("queue_running", [])}
+            pending = {item[1] for item in queue.get("queue_pending", [])}
+            for prompt_id, waiter in list(self._waiters.items()):
+                if prompt_id in running:
+                    waiter.started.set()
+                elif prompt_id not in pending:
+                    history = (await self.get_history(prompt_id)).get(prompt_id)
+                    if history is None:
+                        continue
+                    status = history.get("status") or {}
+                    if status.get("status_str") == "error":
+                        waiter.finish(RuntimeError(f"ComfyUI execution error for prompt {prompt_id}"))
+                    else:
+                        waiter.finish()
+            print(f"[ComfyUI] Resubscribed {len(self._waiters)} in-flight prompt(s) on {self.server_address}.")
+        except Exception as e:
+            print(f"[ComfyUI] Could not resubscribe in-flight prompts on {self.server_address}: {e}")
+
+    async def queue_prompt(self, prompt_workflow):
         p = {"prompt": prompt_workflow, "client_id": self.client_id}
-        data = json.dumps(p).encode('utf-8')
-        req = urllib.request.Request(f"http://{self.server_address}/prompt", data=data)
-        return json.loads(urllib.request.urlopen(req).read())
+        response = await self.http.post("/prompt", json=p)
+        if response.status_code == 400:
+            # Workflow validation failed (missing model, bad input, ...): retrying cannot fix it
+            raise PermanentError(f"ComfyUI rejected the prompt: {_validation_message(response)}")
+        response.raise_for_status()
+        return response.json()
+
+    async def get_image(self, filename, subfolder, folder_type):
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        response = await self.http.get("/view", params=data)
+        response.raise_for_status()
+        return response.content
 
-    def get_image(self, filename, subfolder, folder_type):
+    async def download_image(self, filename, subfolder, folder_type, output_path: str) -> int:
+        """Stream an output image straight to `output_path` (atomically). Returns its size in bytes."""
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(f"http://{self.server_address}/view?{url_values}") as response:
-            return response.read()
+        async with self.http.stream("GET", "/view", params=data) as response:
+            response.raise_for_status()
+            return await atomic_files.stream_to_file(response.aiter_bytes(DOWNLOAD_CHUNK_SIZE), output_path)
+
+    async def get_queue(self):
+        response = await self.http.get("/queue")
+        response.raise_for_status()
+        return response.json()
+
+    async def delete_from_queue(self, prompt_ids):
+        response = await self.http.post("/queue", json={"delete": list(prompt_ids)})
+        response.raise_for_status()
+
+    async def interrupt(self, prompt_id=None):
+        # With a prompt_id, ComfyUI only interrupts if that prompt is the one executing
+        response = await self.http.post("/interrupt", json={"prompt_id": prompt_id} if prompt_id else {})
+        response.raise_for_status()
 
-    def get_history(self, prompt_id):
-        with urllib.request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+    async def cancel_prompt(self, prompt_id):
+        """Drop a prompt from ComfyUI: delete it if still pending, interrupt it if executing."""
+        queue = await self.get_queue()
+        if any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+            await self.delete_from_queue([prompt_id])
+            print(f"[ComfyUI] Deleted pending prompt {prompt_id}.")
+        if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            await self.interrupt(prompt_id)
+            print(f"[ComfyUI] Interrupted prompt {prompt_id}.")
 
-    def generate(self, prompt_text: str, output_path: str, width: int = 512, height: int = 512, workflow_path: Path = None, timeout: int = 600):
+    async def get_history(self, prompt_id):
+        response = await self.http.get(f"/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def build_workflow(
+        self,
+        prompt_text: str,
+        width: int = 512,
+        height: int = 512,
+        workflow_path: Path = None,
+        negative_prompt: Optional[str] = None,
+        seed: Optional[int] = None,
+        steps: Optional[int] = None,
+        batch_size: Optional[int] = None
+    ):
+        """
+        Instantiate the compiled workflow template with this job's values.
+        Values left as None keep the template's defaults. The result is exactly
+        what gets queued, so it also identifies the render. Treat it as read-only:
+        it shares unpatched nodes with the template.
+        """
+        return workflow_templates.instantiate(
+            workflow_path,
+            prompt=prompt_text,
+            negative_prompt=negative_prompt,
+            width=width,
+            height=height,
+            seed=seed,
+            steps=steps,
+            batch_size=batch_size,
+        )
+
+    async def _wait_event(self, event: asyncio.Event, timeout: float, cancel_event: Optional[asyncio.Event]) -> bool:
+        """Wait for `event`; False on timeout, JobCancelled as soon as `cancel_event` is set."""
+        target = asyncio.ensure_future(event.wait())
+        waiting = {target}
+        if cancel_event is not None:
+            waiting.add(asyncio.ensure_future(cancel_event.wait()))
+        try:
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for future in waiting:
+                future.cancel()
+        if target in done:
+            return True
+        if done:
+            raise JobCancelled("Cancelled while waiting on ComfyUI")
+        return False
+
+    async def wait_for(
+        self,
+        prompt_id,
+        timeout: int = 600,
+        cancel_event: asyncio.Event = None,
+        on_execution_start: Optional[Callable[[], None]] = None
+    ):
+        """
+        Wait until `prompt_id` has finished executing.
+        `timeout` applies to the wait in ComfyUI's queue (prompts queued ahead by
+        other slots run first) and again once the prompt starts executing, when
+        `on_execution_start()` is called. Raises JobCancelled as soon as
+        `cancel_event` is set, and the node's error if the prompt failed.
+        """
+        waiter = self._waiters.get(prompt_id) or self._subscribe(prompt_id)
+        try:
+            # 1. In ComfyUI's queue
+            if not await self._wait_event(waiter.started, timeout, cancel_event):
+                raise TimeoutError(f"Generation timed out after {timeout} seconds (waiting in the ComfyUI queue)")
+            if on_execution_start is not None:
+                on_execution_start()
+
+            # 2. Executing
+            if not await self._wait_event(waiter.finished, timeout, cancel_event):
+                raise TimeoutError(f"Generation timed out after {timeout} seconds (execution)")
+            if waiter.error is not None:
+                raise waiter.error
+            print("[ComfyUI] Generation finished.")
+        finally:
+            self._waiters.pop(prompt_id, None)
+
+    async def generate(self, prompt_text: str, output_path: str, width: int = 512, height: int = 512, workflow_path: Path = None, timeout: int = 600, workflow: dict = None, cancel_event: asyncio.Event = None, on_execution_start: Optional[Callable[[], None]] = None, websocket_images: Optional[bool] = None):
         """
         Main function to generate an image from text.
-        Timeout default: 10 minutes.
+        Pass `workflow` to queue a workflow already built by `build_workflow()`.
+        Setting `cancel_event` drops the prompt from ComfyUI and raises JobCancelled
+        right away, freeing the node for the next job.
+        With `websocket_images` (default: COMFYUI["websocket_images"]) the output is
+        pushed over the websocket instead of saved on the server and fetched through
+        /history and /view.
+        Timeout default: 10 minutes (see `wait_for`).
         """
-        # 1. Connect first
-        print(f"[ComfyUI] Connecting to {self.server_address}...")
-        self.ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
-        self.ws.settimeout(1.0)
-        
-        # 2. Load Workflow Template
-        workflow = self.load_workflow(workflow_path)
-        
-        # 3. Inject Prompt (Scanning for CLIPTextEncode nodes)
-        if "6" in workflow:
-           workflow["6"]["inputs"]["text"] = prompt_text
-           print("[ComfyUI] Updated prompt.")
-
-        # 4. Inject Resolution (Scanning for EmptyLatentImage)
-        # ... logic for resolution ...
-        found_latent = False
-        for node_id, node in workflow.items():
-            if node.get("class_type") == "EmptyLatentImage":
-                node["inputs"]["width"] = width
-                node["inputs"]["height"] = height
-                print(f"[ComfyUI] Updated resolution to {width}x{height}")
-                found_latent = True
-                break
-        
-        if not found_latent:
-            if "5" in workflow:
-                workflow["5"]["inputs"]["width"] = width
-                workflow["5"]["inputs"]["height"] = height
-
-        # 5. Send to Queue
-        prompt_response = self.queue_prompt(workflow)
+        if workflow is None:
+            workflow = self.build_workflow(prompt_text, width, height, workflow_path)
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled("Cancelled before it was queued")
+
+        if websocket_images is None:
+            websocket_images = config.COMFYUI["websocket_images"]
+        capture_nodes = None
+        if websocket_images:
+            # Patched after build_workflow, so cache keys do not depend on the delivery mode
+            workflow, capture_nodes = workflow_templates.with_websocket_output(workflow)
+
+        # 1. The node's websocket must be up, so no message for our prompt is missed
+        await self.connect()
+
+        # 2. Send to Queue
+        prompt_response = await self.queue_prompt(workflow)
         prompt_id = prompt_response['prompt_id']
+        waiter = self._subscribe(prompt_id, capture_nodes)
         print(f"[ComfyUI] Prompt queued: {prompt_id}. Waiting for execution...")
 
-        # 6. Listen for Result
-        start_time = time.time()
-        while True:
-            if time.time() - start_time > timeout:
-                self.ws.close()
-                raise TimeoutError(f"Generation timed out after {timeout} seconds")
+        # 3. Listen for Result
+        try:
+            await self.wait_for(prompt_id, timeout, cancel_event, on_execution_start)
+        except (JobCancelled, asyncio.CancelledError):
+            # Do not leave the prompt occupying the node
+            await asyncio.shield(self.cancel_prompt(prompt_id))
+            raise
+
+        if capture_nodes:
+            if not waiter.images:
+                # E.g. the socket dropped while the frame was in flight; the server kept no copy
+                raise RetryableError(f"Prompt {prompt_id} finished but no image arrived over the websocket")
+            await asyncio.to_thread(atomic_files.write_bytes, output_path, waiter.images[0])
+            print(f"[ComfyUI] Saved to {output_path} ({len(waiter.images[0])} bytes, via websocket)")
+            return output_path
+
+        # 4. Retrieve Image History
+        history = (await self.get_history(prompt_id))[prompt_id]
+
+        # 5. Download Image
+        for node_id in history['outputs']:
+            node_output = history['outputs'][node_id]
+            if 'images' in node_output:
+                for image in node_output['images']:
+                    # Streamed to a temp file, then renamed: never whole in memory, never half-written
+                    size = await self.download_image(image['filename'], image['subfolder'], image['type'], output_path)
+                    print(f"[ComfyUI] Saved to {output_path} ({size} bytes)")
+                    return output_path
 
-            try:
-                out = self.ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message['type'] == 'executing':
-                        data = message['data']
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            print("[ComfyUI] Generation finished.")
-                            break # Execution is done
-                else:
-                    continue # Binary data (previews), ignore
-            except websocket.WebSocketTimeoutException:
-                continue
-            except Exception as e:
-                self.ws.close()
-                raise e
-
-        # 7. Retrieve Image History
-        # ... rest of the function ...
-        history = self.get_history(prompt_id)[prompt_id]
-        
-        # 8. Download Image
-        for o in history['outputs']:
-            for node_id in history['outputs']:
-                node_output = history['outputs'][node_id]
-                if 'images' in node_output:
-                    for image in node_output['images']:
-                        image_data = self.get_image(image['filename'], image['subfolder'], image['type'])
-                        
-                        # Save
-                        with open(output_path, "wb") as f:
-                            f.write(image_data)
-                        print(f"[ComfyUI] Saved to {output_path}")
-                        
-                        # Cleanup
-                        self.ws.close()
-                        return output_path
-        
-        self.ws.close()
         raise Exception("No image found in output")
@@ -0,0 +1,153 @@
+"""
+ComfyUI Nodes - health, load and circuit breaking for the GPU boxes in COMFYUI_NODES.
+
+Each node has its own worker slots, claim buffer and provider (see
+`worker.comfy_worker_pool`). Work is pulled, not pushed: a slot only claims a
+job while its node is accepting, so queued jobs flow to the least-loaded
+healthy nodes on their own. A node is accepting when:
+
+*   its circuit breaker is closed, and
+*   our in-flight jobs plus the external load last seen in ComfyUI's queue
+    (prompts from other clients) are below its capacity (slots + pipeline depth).
+
+`probe_loop()` polls each node's `/queue` every COMFYUI_HEALTH["probe_interval"]
+seconds for that load. Failed probes and node-level job failures (connection
+errors, 5xx) count towards the breaker; after `failure_threshold` in a row it
+opens, the node's buffered jobs go back to the queue and its slots stop
+claiming. After `reset_timeout` seconds it is half-open: the next probe or job
+decides whether it closes again or reopens.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+import httpx
+import websockets
+
+from app.core import config
+from app.services import job_queue, metrics
+from app.services.comfy_client import ComfyUIProvider
+from app.services.job_queue import ClaimBuffer
+
+logger = logging.getLogger("comfy_nodes")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        on_open: Optional[Callable[[], None]] = None
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.on_open = on_open
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: str):
+        self._state = state
+        metrics.COMFYUI_NODE_BREAKER.labels(node=self.name).set(BREAKER_STATE_VALUES[state])
+
+    def record_success(self):
+        state = self.state
+        if state == OPEN:
+            return # Still cooling down: only a half-open trial may close it
+        self.failures = 0
+        if state != CLOSED:
+            logger.info(f"{self.name}: circuit closed, node is back.")
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        state = self.state
+        if state == HALF_OPEN or (state == CLOSED and self.failures >= self.failure_threshold):
+            logger.error(f"{self.name}: circuit open after {self.failures} failure(s); retrying in {self.reset_timeout:.0f}s.")
+            self._opened_at = time.monotonic()
+            self._set_state(OPEN)
+            if self.on_open:
+                self.on_open()
+
+
+class ComfyNode:
+    """One ComfyUI server: its provider, claim buffer, breaker and last observed load."""
+
+    def __init__(self, node_config: dict):
+        self.server_address = node_config["server_address"]
+        self.capacity = node_config["slots"] + node_config.get("pipeline_depth", 0)
+        self.provider = ComfyUIProvider(self.server_address)
+        # One claim per refill reserves work for every slot of the node
+        self.buffer = ClaimBuffer(
+            f"ComfyBuffer[{self.server_address}]",
+            job_queue.COMFY_PROVIDERS,
+            config.WORKER["claim_batch_size"] or self.capacity,
+            model_affinity=True,
+            on_model_swap=metrics.COMFYUI_MODEL_SWAPS.labels(node=self.server_address).inc,
+            # Only the breaker: a refill is sized for the node, so load is already accounted for
+            accepting=lambda: self.breaker.state == CLOSED
+        )
+        self.breaker = CircuitBreaker(
+            self.server_address,
+            config.COMFYUI_HEALTH["failure_threshold"],
+            config.COMFYUI_HEALTH["reset_timeout"],
+            on_open=self._on_breaker_open
+        )
+        self.in_flight = 0
+        self.external_load = 0
+
+    def accepting(self) -> bool:
+        return self.breaker.state == CLOSED and self.in_flight + self.external_load < self.capacity
+
+    def _on_breaker_open(self):
+        # Jobs claimed for this node but not started yet can run elsewhere. release()
+        # waits for a refill in flight, which itself hands back what it claimed
+        asyncio.get_running_loop().create_task(self.buffer.release())
+
+    async def probe(self):
+        try:
+            queue = await asyncio.wait_for(self.provider.get_queue(), config.COMFYUI_HEALTH["probe_timeout"])
+        except Exception as e:
+            logger.warning(f"{self.server_address}: health probe failed: {e}")
+            metrics.COMFYUI_NODE_UP.labels(node=self.server_address).set(0)
+            self.breaker.record_failure()
+            return
+
+        depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        # Our own prompts are counted by in_flight; the rest is other clients' work
+        self.external_load = max(0, depth - self.in_flight)
+        metrics.COMFYUI_NODE_UP.labels(node=self.server_address).set(1)
+        metrics.COMFYUI_NODE_QUEUE_DEPTH.labels(node=self.server_address).set(depth)
+        self.breaker.record_success()
+
+    async def probe_loop(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(config.COMFYUI_HEALTH["probe_interval"])
+
+
+def is_node_failure(error: BaseException) -> bool:
+    """Failures of the node itself (unreachable, dropped connection, 5xx), as opposed to the job."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (
+        ConnectionError,
+        httpx.TransportError,
+        websockets.exceptions.WebSocketException,
+    ))
@@ -0,0 +1,87 @@
+"""
+Generation Cache - reuse an earlier render instead of generating it again.
+
+ComfyUI renders are deterministic: the same workflow (prompt, resolution and
+seed injected) on the same model produces the same image. `cache_key()` hashes
+exactly that, and every completed ComfyUI image stores its key in
+`image.cache_key`. A later job with the same key hard-links (or copies) the
+earlier file to its own output path and completes without touching the GPU.
+
+The cache has no storage of its own, so eviction follows the files: deleting an
+image row removes its entry, and an entry whose file has disappeared from disk
+is cleared the next time it is looked up. Hard links keep every copy valid when
+the original is deleted.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+from sqlalchemy import text
+
+from app.database import get_session_context
+from app.services import atomic_files, metrics
+
+logger = logging.getLogger("generation_cache")
+
+LOOKUP_SQL = text("""
+    SELECT id, file_path
+    FROM image
+    WHERE cache_key = :cache_key
+    AND status = 'COMPLETED'
+    ORDER BY id DESC
+    LIMIT 5;
+""")
+
+EVICT_SQL = text("""
+    UPDATE image SET cache_key = NULL WHERE id = ANY(:ids);
+""")
+
+
+def cache_key(workflow: dict, model: str) -> str:
+    """SHA-256 of the final workflow JSON (prompt, resolution, seed injected) and the model."""
+    payload = json.dumps({"model": model, "workflow": workflow}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(source: str, destination: str):
+    # Both go through a unique temp file and an atomic rename (see atomic_files)
+    try:
+        atomic_files.link_file(source, destination)
+    except OSError:
+        # Different filesystem, or links not supported
+        atomic_files.copy_file(source, destination)
+
+
+async def fetch(key: str, output_path: str) -> Optional[int]:
+    """
+    Materialize a cached render at `output_path`.
+    Returns the id of the image it came from, or None on a miss.
+    """
+    async with get_session_context() as session:
+        result = await session.execute(LOOKUP_SQL, {"cache_key": key})
+        candidates = result.all()
+
+    stale = []
+    source_id = None
+    for candidate in candidates:
+        if not candidate.file_path or not os.path.exists(candidate.file_path):
+            stale.append(candidate.id)
+            continue
+        if os.path.abspath(candidate.file_path) != os.path.abspath(output_path):
+            await asyncio.to_thread(_link_or_copy, candidate.file_path, output_path)
+        source_id = candidate.id
+        break
+
+    if stale:
+        # The file went away with its image; drop the entry
+        async with get_session_context() as session:
+            await session.execute(EVICT_SQL, {"ids": stale})
+            await session.commit()
+        logger.info(f"Evicted {len(stale)} cache entr{'y' if len(stale) == 1 else 'ies'} with missing files.")
+
+    metrics.GENERATION_CACHE_LOOKUPS.labels(result="hit" if source_id else "miss").inc()
+    return source_id
@@ -18,6 +18,7 @@ import httpx
 import logging
 
 from app.core import config
+from app.services.job_errors import RETRYABLE_STATUS_CODES, PermanentError, RetryableError, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
@@ -89,7 +90,13 @@ class ImageEditService:
                 if response.status_code != 200:
                     error_text = response.text[:500]
                     logger.error(f"BFL API error {response.status_code}: {error_text}")
-                    raise Exception(f"BFL API error {response.status_code}: {error_text}")
+                    if response.status_code in RETRYABLE_STATUS_CODES:
+                        raise RetryableError(
+                            f"BFL API error {response.status_code}: {error_text}",
+                            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                            status_code=response.status_code
+                        )
+                    raise PermanentError(f"BFL API error {response.status_code}: {error_text}")
 
                 result = response.json()
 
@@ -107,9 +114,15 @@ class ImageEditService:
 
                 raise ValueError(f"Unexpected response format: {list(result.keys())}")
 
+        except (RetryableError, PermanentError) as e:
+            logger.error(f"Image editing failed: {str(e)}")
+            raise
+        except httpx.TransportError as e:
+            logger.error(f"Image editing failed: {str(e)}")
+            raise RetryableError(f"Failed to edit image: {str(e)}")
         except Exception as e:
             logger.error(f"Image editing failed: {str(e)}")
-            raise Exception(f"Failed to edit image: {str(e)}")
+            raise PermanentError(f"Failed to edit image: {str(e)}")
 
     async def generate_image(self, prompt: str, negative_prompt: Optional[str] = None, width: int = 1024, height: int = 1024) -> bytes:
         """
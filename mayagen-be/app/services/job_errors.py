@@ -0,0 +1,88 @@
+"""
+Job Errors - classifying generation failures as retryable or permanent.
+
+Providers raise `RetryableError` / `PermanentError` when they know which kind
+of failure they hit (e.g. an Azure 429 vs. a 400, a ComfyUI execution error).
+Anything else is classified by exception type: only known transport failures
+(network drops, timeouts, 5xx/429 HTTP responses) are worth another attempt,
+bounded by `config.RETRY["max_attempts"]`, after which the job is
+dead-lettered. Unknown errors fail the job straight away.
+"""
+
+import random
+from typing import Optional, Tuple
+
+import httpx
+import websockets
+
+from app.core import config
+
+
+class RetryableError(Exception):
+    """A transient failure. `retry_after` (seconds) is the server's hint, if it sent one."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+    @property
+    def throttled(self) -> bool:
+        return self.status_code == 429
+
+
+class NodeUnavailable(RetryableError):
+    """The ComfyUI node failed, not the job: requeue it straight away for another node."""
+
+
+class PermanentError(Exception):
+    """A failure that will not go away by trying again (invalid input, rejected prompt, ...)."""
+
+
+class JobCancelled(Exception):
+    """The job was cancelled (or its lease lost) while it was running; nothing is recorded."""
+
+
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+RETRYABLE_TYPES = (
+    ConnectionError,
+    TimeoutError,
+    httpx.TransportError,
+    websockets.exceptions.WebSocketException,
+)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header (only the delta-seconds form is supported)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def classify(error: BaseException) -> Tuple[bool, Optional[float]]:
+    """Returns (retryable, retry_after) for an exception raised while rendering a job."""
+    if isinstance(error, RetryableError):
+        return True, error.retry_after
+    if isinstance(error, PermanentError):
+        return False, None
+    if isinstance(error, httpx.HTTPStatusError):
+        retry_after = parse_retry_after(error.response.headers.get("Retry-After"))
+        return error.response.status_code in RETRYABLE_STATUS_CODES, retry_after
+    if isinstance(error, RETRYABLE_TYPES):
+        return True, None
+    return False, None
+
+
+def backoff_delay(attempts: int, retry_after: Optional[float] = None) -> float:
+    """
+    Seconds to wait before attempt `attempts + 1`: exponential with jitter,
+    capped at max_delay, and never sooner than the server asked for.
+    """
+    delay = min(config.RETRY["max_delay"], config.RETRY["base_delay"] * (2 ** max(0, attempts - 1)))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
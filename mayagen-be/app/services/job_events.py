@@ -0,0 +1,138 @@
+"""
+Job Events - Postgres LISTEN/NOTIFY wakeups for the background workers.
+
+API routes call `notify()` in the same transaction that inserts a job; Postgres
+delivers the notification on commit. Worker loops hold a `Subscription` and
+block on it instead of sleeping, so a new job is picked up within milliseconds.
+The wait always has a timeout, which doubles as the fallback poll when the
+listener connection is down.
+"""
+
+import asyncio
+import logging
+from typing import Callable, Iterable, Optional
+
+import asyncpg
+from sqlalchemy import text
+
+from app.core import config
+
+logger = logging.getLogger("job_events")
+
+# Channels
+IMAGE_QUEUED = "mayagen_image_queued"  # payload: image provider ("comfyui", "azure_foundry", ...)
+BATCH_QUEUED = "mayagen_batch_queued"  # payload: "batch" or "edit_batch"
+WORKER_CONTROL = "mayagen_worker_control"  # payload: "drain" (every worker) or "drain:<worker id or hostname>"
+JOB_CANCELLED = "mayagen_job_cancelled"  # payload: "image:<id>", "batch:<id>" or "edit_batch:<id>"
+CHANNELS = [IMAGE_QUEUED, BATCH_QUEUED, WORKER_CONTROL, JOB_CANCELLED]
+
+_subscriptions: set = set()
+# Callbacks that need the payload itself, not just a wakeup: channel -> [handler(payload)]
+_handlers: dict = {}
+
+
+class Subscription:
+    """
+    A wakeup flag for one worker loop, set whenever a matching notification arrives.
+    Unless `wakeable` is False it is also set by `wake_all()`, which is harmless for
+    loops that just re-check the queue but wrong for commands such as a drain.
+    """
+
+    def __init__(self, channel: str, payloads: Optional[Iterable[str]] = None, wakeable: bool = True):
+        self.channel = channel
+        self.payloads = set(payloads) if payloads else None
+        self.wakeable = wakeable
+        self.event = asyncio.Event()
+
+    def matches(self, channel: str, payload: str) -> bool:
+        if channel != self.channel:
+            return False
+        return self.payloads is None or payload in self.payloads
+
+    def clear(self):
+        """Call before checking the queue so notifications sent meanwhile are not lost."""
+        self.event.clear()
+
+    async def wait(self, timeout: float) -> bool:
+        """Block until notified or `timeout` seconds pass. Returns True if notified."""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def close(self):
+        _subscriptions.discard(self)
+
+
+def subscribe(channel: str, payloads: Optional[Iterable[str]] = None, wakeable: bool = True) -> Subscription:
+    subscription = Subscription(channel, payloads, wakeable)
+    _subscriptions.add(subscription)
+    return subscription
+
+
+def add_handler(channel: str, handler: Callable[[str], None]):
+    """Call `handler(payload)` on the event loop for every notification on `channel`."""
+    _handlers.setdefault(channel, []).append(handler)
+
+
+def remove_handler(channel: str, handler: Callable[[str], None]):
+    if handler in _handlers.get(channel, []):
+        _handlers[channel].remove(handler)
+
+
+async def notify(session, channel: str, payload: str = ""):
+    """Queue a notification on the session's transaction. It is sent when the session commits."""
+    await session.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": channel, "payload": payload}
+    )
+
+
+def _dispatch(connection, pid, channel, payload):
+    for subscription in list(_subscriptions):
+        if subscription.matches(channel, payload):
+            subscription.event.set()
+    for handler in list(_handlers.get(channel, [])):
+        try:
+            handler(payload)
+        except Exception as e:
+            logger.error(f"Handler for {channel} failed: {e}")
+
+
+def wake_all():
+    """Wake every worker loop, e.g. so it notices that the process is draining."""
+    for subscription in list(_subscriptions):
+        if subscription.wakeable:
+            subscription.event.set()
+
+
+def _listener_dsn() -> str:
+    # asyncpg wants a plain libpq URL, not the SQLAlchemy dialect form
+    return config.DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://")
+
+
+async def listen_forever():
+    """Keeps one LISTEN connection open per process and reconnects if it drops."""
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(_listener_dsn())
+            for channel in CHANNELS:
+                await conn.add_listener(channel, _dispatch)
+            logger.info(f"Listening for job notifications on {', '.join(CHANNELS)}.")
+
+            # Anything queued while we were disconnected has no notification; let loops re-check.
+            wake_all()
+
+            while not conn.is_closed():
+                await asyncio.sleep(config.WORKER["listener_keepalive"])
+                await conn.execute("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job notification listener error: {e}. Falling back to polling.")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
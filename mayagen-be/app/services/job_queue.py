@@ -0,0 +1,512 @@
+"""
+Job Queue - enqueueing and claiming image jobs in the database.
+
+Batch expansion writes image rows with `enqueue_images()`: chunked multi-row
+INSERTs straight from dicts, without building ORM instances.
+
+A claim reserves up to K QUEUED rows in a single UPDATE ... RETURNING round-trip
+and parks them in an in-process `ClaimBuffer` that worker slots drain one at a
+time. Rows still sitting in a buffer when the worker stops are handed back to
+the queue with `release()`; cancelled ones are dropped (`discard_buffered()`).
+
+Jobs are claimed in (priority, fair_key) order: interactive jobs (no batch)
+before batch jobs, then by fair_key. ComfyUI buffers bend that order within
+bounds to keep a node on the checkpoint it already has loaded. In "fair"
+scheduling mode, batch expansion stamps fair_key from each user's virtual
+clock (weighted fair queuing), so one user's 10k batch interleaves with
+everyone else's instead of starving them.
+
+Failed attempts that are worth retrying go back to QUEUED with a `not_before`
+backoff that the claim respects (see `job_errors`); `requeue_dead_letters()`
+gives jobs that ran out of attempts another round.
+
+Draining (`start_drain()`) stops every claim in this process: worker loops
+finish what they are running and exit, and buffers hand their unstarted jobs
+back. See `worker.serve_workers()` for the deadline.
+
+Claimed rows carry the claiming process's `WORKER_ID` and a lease expiry.
+`lease_keeper_loop()` renews the leases of every job this process holds and
+requeues jobs whose lease has run out anywhere (a crashed or partitioned
+node), so several backend nodes can share the queue and restarts never
+throw away in-flight work.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+import weakref
+from collections import deque
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, text
+
+from app.core import config
+from app.database import get_session_context
+from app.models import Image, JobStatus
+from app.services import job_events
+
+logger = logging.getLogger("job_queue")
+
+COMFY_PROVIDERS = ["comfyui"]
+AZURE_PROVIDERS = ["azure", "azure_foundry"]
+
+# Identifies this process as the owner of the jobs it claims
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Ids of every job this process holds a lease on (buffered or running)
+_held_jobs: set = set()
+
+# Monotonic claim time of each held job, for the claim-to-start metric
+_claimed_at: dict = {}
+
+# Set once this process starts draining; it never claims again afterwards
+_draining = False
+
+# Every live ClaimBuffer of this process, so cancellations can reach buffered jobs
+_claim_buffers = weakref.WeakSet()
+
+# FIFO mode: fair_key gap between consecutive jobs of a batch. Small enough that a
+# million-job batch stays within a second of its submit time, and still above the
+# float resolution of an epoch timestamp (~2.4e-7)
+FIFO_KEY_STEP = 1e-6
+
+# Timestamps are naive UTC throughout the schema (datetime.utcnow())
+DB_UTC_NOW = "timezone('utc', now())"
+
+# Scheduling class: interactive jobs (no batch) are claimed before batch jobs
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+queue_priority = Image.priority
+
+
+def providers_for(provider: str) -> List[str]:
+    """The providers that are claimed by the same worker queue as `provider`."""
+    if provider in AZURE_PROVIDERS:
+        return AZURE_PROVIDERS
+    return [provider]
+
+
+def queued_image_row(**fields) -> dict:
+    """Column values for a new QUEUED image, with the defaults the `Image` model would apply."""
+    now = datetime.utcnow()
+    row = {
+        "status": JobStatus.QUEUED,
+        "fair_key": time.time(),
+        "image_type": "TEXT_TO_IMAGE",
+        "is_edit": False,
+        "is_public": True,
+        "use_cache": True,
+        "created_at": now,
+        "updated_at": now,
+    }
+    row.update(fields)
+    row.setdefault("priority", PRIORITY_BATCH if row.get("batch_job_id") else PRIORITY_INTERACTIVE)
+    return row
+
+
+async def enqueue_images(session, rows: Iterable[dict], chunk_size: Optional[int] = None) -> int:
+    """
+    Inserts image rows in chunks of `chunk_size` using multi-row INSERTs.
+    `rows` may be a generator, so memory stays flat however large the batch is.
+    Runs in the caller's transaction; returns the number of rows written.
+    """
+    chunk_size = chunk_size or config.WORKER["insert_chunk_size"]
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        await session.execute(insert(Image.__table__), chunk)
+        inserted += len(chunk)
+    return inserted
+
+
+async def reserve_fair_keys(
+    session,
+    user_id: int,
+    count: int,
+    created_at: datetime,
+    offset: int = 0
+) -> Tuple[float, float]:
+    """
+    Reserve `count` consecutive jobs on the user's virtual clock (weighted fair queuing).
+    Each job costs 1 / queue_weight virtual seconds; the clock never lags behind real time,
+    so idle users cannot bank credit. Runs in the caller's transaction.
+    Returns (start, step): the i-th job (0-based) gets fair_key = start + (i + 1) * step.
+
+    In "fifo" mode the keys come from the batch itself: its `created_at` (naive UTC)
+    plus the job's index (`offset` is the index of the first job), so every chunk of
+    a batch sorts where the batch was submitted, however late it is expanded.
+    """
+    if config.QUEUE["scheduler"] != "fair":
+        submitted = created_at.replace(tzinfo=timezone.utc).timestamp()
+        return submitted + (offset - 1) * FIFO_KEY_STEP, FIFO_KEY_STEP
+
+    now = time.time()
+    result = await session.execute(text("""
+        UPDATE "user"
+        SET queue_vtime = GREATEST(COALESCE(queue_vtime, 0), :now) + :count / GREATEST(queue_weight, 0.01)
+        WHERE id = :user_id
+        RETURNING queue_vtime, 1.0 / GREATEST(queue_weight, 0.01) AS step;
+    """), {"user_id": user_id, "count": count, "now": now})
+    row = result.first()
+    if not row:
+        return now, 0.0
+    return row.queue_vtime - count * row.step, row.step
+
+
+def _claim_sql(providers: List[str], model_affinity: bool = False):
+    # Providers are inlined (they are code constants) so the planner can walk
+    # idx_image_queue_claim in (priority, fair_key, id) order for a single provider.
+    provider_list = ", ".join(f"'{provider}'" for provider in providers)
+    claimable = f"""
+            status = 'QUEUED'
+            AND provider IN ({provider_list})
+            AND (not_before IS NULL OR not_before <= {DB_UTC_NOW})
+    """
+    # Affinity: only jobs for :model, and never ahead of a higher scheduling class
+    affinity = f"""
+            AND model = :model
+            AND priority <= (SELECT MIN(priority) FROM image WHERE {claimable})
+    """ if model_affinity else ""
+    return text(f"""
+        UPDATE image
+        SET status = 'PROCESSING',
+            worker_id = :worker_id,
+            lease_expires_at = {DB_UTC_NOW} + make_interval(secs => :lease_seconds)
+        WHERE id IN (
+            SELECT id
+            FROM image
+            WHERE {claimable}
+            {affinity}
+            ORDER BY priority ASC, fair_key ASC, id ASC
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, model, priority, fair_key, batch_job_id, edit_batch_job_id;
+    """)
+
+
+RELEASE_SQL = text("""
+    UPDATE image
+    SET status = 'QUEUED', worker_id = NULL, lease_expires_at = NULL
+    WHERE id = ANY(:ids)
+    AND status = 'PROCESSING'
+    AND worker_id = :worker_id
+    RETURNING provider;
+""")
+
+RENEW_SQL = text(f"""
+    UPDATE image
+    SET lease_expires_at = {DB_UTC_NOW} + make_interval(secs => :lease_seconds)
+    WHERE id = ANY(:ids)
+    AND status = 'PROCESSING'
+    AND worker_id = :worker_id
+    RETURNING id;
+""")
+
+REAP_SQL = text(f"""
+    UPDATE image
+    SET status = 'QUEUED', worker_id = NULL, lease_expires_at = NULL
+    WHERE status = 'PROCESSING'
+    AND (lease_expires_at IS NULL OR lease_expires_at < {DB_UTC_NOW})
+    RETURNING id, provider;
+""")
+
+
+async def claim_jobs(providers: List[str], limit: int, model: Optional[str] = None) -> List[Tuple[int, str, Optional[int], Optional[int]]]:
+    """
+    Atomically moves up to `limit` QUEUED jobs to PROCESSING.
+    With `model`, only jobs for that model are claimed (model affinity).
+    Returns (id, model, batch_job_id, edit_batch_job_id) tuples in queue order.
+    """
+    params = {
+        "limit": limit,
+        "worker_id": WORKER_ID,
+        "lease_seconds": config.WORKER["lease_seconds"],
+    }
+    if model is not None:
+        params["model"] = model
+
+    async with get_session_context() as session:
+        result = await session.execute(_claim_sql(providers, model_affinity=model is not None), params)
+        rows = result.all()
+        await session.commit()
+
+    _held_jobs.update(row.id for row in rows)
+    claimed_at = time.monotonic()
+    _claimed_at.update((row.id, claimed_at) for row in rows)
+
+    # RETURNING does not preserve the subquery's ORDER BY
+    rows.sort(key=lambda row: (row.priority, row.fair_key, row.id))
+    return [(row.id, row.model, row.batch_job_id, row.edit_batch_job_id) for row in rows]
+
+
+async def release_jobs(job_ids: List[int]) -> int:
+    """Puts claimed-but-unstarted jobs back on the queue."""
+    if not job_ids:
+        return 0
+
+    async with get_session_context() as session:
+        result = await session.execute(RELEASE_SQL, {"ids": list(job_ids), "worker_id": WORKER_ID})
+        providers = {row.provider for row in result.all()}
+        for provider in providers:
+            await job_events.notify(session, job_events.IMAGE_QUEUED, provider)
+        await session.commit()
+
+    _held_jobs.difference_update(job_ids)
+    for job_id in job_ids:
+        _claimed_at.pop(job_id, None)
+    return len(job_ids)
+
+
+def start_drain():
+    """Stop claiming jobs in this process and wake every worker loop so it can wind down."""
+    global _draining
+    if _draining:
+        return
+    _draining = True
+    logger.info(f"Worker {WORKER_ID} draining: no new jobs will be claimed.")
+    job_events.wake_all()
+
+
+def is_draining() -> bool:
+    return _draining
+
+
+def held_jobs() -> List[int]:
+    return list(_held_jobs)
+
+
+def pop_claim_time(job_id: int) -> Optional[float]:
+    """When (time.monotonic()) this process claimed the job, if it did."""
+    return _claimed_at.pop(job_id, None)
+
+
+def job_finished(job_id: int):
+    """Stop renewing the lease of a job this process has finalized (or given up on)."""
+    _held_jobs.discard(job_id)
+    _claimed_at.pop(job_id, None)
+
+
+async def renew_leases() -> List[int]:
+    """Extends the lease of every held job. Returns ids whose lease was already lost."""
+    job_ids = list(_held_jobs)
+    if not job_ids:
+        return []
+
+    async with get_session_context() as session:
+        result = await session.execute(RENEW_SQL, {
+            "ids": job_ids,
+            "worker_id": WORKER_ID,
+            "lease_seconds": config.WORKER["lease_seconds"],
+        })
+        renewed = {row.id for row in result.all()}
+        await session.commit()
+
+    # Jobs finalized while the renew was in flight are simply gone from _held_jobs
+    lost = [job_id for job_id in job_ids if job_id not in renewed and job_id in _held_jobs]
+    for job_id in lost:
+        logger.warning(f"Lease lost for job {job_id}; it was cancelled, deleted or requeued.")
+    return lost
+
+
+async def reap_expired_leases() -> int:
+    """Requeues PROCESSING jobs whose owner stopped renewing their lease."""
+    async with get_session_context() as session:
+        result = await session.execute(REAP_SQL)
+        rows = result.all()
+        for provider in {row.provider for row in rows}:
+            await job_events.notify(session, job_events.IMAGE_QUEUED, provider)
+        await session.commit()
+
+    if rows:
+        logger.warning(f"Requeued {len(rows)} job(s) with expired leases: {[row.id for row in rows][:20]}")
+    return len(rows)
+
+
+async def lease_keeper_loop(on_lease_lost: Optional[Callable[[List[int]], None]] = None):
+    """
+    Heartbeats this process's leases and reaps expired ones from any node.
+    `on_lease_lost(ids)` is told about held jobs that are no longer ours (cancelled,
+    deleted or requeued elsewhere) so their work can be stopped.
+    """
+    logger.info(f"Lease keeper started for worker {WORKER_ID}.")
+    last_reap = 0.0
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            lost = await renew_leases()
+            if lost and on_lease_lost:
+                on_lease_lost(lost)
+            if loop.time() - last_reap >= config.WORKER["reaper_interval"]:
+                last_reap = loop.time()
+                await reap_expired_leases()
+        except Exception as e:
+            logger.error(f"Lease keeper error: {e}")
+        await asyncio.sleep(config.WORKER["heartbeat_interval"])
+
+
+DEAD_LETTER_REQUEUE_SQL = text("""
+    UPDATE image
+    SET status = 'QUEUED', attempts = 0, not_before = NULL, error_message = NULL, updated_at = :now
+    WHERE id = ANY(:ids)
+    AND status = 'DEAD_LETTER'
+    RETURNING id, provider, batch_job_id, edit_batch_job_id;
+""")
+
+
+async def requeue_dead_letters(session, image_ids: List[int]) -> List[int]:
+    """
+    Gives dead-lettered jobs a fresh set of attempts. Their batches stop counting
+    them as failed and reopen if they had already completed. Runs in the caller's
+    transaction; returns the ids that were requeued.
+    """
+    result = await session.execute(DEAD_LETTER_REQUEUE_SQL, {"ids": list(image_ids), "now": datetime.utcnow()})
+    rows = result.all()
+
+    for table, fk in (("batchjob", "batch_job_id"), ("edit_batch_job", "edit_batch_job_id")):
+        counts = {}
+        for row in rows:
+            batch_id = getattr(row, fk)
+            if batch_id:
+                counts[batch_id] = counts.get(batch_id, 0) + 1
+        for batch_id, count in counts.items():
+            await session.execute(text(f"""
+                UPDATE {table}
+                SET failed_count = GREATEST(failed_count - :count, 0),
+                    status = CASE WHEN status = 'COMPLETED' THEN 'GENERATING' ELSE status END
+                WHERE id = :batch_id;
+            """), {"batch_id": batch_id, "count": count})
+
+    for provider in {row.provider for row in rows}:
+        await job_events.notify(session, job_events.IMAGE_QUEUED, provider)
+    return [row.id for row in rows]
+
+
+class ClaimBuffer:
+    """
+    Local buffer of claimed job ids shared by the worker slots of one consumer.
+    When it runs dry, the next slot to ask refills it with a single multi-row claim.
+
+    With `model_affinity` (ComfyUI nodes), refills prefer jobs for the model the
+    node ran last, so it does not swap checkpoints between renders. Staleness is
+    bounded: after QUEUE["affinity_max_streak"] jobs or QUEUE["affinity_max_seconds"]
+    of affinity claims, the next refill takes the queue head whatever its model.
+    `on_model_swap()` is called whenever the model handed out changes.
+
+    With `accepting`, a refill whose consumer stopped accepting while the claim
+    was in flight (e.g. its node's breaker opened) hands the jobs straight back.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        providers: List[str],
+        batch_size: int,
+        model_affinity: bool = False,
+        on_model_swap: Optional[Callable[[], None]] = None,
+        accepting: Optional[Callable[[], bool]] = None
+    ):
+        self.name = name
+        self.providers = providers
+        self.batch_size = max(1, batch_size)
+        self.model_affinity = model_affinity
+        self.on_model_swap = on_model_swap
+        self.accepting = accepting
+        self.last_model = None
+        self._job_ids = deque()
+        self._lock = asyncio.Lock()
+        self._streak = 0
+        self._streak_started = 0.0
+        _claim_buffers.add(self)
+
+    async def _refill(self):
+        loop = asyncio.get_running_loop()
+        use_affinity = (
+            self.model_affinity
+            and config.QUEUE["model_affinity"]
+            and self.last_model is not None
+            and self._streak < config.QUEUE["affinity_max_streak"]
+            and (self._streak == 0 or loop.time() - self._streak_started < config.QUEUE["affinity_max_seconds"])
+        )
+        if use_affinity:
+            claimed = await claim_jobs(self.providers, self.batch_size, model=self.last_model)
+            if claimed:
+                if self._streak == 0:
+                    self._streak_started = loop.time()
+                self._streak += len(claimed)
+                self._job_ids.extend(claimed)
+                return
+
+        # Queue head: whatever model is next in line
+        self._streak = 0
+        self._job_ids.extend(await claim_jobs(self.providers, self.batch_size))
+
+    async def next_job(self) -> Optional[int]:
+        async with self._lock:
+            if _draining:
+                return None
+            if not self._job_ids:
+                await self._refill()
+                if self._job_ids and self.accepting and not self.accepting():
+                    await self._release_buffered()
+            if not self._job_ids:
+                return None
+
+            job_id, model, _, _ = self._job_ids.popleft()
+            if self.last_model is not None and model != self.last_model and self.on_model_swap:
+                self.on_model_swap()
+            self.last_model = model
+            return job_id
+
+    async def release(self):
+        """Hands every still-buffered job back to the queue, after any refill in flight."""
+        async with self._lock:
+            await self._release_buffered()
+
+    async def _release_buffered(self):
+        job_ids = [entry[0] for entry in self._job_ids]
+        self._job_ids.clear()
+        if job_ids:
+            await release_jobs(job_ids)
+            logger.info(f"{self.name}: Released {len(job_ids)} unstarted job(s) back to the queue.")
+
+    def discard(self, image_ids=(), batch_job_id: Optional[int] = None, edit_batch_job_id: Optional[int] = None) -> List[int]:
+        """
+        Drops matching unstarted jobs without releasing them: their rows were
+        cancelled or deleted, so they must not go back to the queue.
+        """
+        dropped = []
+        kept = deque()
+        for entry in self._job_ids:
+            job_id, _, entry_batch_id, entry_edit_batch_id = entry
+            if (
+                job_id in image_ids
+                or (batch_job_id is not None and entry_batch_id == batch_job_id)
+                or (edit_batch_job_id is not None and entry_edit_batch_id == edit_batch_job_id)
+            ):
+                dropped.append(job_id)
+            else:
+                kept.append(entry)
+        self._job_ids = kept
+        for job_id in dropped:
+            job_finished(job_id)
+        if dropped:
+            logger.info(f"{self.name}: Dropped {len(dropped)} cancelled job(s) from the buffer.")
+        return dropped
+
+
+def discard_buffered(image_ids=(), batch_job_id: Optional[int] = None, edit_batch_job_id: Optional[int] = None) -> int:
+    """Drops cancelled jobs from every claim buffer of this process. Returns how many."""
+    image_ids = set(image_ids)
+    return sum(
+        len(buffer.discard(image_ids, batch_job_id, edit_batch_job_id))
+        for buffer in list(_claim_buffers)
+    )
@@ -0,0 +1,114 @@
+"""
+Metrics - Prometheus instrumentation for the API and the worker tier.
+
+The API serves everything on `GET /metrics`; `python main.py worker` processes serve
+their own registry on WORKER_METRICS_PORT (+ shard index). Scrapes only read
+in-memory values: queue depth comes from `queue_depth_loop()`, which refreshes
+it from the partial queue indexes every METRICS["queue_depth_interval"] seconds,
+so a scrape never touches the image table.
+"""
+
+import asyncio
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import text
+
+from app.core import config
+from app.database import engine, get_session_context
+
+logger = logging.getLogger("metrics")
+
+# Seconds; generations take from ~1s (LCM) to minutes (large batches on a busy node)
+JOB_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+
+# --- Queue ---
+QUEUE_DEPTH = Gauge(
+    "mayagen_queue_depth", "Image jobs by provider and status (refreshed periodically)",
+    ["provider", "status"]
+)
+JOB_CLAIM_TO_START = Histogram(
+    "mayagen_job_claim_to_start_seconds", "Time a claimed job waited in a worker buffer before it started",
+    ["model"], buckets=JOB_BUCKETS
+)
+JOB_START_TO_COMPLETE = Histogram(
+    "mayagen_job_start_to_complete_seconds", "Time from job start to its outcome being recorded",
+    ["model", "status"], buckets=JOB_BUCKETS
+)
+
+# --- Providers ---
+COMFYUI_REQUEST_SECONDS = Histogram(
+    "mayagen_comfyui_request_seconds", "ComfyUI generation latency per node",
+    ["node"], buckets=JOB_BUCKETS
+)
+COMFYUI_ERRORS = Counter("mayagen_comfyui_errors_total", "Failed ComfyUI generations per node", ["node"])
+COMFYUI_MODEL_SWAPS = Counter(
+    "mayagen_comfyui_model_swaps_total", "Consecutive jobs on a node that needed a different model", ["node"]
+)
+COMFYUI_NODE_UP = Gauge("mayagen_comfyui_node_up", "1 if the node's last health probe succeeded", ["node"])
+COMFYUI_NODE_QUEUE_DEPTH = Gauge(
+    "mayagen_comfyui_node_queue_depth", "Prompts running or pending in the node's ComfyUI queue (last probe)", ["node"]
+)
+COMFYUI_NODE_BREAKER = Gauge(
+    "mayagen_comfyui_node_breaker_state", "Node circuit breaker: 0 closed, 1 half-open, 2 open", ["node"]
+)
+AZURE_REQUEST_SECONDS = Histogram(
+    "mayagen_azure_request_seconds", "Azure Foundry request latency", buckets=JOB_BUCKETS
+)
+AZURE_ERRORS = Counter("mayagen_azure_errors_total", "Failed Azure Foundry requests", ["kind"])
+
+GENERATION_CACHE_LOOKUPS = Counter(
+    "mayagen_generation_cache_lookups_total", "Generation cache lookups by result (hit/miss)", ["result"]
+)
+
+# --- Batches ---
+BATCH_EXPANSION_SECONDS = Histogram(
+    "mayagen_batch_expansion_seconds", "Time to expand one batch chunk into image jobs",
+    ["kind"], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+# --- Database pool ---
+DB_POOL_SIZE = Gauge("mayagen_db_pool_size", "Configured size of the SQLAlchemy connection pool")
+DB_POOL_CHECKED_OUT = Gauge("mayagen_db_pool_checked_out", "Connections currently checked out of the pool")
+DB_POOL_OVERFLOW = Gauge("mayagen_db_pool_overflow", "Connections open beyond the pool size")
+
+_pool = engine.sync_engine.pool
+DB_POOL_SIZE.set_function(lambda: _pool.size())
+DB_POOL_CHECKED_OUT.set_function(lambda: _pool.checkedout())
+DB_POOL_OVERFLOW.set_function(lambda: max(0, _pool.overflow()))
+
+# --- HTTP ---
+HTTP_REQUEST_SECONDS = Histogram(
+    "mayagen_http_request_duration_seconds", "API request latency per route template",
+    ["method", "route", "status"]
+)
+
+# Only the active states: each is served by a partial or status index
+QUEUE_DEPTH_SQL = text("""
+    SELECT provider, status::text AS status, COUNT(*) AS count
+    FROM image
+    WHERE status IN ('QUEUED', 'PROCESSING', 'DEAD_LETTER')
+    GROUP BY provider, status;
+""")
+
+
+async def refresh_queue_depth():
+    async with get_session_context() as session:
+        result = await session.execute(QUEUE_DEPTH_SQL)
+        rows = result.all()
+
+    # Reset so a provider whose queue drained reports 0 instead of its last value
+    QUEUE_DEPTH.clear()
+    for row in rows:
+        QUEUE_DEPTH.labels(provider=row.provider, status=row.status).set(row.count)
+
+
+async def queue_depth_loop():
+    """Keeps the queue depth gauges fresh in the background, independent of scrapes."""
+    while True:
+        try:
+            await refresh_queue_depth()
+        except Exception as e:
+            logger.error(f"Queue depth refresh failed: {e}")
+        await asyncio.sleep(config.METRICS["queue_depth_interval"])
+
@@ -5,6 +5,7 @@ Generates unique prompts by combining variations from a BatchJob configuration.
 Uses template-based generation for predictable, fast prompt creation.
 """
 
+import math
 import random
 from typing import List, Dict, Any, Optional
 
@@ -39,17 +40,26 @@ def generate_single_prompt(
     Returns:
         A formatted prompt string
     """
+    # Pick random values from each variation category
+    choices = {key: random.choice(values) for key, values in variations.items() if values}
+    return _format_prompt(target_subject, choices, template)
+
+
+def _format_prompt(
+    target_subject: str,
+    choices: Dict[str, str],
+    template: Optional[str] = None
+) -> str:
+    """Fill the template with one chosen value per variation category."""
     template = template or DEFAULT_TEMPLATE
     
     # Build replacements dict
     replacements = {"target": target_subject}
     
-    # Pick random values from each variation category
-    for key, values in variations.items():
-        if values:
-            # Remove 's' suffix for template matching (colors -> color)
-            template_key = key.rstrip('s') if key.endswith('s') else key
-            replacements[template_key] = random.choice(values)
+    for key, value in choices.items():
+        # Remove 's' suffix for template matching (colors -> color)
+        template_key = key.rstrip('s') if key.endswith('s') else key
+        replacements[template_key] = value
     
     # Fill in defaults for any missing template variables
     for key in ["color", "environment", "action", "style", "lighting", "camera"]:
@@ -115,6 +125,59 @@ def generate_prompts(
     return prompts
 
 
+def generate_prompt_range(
+    target_subject: str,
+    variations: Dict[str, List[str]],
+    template: Optional[str] = None,
+    start: int = 0,
+    count: int = 1,
+    seed: int = 0
+) -> List[str]:
+    """
+    Generate prompts `start` .. `start + count - 1` of a batch's prompt sequence.
+    
+    Each index maps to one combination of the variations through a seeded
+    permutation of all combinations. Chunks can therefore be generated at
+    different times, with nothing kept in memory between them, and no prompt
+    repeats until every unique combination has been used.
+    
+    Args:
+        target_subject: The main subject
+        variations: Dict of variation categories
+        template: Optional custom template
+        start: Index of the first prompt in the sequence
+        count: Number of prompts to generate
+        seed: Selects the permutation (use the batch id for a stable sequence)
+    
+    Returns:
+        List of prompt strings
+    """
+    # JSONB does not preserve key order, so fix one
+    keys = sorted(key for key, values in variations.items() if values)
+    total = estimate_unique_combinations(variations)
+    
+    # index -> (stride * index + offset) mod total is a bijection when gcd(stride, total) == 1
+    rng = random.Random(seed)
+    stride = 1
+    if total > 2:
+        stride = rng.randrange(1, total)
+        while math.gcd(stride, total) != 1:
+            stride = rng.randrange(1, total)
+    offset = rng.randrange(total)
+    
+    prompts = []
+    for index in range(start, start + count):
+        combination = (index * stride + offset) % total
+        choices = {}
+        for key in keys:
+            values = variations[key]
+            combination, pick = divmod(combination, len(values))
+            choices[key] = values[pick]
+        prompts.append(_format_prompt(target_subject, choices, template))
+    
+    return prompts
+
+
 def estimate_unique_combinations(variations: Dict[str, List[str]]) -> int:
     """
     Calculate the maximum number of unique prompt combinations possible.
@@ -0,0 +1,89 @@
+"""
+Rate Limiter - adaptive token bucket for calls to rate-limited cloud APIs.
+
+The bucket refills at `rate` requests per second. The rate adapts AIMD-style:
+every successful call adds `increase` to it (up to `max_rate`), and every
+throttled call (HTTP 429) multiplies it by `decrease_factor` (down to
+`min_rate`) - at most once per congestion window: a 429 for a request sent
+before the last decrease was caused by the old rate and does not lower it
+again, so a burst of concurrent 429s halves the rate once, not once per
+request. A Retry-After hint pauses the whole bucket until it has passed,
+so concurrent callers back off together instead of hammering the API.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger("rate_limiter")
+
+
+class AdaptiveRateLimiter:
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        increase: float,
+        decrease_factor: float,
+        burst: Optional[float] = None
+    ):
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._decreased_at = float("-inf")
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """Wait for a token. Callers queue up in order behind the lock."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self):
+        """Additive increase."""
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: Optional[float] = None, sent_at: Optional[float] = None):
+        """
+        Multiplicative decrease; honours the server's Retry-After for every caller.
+        `sent_at` is the time.monotonic() the throttled request went out; requests
+        sent before the last decrease do not lower the rate again.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens = min(self._tokens, 0.0)
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        if sent_at is not None and sent_at < self._decreased_at:
+            logger.debug(f"{self.name}: throttle from before the last decrease, rate kept at {self.rate:.2f} req/s")
+            return
+
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._decreased_at = now
+        logger.warning(
+            f"{self.name}: throttled, rate lowered to {self.rate:.2f} req/s"
+            + (f", paused for {retry_after:.0f}s" if retry_after else "")
+        )
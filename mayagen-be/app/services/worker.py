@@ -1,35 +1,129 @@
 import asyncio
 import os
+import signal
+import socket
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from typing import Optional
 from sqlmodel import select
-from sqlalchemy import text, func
+from sqlalchemy import text, func, update
 from app.database import get_session_context
 from app.models import Image, JobStatus, BatchJob, BatchJobStatus, EditBatchJob
 from app.core import config
-from app.services.comfy_client import ComfyUIProvider
-from app.services.prompt_generator import generate_prompts
+from app.services.comfy_nodes import ComfyNode, is_node_failure
+from app.services import atomic_files, generation_cache, job_errors, job_events, job_queue, metrics, workflow_templates
+from app.services.job_queue import ClaimBuffer
+from app.services.prompt_generator import generate_prompt_range
+from app.services.rate_limiter import AdaptiveRateLimiter
 
 # Setup Logging
 logger = logging.getLogger("worker")
 
-provider = ComfyUIProvider(config.COMFYUI["server_address"])
+# Shared by every in-flight Azure request of this process
+azure_rate_limiter = AdaptiveRateLimiter(
+    "AzureFoundry",
+    rate=config.AZURE_WORKER["initial_rate"],
+    min_rate=config.AZURE_WORKER["min_rate"],
+    max_rate=config.AZURE_WORKER["max_rate"],
+    increase=config.AZURE_WORKER["rate_increase"],
+    decrease_factor=config.AZURE_WORKER["rate_decrease_factor"]
+)
 
-async def process_job(image_id: int):
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class RunningJob:
+    """A job this process is executing right now, and the means to stop it."""
+
+    def __init__(self, job: Image, task: asyncio.Task):
+        self.job = job
+        self.task = task
+        # ComfyUI generations await this flag instead of being cancelled: the task
+        # is the worker slot's loop, which must survive to claim the next job
+        self.cancel_event = asyncio.Event()
+
+    def cancel(self):
+        if self.cancel_event.is_set():
+            return
+        self.cancel_event.set()
+        logger.info(f"Cancelling running job {self.job.id}.")
+        if self.job.provider != "comfyui":
+            # Awaiting an HTTP call or a sleep: cancelling the coroutine stops it
+            self.task.cancel()
+
+
+# image id -> RunningJob, for every job process_job is executing in this process
+_running_jobs: dict = {}
+
+
+def cancel_running_jobs(image_ids=None, batch_job_id: Optional[int] = None, edit_batch_job_id: Optional[int] = None) -> int:
+    """Stop matching jobs running in this process. Their rows are left as the canceller set them."""
+    image_ids = set(image_ids or [])
+    cancelled = 0
+    for running in list(_running_jobs.values()):
+        job = running.job
+        if (
+            job.id in image_ids
+            or (batch_job_id is not None and job.batch_job_id == batch_job_id)
+            or (edit_batch_job_id is not None and job.edit_batch_job_id == edit_batch_job_id)
+        ):
+            running.cancel()
+            cancelled += 1
+    return cancelled
+
+
+def _on_job_cancelled(payload: str):
+    """JOB_CANCELLED handler: payload is "image:<id>", "batch:<id>" or "edit_batch:<id>"."""
+    kind, _, value = payload.partition(":")
+    if not value.isdigit():
+        return
+    target = int(value)
+    if kind == "image":
+        match = {"image_ids": [target]}
+    elif kind == "batch":
+        match = {"batch_job_id": target}
+    elif kind == "edit_batch":
+        match = {"edit_batch_job_id": target}
+    else:
+        return
+    cancel_running_jobs(**match)
+    # Claimed but not started yet: never start them
+    job_queue.discard_buffered(**match)
+
+
+async def process_job(image_id: int, node: ComfyNode = None):
     """
-    Processes a single image job.
+    Processes a single image job claimed by this worker.
+    `node` is the ComfyUI node whose worker slot claimed the job.
+    No DB connection is held while the image renders.
     """
-    async with get_session_context() as session:
-        # Re-fetch image to get details
-        result = await session.execute(select(Image).where(Image.id == image_id))
-        job = result.scalars().first()
+    try:
+        async with get_session_context() as session:
+            # Re-fetch image to get details
+            result = await session.execute(select(Image).where(Image.id == image_id))
+            job = result.scalars().first()
         
         if not job:
             logger.error(f"Job {image_id} not found after locking.")
             return
+        if job.status != JobStatus.PROCESSING or job.worker_id != job_queue.WORKER_ID:
+            # Cancelled or requeued while it sat in a claim buffer
+            logger.info(f"Skipping job {job.id}: it is {job.status} and no longer held by this worker.")
+            return
 
         logger.info(f"Starting Job {job.id} | Prompt: {job.prompt[:30]}...")
+        running = RunningJob(job, asyncio.current_task())
+        _running_jobs[job.id] = running
+        claimed_at = job_queue.pop_claim_time(image_id)
+        started_at = time.monotonic()
+        if claimed_at is not None:
+            metrics.JOB_CLAIM_TO_START.labels(model=job.model).observe(started_at - claimed_at)
         
+        cache_key = None
         try:
             # 1. Prepare Paths
             safe_category = job.category
@@ -37,13 +131,13 @@ async def process_job(image_id: int):
             os.makedirs(category_dir, exist_ok=True)
             
             # Generate filename if not set (for edit jobs)
-            if not job.filename:
-                from datetime import datetime as dt
-                timestamp = dt.now().strftime("%Y%m%d_%H%M%S")
-                job.filename = f"edit_{job.id}_{timestamp}.png"
+            filename = job.filename
+            if not filename:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                filename = f"edit_{job.id}_{timestamp}.png"
             
             # Construct full absolute path
-            full_output_path = os.path.join(category_dir, job.filename)
+            full_output_path = os.path.join(category_dir, filename)
             
             # 2. Check Provider / Job Type
             if job.is_edit and job.provider in ["azure", "azure_foundry"]:
@@ -58,128 +152,307 @@ async def process_job(image_id: int):
                     logger.error(f"Input image not found at: {input_path}")
                     raise FileNotFoundError(f"Input image not found at: {input_path}")
 
-                with open(input_path, "rb") as f:
-                    input_image_bytes = f.read()
+                # File I/O off the event loop: many Azure jobs run concurrently
+                input_image_bytes = await asyncio.to_thread(_read_file, input_path)
                 
-                # Call Azure Foundry API
-                output_bytes = await image_edit_service.edit_image(
-                    image_bytes=input_image_bytes,
-                    prompt=job.edit_prompt or job.prompt,
-                    negative_prompt=job.negative_prompt,
-                    width=job.width,
-                    height=job.height
-                )
+                # Call Azure Foundry API, paced by the shared adaptive limiter.
+                # A 429 is the limiter's problem, not the job's: wait out the
+                # limiter's pause and try again before giving the job back
+                throttle_retries = config.AZURE_WORKER["throttle_retries"]
+                for throttled_count in range(throttle_retries + 1):
+                    await azure_rate_limiter.acquire()
+                    request_started = time.monotonic()
+                    try:
+                        output_bytes = await image_edit_service.edit_image(
+                            image_bytes=input_image_bytes,
+                            prompt=job.edit_prompt or job.prompt,
+                            negative_prompt=job.negative_prompt,
+                            width=job.width,
+                            height=job.height
+                        )
+                        break
+                    except job_errors.RetryableError as e:
+                        if e.throttled:
+                            azure_rate_limiter.on_throttle(e.retry_after, sent_at=request_started)
+                        metrics.AZURE_ERRORS.labels(kind="throttled" if e.throttled else "retryable").inc()
+                        if not e.throttled or throttled_count == throttle_retries:
+                            raise
+                        logger.info(f"Job {job.id} throttled; retrying ({throttled_count + 1}/{throttle_retries}).")
+                    except Exception:
+                        metrics.AZURE_ERRORS.labels(kind="permanent").inc()
+                        raise
+                azure_rate_limiter.on_success()
+                metrics.AZURE_REQUEST_SECONDS.observe(time.monotonic() - request_started)
                 
-                # Save output image
-                with open(full_output_path, "wb") as f:
-                    f.write(output_bytes)
+                # Save output image (temp file + fsync + rename: never half-written)
+                await asyncio.to_thread(atomic_files.write_bytes, full_output_path, output_bytes)
                 
                 logger.info(f"Azure Foundry edit completed for job {job.id}")
             
             elif job.provider == "comfyui":
+                if node is None:
+                    raise RuntimeError("No ComfyUI node assigned to this job")
+                provider = node.provider
                 workflow_path = config.WORKFLOWS.get(job.model, config.WORKFLOWS["sd15"])
-                
-                # EXECUTE GENERATION
-                # We pass the full path so ComfyClient saves it in the right folder
-                await asyncio.to_thread(
-                    provider.generate, 
-                    job.prompt, 
-                    full_output_path, 
-                    job.width, 
-                    job.height, 
-                    workflow_path
+                workflow = provider.build_workflow(
+                    job.prompt, job.width, job.height, workflow_path, negative_prompt=job.negative_prompt
                 )
+
+                # Identical render already on disk? Reuse it instead of generating again.
+                cached_from = None
+                if job.use_cache and config.GENERATION_CACHE["enabled"]:
+                    cache_key = generation_cache.cache_key(workflow, job.model)
+                    cached_from = await generation_cache.fetch(cache_key, full_output_path)
+
+                if cached_from:
+                    logger.info(f"Job {job.id}: cache hit, reused the render of image {cached_from}")
+                else:
+                    # EXECUTE GENERATION
+                    # We pass the full path so ComfyClient saves it in the right folder
+                    render_started = time.monotonic()
+
+                    def on_render_start():
+                        # Render time only: a pipelined prompt first waits behind the one ahead of it
+                        nonlocal render_started
+                        render_started = time.monotonic()
+
+                    try:
+                        await provider.generate(
+                            job.prompt,
+                            full_output_path,
+                            job.width,
+                            job.height,
+                            workflow_path,
+                            workflow=workflow,
+                            cancel_event=running.cancel_event,
+                            on_execution_start=on_render_start
+                        )
+                    except job_errors.JobCancelled:
+                        raise
+                    except Exception as e:
+                        metrics.COMFYUI_ERRORS.labels(node=provider.server_address).inc()
+                        if is_node_failure(e):
+                            # The node broke, not the job: another node should pick it up
+                            node.breaker.record_failure()
+                            raise job_errors.NodeUnavailable(f"ComfyUI node {provider.server_address} failed: {e}") from e
+                        raise
+                    node.breaker.record_success()
+                    metrics.COMFYUI_REQUEST_SECONDS.labels(node=provider.server_address).observe(
+                        time.monotonic() - render_started
+                    )
                 
             else:
                 # Mock
                 await asyncio.sleep(2)
                 logger.info("Mock generation complete")
 
-            # 3. Update Success
-            job.status = JobStatus.COMPLETED
-            job.file_path = full_output_path # Save the absolute path
-            job.updated_at = datetime.utcnow()
-            session.add(job)
-            await session.commit()
+        except job_errors.JobCancelled as e:
+            # The row was cancelled, deleted or requeued elsewhere; nothing to record
+            logger.info(f"Job {job.id} stopped: {e}")
+            return
+        except Exception as e:
+            await fail_job(job, e)
+            metrics.JOB_START_TO_COMPLETE.labels(model=job.model, status="FAILED").observe(time.monotonic() - started_at)
+            return
+
+        # 3. Update Success
+        if await finalize_job(job, JobStatus.COMPLETED, filename=filename, file_path=full_output_path, cache_key=cache_key):
             logger.info(f"Job {job.id} COMPLETED.")
-            
-            # 4. Update batch job progress if applicable
-            if job.batch_job_id:
-                await update_batch_progress(job.batch_job_id, success=True)
-            elif job.edit_batch_job_id:
-                await update_edit_batch_progress(job.edit_batch_job_id, success=True)
+            metrics.JOB_START_TO_COMPLETE.labels(model=job.model, status="COMPLETED").observe(time.monotonic() - started_at)
+    finally:
+        _running_jobs.pop(image_id, None)
+        job_queue.job_finished(image_id)
 
-        except Exception as e:
-            logger.error(f"Job {job.id} FAILED: {e}")
-            job.status = JobStatus.FAILED
-            job.error_message = str(e)
-            session.add(job)
-            await session.commit()
-            
-            # Update batch job progress
-            if job.batch_job_id:
-                await update_batch_progress(job.batch_job_id, success=False)
-            elif job.edit_batch_job_id:
-                await update_edit_batch_progress(job.edit_batch_job_id, success=False)
 
+async def fail_job(job: Image, error: Exception) -> bool:
+    """
+    Record a failed attempt. Retryable errors put the job back on the queue
+    behind an exponential backoff until it has used up max_attempts, then it is
+    dead-lettered; permanent errors fail it straight away. A job whose ComfyUI
+    node failed is requeued without a backoff, so a healthy node picks it up.
+    A job that is still throttled after its in-process retries is requeued
+    without using up an attempt.
+    """
+    retryable, retry_after = job_errors.classify(error)
+    attempts = (job.attempts or 0) + 1
+
+    if isinstance(error, job_errors.RetryableError) and error.throttled:
+        delay = job_errors.backoff_delay(1, retry_after)
+        logger.warning(f"Job {job.id} still throttled: {error}. Requeued, retrying in {delay:.0f}s.")
+        return await finalize_job(
+            job, JobStatus.QUEUED,
+            error_message=str(error),
+            not_before=datetime.utcnow() + timedelta(seconds=delay)
+        )
+
+    if isinstance(error, job_errors.NodeUnavailable) and attempts < config.RETRY["max_attempts"]:
+        logger.warning(f"Job {job.id}: {error}. Requeued for another node.")
+        return await finalize_job(job, JobStatus.QUEUED, attempts=attempts, error_message=str(error), not_before=None)
 
-async def update_batch_progress(batch_id: int, success: bool):
-    """Update batch job progress by counting actual images."""
+    if retryable and attempts < config.RETRY["max_attempts"]:
+        delay = job_errors.backoff_delay(attempts, retry_after)
+        logger.warning(f"Job {job.id} attempt {attempts} failed: {error}. Retrying in {delay:.0f}s.")
+        return await finalize_job(
+            job, JobStatus.QUEUED,
+            attempts=attempts,
+            error_message=str(error),
+            not_before=datetime.utcnow() + timedelta(seconds=delay)
+        )
+
+    if retryable:
+        logger.error(f"Job {job.id} DEAD_LETTER after {attempts} attempts: {error}")
+        return await finalize_job(job, JobStatus.DEAD_LETTER, attempts=attempts, error_message=str(error))
+
+    logger.error(f"Job {job.id} FAILED: {error}")
+    return await finalize_job(job, JobStatus.FAILED, attempts=attempts, error_message=str(error))
+
+
+async def finalize_job(job: Image, status: JobStatus, **values) -> bool:
+    """
+    Record a job's outcome if this worker still holds its lease, and count it
+    against its batch in the same transaction. Returns False if the lease was
+    lost (the reaper requeued the job), in which case nothing is written.
+    A QUEUED status is a retry: the job is handed back and not counted yet.
+    """
     async with get_session_context() as session:
-        result = await session.execute(select(BatchJob).where(BatchJob.id == batch_id))
-        batch = result.scalars().first()
-        
-        if batch:
-            # Count completed and failed images
-            # This is idempotent and handles retries correctly
-            completed_count = await session.execute(
-                select(func.count()).where(Image.batch_job_id == batch_id, Image.status == JobStatus.COMPLETED)
+        result = await session.execute(
+            update(Image)
+            .where(
+                Image.id == job.id,
+                Image.status == JobStatus.PROCESSING,
+                Image.worker_id == job_queue.WORKER_ID
             )
-            failed_count = await session.execute(
-                select(func.count()).where(Image.batch_job_id == batch_id, Image.status == JobStatus.FAILED)
+            .values(
+                status=status,
+                worker_id=None,
+                lease_expires_at=None,
+                updated_at=datetime.utcnow(),
+                **values
             )
-            
-            batch.generated_count = completed_count.scalar_one()
-            batch.failed_count = failed_count.scalar_one()
-            
-            # Check if batch is complete
-            total_processed = batch.generated_count + batch.failed_count
-            if total_processed >= batch.total_images:
-                batch.status = BatchJobStatus.COMPLETED
-                logger.info(f"Batch {batch.id} COMPLETED: {batch.generated_count} success, {batch.failed_count} failed")
-            
-            batch.updated_at = datetime.utcnow()
-            session.add(batch)
-            await session.commit()
+            .returning(Image.id)
+            .execution_options(synchronize_session=False)
+        )
+        if result.first() is None:
+            await session.rollback()
+            logger.warning(f"Job {job.id}: lease lost before it finished; result discarded.")
+            return False
+
+        # Update batch job progress if applicable
+        success = status == JobStatus.COMPLETED
+        if status == JobStatus.QUEUED:
+            pass
+        elif job.batch_job_id:
+            await update_batch_progress(session, job.batch_job_id, success=success)
+        elif job.edit_batch_job_id:
+            await update_edit_batch_progress(session, job.edit_batch_job_id, success=success)
 
+        await session.commit()
+        return True
+
+
+# Progress is tracked with O(1) counter increments; the status flips to COMPLETED
+# in the same statement once every image is accounted for.
+BATCH_PROGRESS_SQL = text("""
+    UPDATE batchjob
+    SET generated_count = generated_count + :succeeded,
+        failed_count = failed_count + :failed,
+        status = CASE
+            WHEN status = 'GENERATING'
+                AND generated_count + :succeeded + failed_count + :failed >= total_images
+            THEN 'COMPLETED'
+            ELSE status
+        END,
+        updated_at = :now
+    WHERE id = :batch_id
+    RETURNING status, generated_count, failed_count;
+""")
+
+EDIT_BATCH_PROGRESS_SQL = text("""
+    UPDATE edit_batch_job
+    SET generated_count = generated_count + :succeeded,
+        failed_count = failed_count + :failed,
+        status = CASE
+            WHEN status = 'GENERATING'
+                AND generated_count + :succeeded + failed_count + :failed >= total_variations
+            THEN 'COMPLETED'
+            ELSE status
+        END,
+        updated_at = :now
+    WHERE id = :batch_id
+    RETURNING status, generated_count, failed_count;
+""")
+
+
+async def _increment_progress(session, statement, batch_id: int, success: bool):
+    result = await session.execute(statement, {
+        "batch_id": batch_id,
+        "succeeded": 1 if success else 0,
+        "failed": 0 if success else 1,
+        "now": datetime.utcnow(),
+    })
+    return result.first()
+
+
+async def update_batch_progress(session, batch_id: int, success: bool):
+    """Count one finished image against its batch. Runs in the caller's transaction."""
+    row = await _increment_progress(session, BATCH_PROGRESS_SQL, batch_id, success)
+    if row and row.status == BatchJobStatus.COMPLETED.name:
+        logger.info(f"Batch {batch_id} COMPLETED: {row.generated_count} success, {row.failed_count} failed")
+
+
+async def update_edit_batch_progress(session, edit_batch_id: int, success: bool):
+    """Count one finished edit variation against its edit batch. Runs in the caller's transaction."""
+    row = await _increment_progress(session, EDIT_BATCH_PROGRESS_SQL, edit_batch_id, success)
+    if row and row.status == BatchJobStatus.COMPLETED.name:
+        logger.info(f"Edit Batch {edit_batch_id} COMPLETED: {row.generated_count} success, {row.failed_count} failed")
+
+
+async def reconcile_batch_progress(batch_id: Optional[int] = None, edit_batch_id: Optional[int] = None):
+    """
+    Offline recount of batch counters from the actual image rows.
+    Idempotent: repairs drift from manual requeues or crashes between a render and its commit.
+    With no ids, every batch and edit batch is recounted.
+    """
+    targets = [
+        ("batchjob", "batch_job_id", "total_images", batch_id),
+        ("edit_batch_job", "edit_batch_job_id", "total_variations", edit_batch_id),
+    ]
+    only_one = batch_id is not None or edit_batch_id is not None
+    reconciled = {}
 
-async def update_edit_batch_progress(edit_batch_id: int, success: bool):
-    """Update edit batch job progress by counting actual images."""
     async with get_session_context() as session:
-        result = await session.execute(select(EditBatchJob).where(EditBatchJob.id == edit_batch_id))
-        batch = result.scalars().first()
-        
-        if batch:
-            # Count completed and failed images
-            completed_count = await session.execute(
-                select(func.count()).where(Image.edit_batch_job_id == edit_batch_id, Image.status == JobStatus.COMPLETED)
-            )
-            failed_count = await session.execute(
-                select(func.count()).where(Image.edit_batch_job_id == edit_batch_id, Image.status == JobStatus.FAILED)
-            )
-            
-            batch.generated_count = completed_count.scalar_one()
-            batch.failed_count = failed_count.scalar_one()
-            
-            # Check if batch is complete
-            total_processed = batch.generated_count + batch.failed_count
-            if total_processed >= batch.total_variations:
-                batch.status = BatchJobStatus.COMPLETED
-                logger.info(f"Edit Batch {batch.id} COMPLETED: {batch.generated_count} success, {batch.failed_count} failed")
-            
-            batch.updated_at = datetime.utcnow()
-            session.add(batch)
-            await session.commit()
+        for table, fk, total_column, target_id in targets:
+            if only_one and target_id is None:
+                continue
+
+            statement = text(f"""
+                UPDATE {table} b
+                SET generated_count = (SELECT COUNT(*) FROM image WHERE {fk} = b.id AND status = 'COMPLETED'),
+                    failed_count = (SELECT COUNT(*) FROM image WHERE {fk} = b.id AND status IN ('FAILED', 'DEAD_LETTER')),
+                    updated_at = :now
+                {"WHERE b.id = :target_id" if target_id is not None else ""}
+                RETURNING b.id;
+            """)
+            params = {"now": datetime.utcnow()}
+            if target_id is not None:
+                params["target_id"] = target_id
+            result = await session.execute(statement, params)
+            reconciled[table] = len(result.all())
+
+            # Same completion rule as the incremental path
+            completion = text(f"""
+                UPDATE {table}
+                SET status = 'COMPLETED'
+                WHERE status = 'GENERATING'
+                AND generated_count + failed_count >= {total_column}
+                {"AND id = :target_id" if target_id is not None else ""}
+            """)
+            await session.execute(completion, {"target_id": target_id} if target_id is not None else {})
+
+        await session.commit()
+
+    logger.info(f"Reconciled batch progress: {reconciled}")
+    return reconciled
 
 
 async def process_edit_batch_jobs():
@@ -193,6 +466,7 @@ async def process_edit_batch_jobs():
             .where(EditBatchJob.status == BatchJobStatus.QUEUED)
             .order_by(EditBatchJob.created_at.asc())
             .limit(1)
+            .with_for_update(skip_locked=True)
         )
         batch = result.scalars().first()
         
@@ -202,10 +476,10 @@ async def process_edit_batch_jobs():
         logger.info(f"Processing Edit Batch Job {batch.id}: {batch.name} ({batch.total_variations} variations)")
         
         try:
-            # Mark as generating
+            # Mark as generating; committed together with the image rows so a crash
+            # never leaves a GENERATING edit batch without its jobs
             batch.status = BatchJobStatus.GENERATING
             session.add(batch)
-            await session.commit()
             
             # Get original image details
             img_result = await session.execute(select(Image).where(Image.id == batch.original_image_id))
@@ -215,12 +489,12 @@ async def process_edit_batch_jobs():
                 raise Exception("Original image not found")
 
             # Create Image records for each edit prompt
-            for i, prompt in enumerate(batch.edit_prompts):
-                # Ensure we don't exceed total variations if prompts list is shorter/longer
-                if i >= batch.total_variations:
-                    break
-                    
-                image = Image(
+            # (never more than total_variations, even if the prompts list is longer)
+            input_image_path = os.path.join(original_image.category, original_image.filename)
+            edit_prompts = batch.edit_prompts[:batch.total_variations]
+            start_key, step = await job_queue.reserve_fair_keys(session, batch.user_id, len(edit_prompts), batch.created_at)
+            rows = (
+                job_queue.queued_image_row(
                     prompt=prompt, # Using the edit prompt
                     edit_prompt=prompt,
                     filename=None, # Will be generated in process_job
@@ -231,20 +505,24 @@ async def process_edit_batch_jobs():
                     height=batch.height,
                     user_id=batch.user_id,
                     edit_batch_job_id=batch.id,
-                    status=JobStatus.QUEUED,
                     is_public=batch.is_public,
                     is_edit=True,
-                    input_image_url=batch.original_image_url,
-                    input_image_path=os.path.join(original_image.category, original_image.filename)
+                    input_image_path=input_image_path,
+                    fair_key=start_key + (i + 1) * step
                 )
-                session.add(image)
+                for i, prompt in enumerate(edit_prompts)
+            )
+            with metrics.BATCH_EXPANSION_SECONDS.labels(kind="edit_batch").time():
+                created = await job_queue.enqueue_images(session, rows)
             
+            await job_events.notify(session, job_events.IMAGE_QUEUED, batch.provider)
             await session.commit()
-            logger.info(f"Created {len(batch.edit_prompts)} image edit jobs for batch {batch.id}")
+            logger.info(f"Created {created} image edit jobs for batch {batch.id}")
             return True
             
         except Exception as e:
             logger.error(f"Edit Batch Job {batch.id} FAILED: {e}")
+            await session.rollback()
             batch.status = BatchJobStatus.FAILED
             batch.error_message = str(e)
             session.add(batch)
@@ -252,9 +530,62 @@ async def process_edit_batch_jobs():
             return False
 
 
+async def expand_batch_chunk(session, batch: BatchJob) -> int:
+    """
+    Materialize the next chunk of a batch's prompts as QUEUED Image rows and
+    advance its expansion cursor. Runs in the caller's transaction.
+    """
+    start = batch.expanded_count
+    count = min(config.BATCH_EXPANSION["chunk_size"], batch.total_images - start)
+    if count <= 0:
+        return 0
+    expansion_started = time.monotonic()
+
+    # Prompts come from a deterministic sequence, so any chunk can be rebuilt from the cursor alone
+    prompts = generate_prompt_range(
+        target_subject=batch.target_subject,
+        variations=batch.variations,
+        template=batch.base_prompt_template,
+        start=start,
+        count=count,
+        seed=batch.id
+    )
+
+    # Position the chunk on the owner's fair-share clock
+    start_key, step = await job_queue.reserve_fair_keys(
+        session, batch.user_id, len(prompts), batch.created_at, offset=start
+    )
+
+    rows = (
+        job_queue.queued_image_row(
+            prompt=prompt,
+            filename=f"{batch.category.replace('/', '_')}_{batch.id}_{i+1:04d}.png",
+            category=batch.category,
+            model=batch.model,
+            provider=batch.provider,
+            width=batch.width,
+            height=batch.height,
+            user_id=batch.user_id,
+            batch_job_id=batch.id,
+            is_public=batch.is_public,
+            use_cache=batch.use_cache,
+            fair_key=start_key + (i - start + 1) * step
+        )
+        for i, prompt in enumerate(prompts, start=start)
+    )
+    created = await job_queue.enqueue_images(session, rows)
+
+    batch.expanded_count = start + created
+    batch.updated_at = datetime.utcnow()
+    session.add(batch)
+    await job_events.notify(session, job_events.IMAGE_QUEUED, batch.provider)
+    metrics.BATCH_EXPANSION_SECONDS.labels(kind="batch").observe(time.monotonic() - expansion_started)
+    return created
+
+
 async def process_batch_jobs():
     """
-    Poll for QUEUED batch jobs, generate prompts, and create Image records.
+    Poll for QUEUED batch jobs, mark them GENERATING and create their first chunk of Image records.
     """
     async with get_session_context() as session:
         # Find next QUEUED batch job
@@ -263,6 +594,7 @@ async def process_batch_jobs():
             .where(BatchJob.status == BatchJobStatus.QUEUED)
             .order_by(BatchJob.created_at.asc())
             .limit(1)
+            .with_for_update(skip_locked=True)
         )
         batch = result.scalars().first()
         
@@ -272,45 +604,16 @@ async def process_batch_jobs():
         logger.info(f"Processing Batch Job {batch.id}: {batch.name} ({batch.total_images} images)")
         
         try:
-            # Mark as generating
+            # Mark as generating; committed together with the first chunk
             batch.status = BatchJobStatus.GENERATING
-            session.add(batch)
-            await session.commit()
-            
-            # Generate prompts
-            prompts = generate_prompts(
-                target_subject=batch.target_subject,
-                total_images=batch.total_images,
-                variations=batch.variations,
-                template=batch.base_prompt_template,
-                unique=True
-            )
-            
-            # Create Image records for each prompt
-            for i, prompt in enumerate(prompts):
-                filename = f"{batch.category.replace('/', '_')}_{batch.id}_{i+1:04d}.png"
-                
-                image = Image(
-                    prompt=prompt,
-                    filename=filename,
-                    category=batch.category,
-                    model=batch.model,
-                    provider=batch.provider,
-                    width=batch.width,
-                    height=batch.height,
-                    user_id=batch.user_id,
-                    batch_job_id=batch.id,
-                    status=JobStatus.QUEUED,
-                    is_public=batch.is_public
-                )
-                session.add(image)
-            
+            created = await expand_batch_chunk(session, batch)
             await session.commit()
-            logger.info(f"Created {len(prompts)} image jobs for batch {batch.id}")
+            logger.info(f"Created {created}/{batch.total_images} image jobs for batch {batch.id}")
             return True
             
         except Exception as e:
             logger.error(f"Batch Job {batch.id} FAILED: {e}")
+            await session.rollback()
             batch.status = BatchJobStatus.FAILED
             batch.error_message = str(e)
             session.add(batch)
@@ -318,155 +621,284 @@ async def process_batch_jobs():
             return False
 
 
+async def top_up_batch_jobs():
+    """
+    Expand the next chunk of a GENERATING batch whose QUEUED backlog has drained
+    below the low watermark. Returns True if a chunk was created.
+    """
+    async with get_session_context() as session:
+        backlog = (
+            select(func.count())
+            .where(Image.batch_job_id == BatchJob.id, Image.status == JobStatus.QUEUED)
+            .scalar_subquery()
+        )
+        result = await session.execute(
+            select(BatchJob)
+            .where(BatchJob.status == BatchJobStatus.GENERATING)
+            .where(BatchJob.expanded_count < BatchJob.total_images)
+            .where(backlog < config.BATCH_EXPANSION["low_watermark"])
+            .order_by(BatchJob.updated_at.asc())
+            .limit(1)
+            .with_for_update(of=BatchJob, skip_locked=True)
+        )
+        batch = result.scalars().first()
+
+        if not batch:
+            return False
+
+        created = await expand_batch_chunk(session, batch)
+        await session.commit()
+        logger.info(f"Expanded batch {batch.id}: {batch.expanded_count}/{batch.total_images} image jobs created (+{created})")
+        return created > 0
+
 
 async def batch_manager_loop():
-    """Loop for expanding Batch Jobs into Image Jobs."""
+    """Loop for expanding Batch Jobs into Image Jobs, chunk by chunk."""
     logger.info("Batch Manager started.")
-    while True:
+    wakeup = job_events.subscribe(job_events.BATCH_QUEUED)
+    while not job_queue.is_draining():
         try:
+            wakeup.clear()
             has_batch = await process_batch_jobs()
             has_edit_batch = await process_edit_batch_jobs()
+            has_chunk = await top_up_batch_jobs()
             
-            if not has_batch and not has_edit_batch:
-                await asyncio.sleep(2) # Sleep if no jobs found
+            if not has_batch and not has_edit_batch and not has_chunk:
+                await wakeup.wait(config.WORKER["poll_interval"]) # Block until a batch is queued
         except Exception as e:
             logger.error(f"Batch Manager Error: {e}")
             await asyncio.sleep(5)
+    wakeup.close()
+    logger.info("Batch Manager stopped (draining).")
 
 
-async def comfy_worker_loop():
-    """Loop for processing local ComfyUI generation jobs."""
-    logger.info("ComfyUI Worker started.")
-    while True:
+async def comfy_worker_loop(node: ComfyNode, slot: int = 0):
+    """
+    Loop for processing local ComfyUI generation jobs on one slot of a node.
+    All slots of a node share its provider: one HTTP session and one websocket.
+    The slot only claims while the node is accepting (breaker closed, spare capacity).
+    """
+    worker_name = f"ComfyWorker[{node.server_address}#{slot}]"
+    wakeup = job_events.subscribe(job_events.IMAGE_QUEUED, job_queue.COMFY_PROVIDERS)
+    logger.info(f"{worker_name} started.")
+    while not job_queue.is_draining():
         try:
-            async with get_session_context() as session:
-                # Pop next ComfyUI job
-                statement = text("""
-                    UPDATE image
-                    SET status = 'PROCESSING'
-                    WHERE id = (
-                        SELECT id
-                        FROM image
-                        WHERE status = 'QUEUED' 
-                        AND provider = 'comfyui'
-                        ORDER BY 
-                            CASE WHEN batch_job_id IS NULL THEN 0 ELSE 1 END ASC,
-                            created_at ASC
-                        LIMIT 1
-                        FOR UPDATE SKIP LOCKED
-                    )
-                    RETURNING id;
-                """)
-                
-                result = await session.execute(statement)
-                row = result.first()
-                
-                if row:
-                    job_id = row[0]
-                    await session.commit()
-                    
-                    logger.info(f"ComfyWorker: Picked up Job {job_id}...")
-                    try:
-                        await process_job(job_id)
-                        logger.info(f"ComfyWorker: Finished Job {job_id}.")
-                    except Exception as e:
-                        logger.error(f"ComfyWorker: Error on Job {job_id}: {e}")
-                else:
-                    await session.commit()
-                    await asyncio.sleep(1) # No jobs
+            if not node.accepting():
+                # Down, or busy with other clients' work: leave the queue to the other nodes
+                await asyncio.sleep(config.COMFYUI_HEALTH["probe_interval"])
+                continue
+
+            wakeup.clear()
+            job_id = await node.buffer.next_job()
+
+            if job_id:
+                logger.info(f"{worker_name}: Picked up Job {job_id}...")
+                node.in_flight += 1
+                try:
+                    await process_job(job_id, node)
+                    logger.info(f"{worker_name}: Finished Job {job_id}.")
+                except Exception as e:
+                    logger.error(f"{worker_name}: Error on Job {job_id}: {e}")
+                finally:
+                    node.in_flight -= 1
+            else:
+                await wakeup.wait(config.WORKER["poll_interval"]) # No jobs
                     
         except Exception as e:
-            logger.error(f"ComfyWorker Critical Error: {e}")
+            logger.error(f"{worker_name} Critical Error: {e}")
             await asyncio.sleep(5)
+    wakeup.close()
+    logger.info(f"{worker_name} stopped (draining).")
 
 
-async def azure_worker_loop():
-    """Loop for processing cloud Azure Foundry editing jobs."""
-    logger.info("Azure Worker started.")
-    while True:
-        try:
-            async with get_session_context() as session:
-                # Pop next Azure job
-                statement = text("""
-                    UPDATE image
-                    SET status = 'PROCESSING'
-                    WHERE id = (
-                        SELECT id
-                        FROM image
-                        WHERE status = 'QUEUED' 
-                        AND provider IN ('azure', 'azure_foundry')
-                        ORDER BY created_at ASC
-                        LIMIT 1
-                        FOR UPDATE SKIP LOCKED
-                    )
-                    RETURNING id;
-                """)
-                
-                result = await session.execute(statement)
-                row = result.first()
-                
-                if row:
-                    job_id = row[0]
-                    await session.commit()
-                    
-                    logger.info(f"AzureWorker: Picked up Job {job_id}...")
-                    try:
-                        await process_job(job_id)
-                        logger.info(f"AzureWorker: Finished Job {job_id}.")
-                    except Exception as e:
-                        logger.error(f"AzureWorker: Error on Job {job_id}: {e}")
-                else:
-                    await session.commit()
-                    await asyncio.sleep(1) # No jobs
+async def comfy_worker_pool(nodes: Optional[list] = None):
+    """
+    Runs the configured number of concurrent worker slots for every ComfyUI node,
+    plus a health probe per node (see comfy_nodes).
+    On top of them, `pipeline_depth` slots per node keep prompts queued ahead inside
+    ComfyUI: while one slot downloads and finalizes its result, the next prompt is
+    already waiting on the server and the GPU moves straight on to it.
+    """
+    nodes = [ComfyNode(node) for node in (config.COMFYUI_NODES if nodes is None else nodes)]
+    loops = []
+    for node in nodes:
+        loops.extend(comfy_worker_loop(node, slot) for slot in range(node.capacity))
+    slot_count = len(loops)
+    # Probes run until the slots stop; they are not part of the drain
+    probes = [asyncio.create_task(node.probe_loop()) for node in nodes]
+
+    logger.info(f"ComfyUI worker pool: {slot_count} slots across {len(nodes)} node(s).")
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        for probe in probes:
+            probe.cancel()
+        for node in nodes:
+            await node.buffer.release()
+            await node.provider.aclose()
 
+
+async def azure_worker_pool():
+    """
+    Runs Azure Foundry jobs concurrently: up to AZURE_WORKER["concurrency"] requests
+    in flight, each paced by the shared adaptive rate limiter.
+    """
+    concurrency = config.AZURE_WORKER["concurrency"]
+    buffer = ClaimBuffer("AzureBuffer", job_queue.AZURE_PROVIDERS, config.WORKER["claim_batch_size"] or concurrency)
+    wakeup = job_events.subscribe(job_events.IMAGE_QUEUED, job_queue.AZURE_PROVIDERS)
+    slots = asyncio.Semaphore(concurrency)
+    in_flight = set()
+
+    async def run(job_id: int):
+        try:
+            await process_job(job_id)
+            logger.info(f"AzureWorker: Finished Job {job_id}.")
         except Exception as e:
-            logger.error(f"AzureWorker Critical Error: {e}")
-            await asyncio.sleep(5)
+            logger.error(f"AzureWorker: Error on Job {job_id}: {e}")
+        finally:
+            slots.release()
 
+    logger.info(f"Azure worker pool started ({concurrency} concurrent requests).")
+    try:
+        while not job_queue.is_draining():
+            # Only claim a job once there is a free slot to run it
+            await slots.acquire()
+            try:
+                wakeup.clear()
+                job_id = await buffer.next_job()
+            except Exception as e:
+                slots.release()
+                logger.error(f"AzureWorker Critical Error: {e}")
+                await asyncio.sleep(5)
+                continue
 
-async def start_all_workers():
-    """Starts all background worker loops concurrently."""
-    logger.info("Initializing background workers...")
-    await asyncio.gather(
-        batch_manager_loop(),
-        comfy_worker_loop(),
-        azure_worker_loop()
-    )
+            if not job_id:
+                slots.release()
+                await wakeup.wait(config.WORKER["poll_interval"]) # No jobs
+                continue
 
+            logger.info(f"AzureWorker: Picked up Job {job_id}...")
+            task = asyncio.create_task(run(job_id))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
 
-async def reset_stuck_jobs():
+        # Draining: let in-flight requests finish (the drain deadline cancels them otherwise)
+        await buffer.release()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        logger.info("Azure worker pool stopped (draining).")
+    finally:
+        wakeup.close()
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        await buffer.release()
+
+
+async def run_workers(roles: Optional[list] = None, shard_index: int = 0, shard_count: int = 1):
     """
-    Resets jobs stuck in PROCESSING or GENERATING state on startup.
+    Runs the worker loops for `roles` in this process, plus the notification
+    listener and lease keeper every consumer needs. When several processes run
+    the comfy role, shard `shard_index` of `shard_count` takes every
+    shard_count-th ComfyUI node, so each node's slots are driven by one process.
     """
-    async with get_session_context() as session:
-        # 1. Reset stuck Images
-        statement = text("""
-            UPDATE image
-            SET status = 'QUEUED'
-            WHERE status = 'PROCESSING'
-        """)
-        result = await session.execute(statement)
-        if result.rowcount > 0:
-            logger.warning(f"Reset {result.rowcount} stuck PROCESSING images to QUEUED.")
-            
-        # 2. Reset stuck Batch Jobs to FAILED
-        statement_batch = text("""
-            UPDATE batchjob
-            SET status = 'FAILED', error_message = 'Server restarted during initialization'
-            WHERE status = 'GENERATING'
-        """)
-        result_batch = await session.execute(statement_batch)
-        if result_batch.rowcount > 0:
-             logger.warning(f"Marked {result_batch.rowcount} stuck GENERATING batches as FAILED.")
-             
-        # 3. Reset stuck Edit Batch Jobs to FAILED
-        statement_edit_batch = text("""
-            UPDATE edit_batch_job
-            SET status = 'FAILED', error_message = 'Server restarted during initialization'
-            WHERE status = 'GENERATING'
-        """)
-        result_edit_batch = await session.execute(statement_edit_batch)
-        if result_edit_batch.rowcount > 0:
-             logger.warning(f"Marked {result_edit_batch.rowcount} stuck GENERATING edit batches as FAILED.")
-             
-        await session.commit()
+    roles = roles or config.WORKER_ROLES
+    unknown = set(roles) - set(config.WORKER_ROLES)
+    if unknown:
+        raise ValueError(f"Unknown worker role(s): {', '.join(sorted(unknown))}")
+    if "comfy" in roles:
+        # Compile up front so a broken workflow shows in the startup log, not just on its jobs
+        workflow_templates.load_all()
+
+    logger.info(f"Initializing background workers: {', '.join(roles)} (shard {shard_index + 1}/{shard_count})")
+    # Cancellations reach running jobs by notification, or at the latest by the next lease renewal
+    job_events.add_handler(job_events.JOB_CANCELLED, _on_job_cancelled)
+    loops = [
+        job_events.listen_forever(),
+        job_queue.lease_keeper_loop(on_lease_lost=lambda job_ids: cancel_running_jobs(image_ids=job_ids)),
+    ]
+    if "batch-manager" in roles:
+        loops.append(batch_manager_loop())
+    if "comfy" in roles:
+        nodes = config.COMFYUI_NODES[shard_index::shard_count]
+        if nodes:
+            loops.append(comfy_worker_pool(nodes))
+        else:
+            logger.warning(f"No ComfyUI nodes left for shard {shard_index + 1}/{shard_count}; comfy role idle.")
+    if "azure" in roles:
+        loops.append(azure_worker_pool())
+
+    await asyncio.gather(*loops)
+
+
+async def drain_workers(workers_task: asyncio.Task, timeout: Optional[float] = None):
+    """
+    Graceful stop: no new claims, unstarted buffered jobs go straight back to the
+    queue, and in-flight jobs get `timeout` seconds to finish. Whatever is still
+    running after that is cancelled and handed back to the queue immediately,
+    rather than waiting for its lease to expire.
+    """
+    timeout = config.WORKER["drain_timeout"] if timeout is None else timeout
+    job_queue.start_drain()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while job_queue.held_jobs() and loop.time() < deadline and not workers_task.done():
+        await asyncio.sleep(0.5)
+
+    leftover = job_queue.held_jobs()
+    if leftover:
+        logger.warning(f"Drain deadline reached with {len(leftover)} job(s) in flight; handing them back.")
+        # Stop the renders too, so the GPU is free for whoever picks them up
+        cancel_running_jobs(image_ids=leftover)
+
+    workers_task.cancel()
+    await asyncio.gather(workers_task, return_exceptions=True)
+
+    if leftover:
+        await job_queue.release_jobs(leftover)
+    logger.info(f"Worker {job_queue.WORKER_ID} drained.")
+
+
+async def serve_workers(
+    roles: Optional[list] = None,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    handle_signals: bool = False
+):
+    """
+    Runs the worker loops until a drain is requested (SIGTERM/SIGINT when
+    `handle_signals`, an admin drain notification, or `job_queue.start_drain()`),
+    then drains them within WORKER["drain_timeout"].
+    """
+    workers_task = asyncio.create_task(run_workers(roles, shard_index, shard_count))
+    control = job_events.subscribe(job_events.WORKER_CONTROL, [
+        "drain",
+        f"drain:{job_queue.WORKER_ID}",
+        f"drain:{socket.gethostname()}",
+    ], wakeable=False)
+
+    if handle_signals:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, job_queue.start_drain)
+
+    try:
+        while not job_queue.is_draining() and not workers_task.done():
+            if await control.wait(1.0):
+                logger.info("Drain requested by an admin.")
+                job_queue.start_drain()
+    finally:
+        control.close()
+        # Cancelled from outside (e.g. the API shutting down): still drain
+        await asyncio.shield(drain_workers(workers_task))
+
+    # The drain cancels the loops; anything else means they crashed
+    if not workers_task.cancelled() and workers_task.exception() is not None:
+        error = workers_task.exception()
+        logger.error(f"Worker loops crashed: {error!r}", exc_info=error)
+        raise error
+
+
+async def start_all_workers():
+    """Starts all background worker loops concurrently."""
+    await serve_workers(config.WORKER_ROLES)
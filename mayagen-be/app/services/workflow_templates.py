@@ -0,0 +1,202 @@
+"""
+Workflow Templates - ComfyUI workflows parsed once and compiled into injection plans.
+
+Every workflow in `config.WORKFLOWS` is loaded and validated when the ComfyUI
+workers start (`load_all()`); a broken one is logged and only fails its jobs. Compiling a workflow walks its graph from the
+sampler to find which node input receives each per-job value (prompt, negative
+prompt, width, height, seed, steps, batch size), so nothing depends on
+hardcoded node ids.
+
+`instantiate()` copies only the nodes it patches and shares the rest with the
+template, so the result must be treated as read-only. A template whose file
+changes on disk is recompiled on its next use; if the new version does not
+compile, the previous one stays in service.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from app.core import config
+
+logger = logging.getLogger("workflow_templates")
+
+# Field -> (node id, input name)
+InjectionPlan = Dict[str, Tuple[str, str]]
+
+REQUIRED_FIELDS = ("prompt", "width", "height")
+
+SAMPLER_TYPES = ("KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced")
+
+SAVE_IMAGE_TYPE = "SaveImage"
+# Ships with ComfyUI as custom_nodes/websocket_image_save.py
+WEBSOCKET_SAVE_TYPE = "SaveImageWebsocket"
+
+
+class WorkflowTemplate:
+    def __init__(self, path: Path, mtime: float, workflow: dict, plan: InjectionPlan):
+        self.path = path
+        self.mtime = mtime
+        self.workflow = workflow
+        self.plan = plan
+
+    def instantiate(self, **values) -> dict:
+        """The workflow with `values` injected. Values that are None keep the template's default."""
+        workflow = dict(self.workflow)
+        patched = {}
+        for field, value in values.items():
+            if value is None or field not in self.plan:
+                continue
+            node_id, input_name = self.plan[field]
+            if node_id not in patched:
+                node = dict(workflow[node_id])
+                node["inputs"] = dict(node["inputs"])
+                workflow[node_id] = patched[node_id] = node
+            patched[node_id]["inputs"][input_name] = value
+        return workflow
+
+
+def _linked_node(workflow: dict, node: dict, input_name: str) -> Optional[str]:
+    link = node.get("inputs", {}).get(input_name)
+    # Links are [source node id, output index]
+    if isinstance(link, list) and link and str(link[0]) in workflow:
+        return str(link[0])
+    return None
+
+
+def _text_input(workflow: dict, node_id: Optional[str]) -> Optional[Tuple[str, str]]:
+    """
+    Follow conditioning links back from `node_id` to the text encoder feeding it.
+    Pass-through nodes (FluxGuidance, ConditioningSetArea, ...) are walked through
+    via their `conditioning` input.
+    """
+    seen = set()
+    while node_id is not None and node_id not in seen:
+        seen.add(node_id)
+        inputs = workflow[node_id].get("inputs", {})
+        if isinstance(inputs.get("text"), str):
+            return node_id, "text"
+        node_id = _linked_node(workflow, workflow[node_id], "conditioning")
+    return None
+
+
+def compile_plan(workflow: dict, name: str = "workflow") -> InjectionPlan:
+    """
+    Find the node input for every injectable field by walking back from the sampler.
+    Raises ValueError if a required field is missing or two fields share an input.
+    """
+    plan: InjectionPlan = {}
+
+    sampler_id = next(
+        (node_id for node_id, node in workflow.items() if node.get("class_type") in SAMPLER_TYPES),
+        None
+    )
+    if sampler_id is None:
+        raise ValueError(f"{name}: no sampler node ({', '.join(SAMPLER_TYPES)})")
+
+    sampler = workflow[sampler_id]
+    inputs = sampler.get("inputs", {})
+    for field, candidates in (("seed", ("seed", "noise_seed")), ("steps", ("steps",))):
+        input_name = next((c for c in candidates if isinstance(inputs.get(c), (int, float))), None)
+        if input_name:
+            plan[field] = (sampler_id, input_name)
+
+    for field, input_name in (("prompt", "positive"), ("negative_prompt", "negative")):
+        target = _text_input(workflow, _linked_node(workflow, sampler, input_name))
+        if target:
+            plan[field] = target
+
+    latent_id = _linked_node(workflow, sampler, "latent_image")
+    if latent_id is not None:
+        latent_inputs = workflow[latent_id].get("inputs", {})
+        for field in ("width", "height", "batch_size"):
+            if isinstance(latent_inputs.get(field), int):
+                plan[field] = (latent_id, field)
+
+    missing = [field for field in REQUIRED_FIELDS if field not in plan]
+    if missing:
+        raise ValueError(f"{name}: cannot find where to inject {', '.join(missing)}")
+
+    targets = {}
+    for field, target in plan.items():
+        if target in targets:
+            raise ValueError(f"{name}: {field} and {targets[target]} both resolve to node {target[0]} input {target[1]}")
+        targets[target] = field
+    return plan
+
+
+def _compile_file(path: Path) -> WorkflowTemplate:
+    mtime = os.stat(path).st_mtime
+    with open(path, "r", encoding="utf-8") as f:
+        workflow = json.load(f)
+    plan = compile_plan(workflow, path.name)
+    return WorkflowTemplate(path, mtime, workflow, plan)
+
+
+_templates: Dict[Path, WorkflowTemplate] = {}
+
+
+def get(path: Path) -> WorkflowTemplate:
+    """The compiled template for `path`, recompiled if the file changed since it was loaded."""
+    path = Path(path)
+    template = _templates.get(path)
+    if template is not None:
+        try:
+            if os.stat(path).st_mtime == template.mtime:
+                return template
+        except OSError:
+            return template # File gone: keep serving what we have
+
+    try:
+        _templates[path] = _compile_file(path)
+    except (OSError, ValueError) as e:
+        if template is None:
+            raise
+        logger.error(f"Reloading {path.name} failed, keeping the previous version: {e}")
+        template.mtime = os.stat(path).st_mtime if path.exists() else template.mtime
+        return template
+
+    if template is not None:
+        logger.info(f"Reloaded workflow {path.name}")
+    return _templates[path]
+
+
+def instantiate(path: Path, **values) -> dict:
+    return get(path).instantiate(**values)
+
+
+def with_websocket_output(workflow: dict) -> Tuple[dict, set]:
+    """
+    Swap every SaveImage node for SaveImageWebsocket, which pushes the PNG to the
+    client over the websocket instead of writing it on the server.
+    Returns the patched workflow and the ids of the swapped nodes.
+    """
+    patched = dict(workflow)
+    output_nodes = set()
+    for node_id, node in workflow.items():
+        if node.get("class_type") == SAVE_IMAGE_TYPE:
+            patched[node_id] = {"class_type": WEBSOCKET_SAVE_TYPE, "inputs": {"images": node["inputs"]["images"]}}
+            output_nodes.add(node_id)
+    if not output_nodes:
+        raise ValueError(f"Workflow has no {SAVE_IMAGE_TYPE} node to deliver over the websocket")
+    return patched, output_nodes
+
+
+def load_all() -> list:
+    """
+    Load and validate every workflow in config.WORKFLOWS up front.
+    Broken or missing ones are logged and skipped: only jobs that use them fail
+    (when `get()` raises for them). Returns the names that loaded.
+    """
+    loaded = []
+    for name, path in config.WORKFLOWS.items():
+        try:
+            template = get(path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Workflow {name} ({path}) is unusable; its jobs will fail: {e}")
+            continue
+        logger.info(f"Workflow {name}: {path.name} (injects {', '.join(sorted(template.plan))})")
+        loaded.append(name)
+    return loaded
@@ -0,0 +1,14 @@
+-- Migration: Incremental batch expansion
+-- Date: 2026-10-17
+
+-- Cursor into the batch's prompt sequence: rows [0, expanded_count) already exist in image
+ALTER TABLE batchjob ADD COLUMN IF NOT EXISTS expanded_count INTEGER NOT NULL DEFAULT 0;
+
+-- Batches created before this migration were expanded in one go
+UPDATE batchjob SET expanded_count = total_images WHERE status <> 'QUEUED';
+
+-- Per-batch lookups (progress, listing) and the queued-backlog check that drives expansion
+CREATE INDEX IF NOT EXISTS idx_image_batch_job_id ON image(batch_job_id);
+CREATE INDEX IF NOT EXISTS idx_image_batch_job_id_queued ON image(batch_job_id) WHERE status = 'QUEUED';
+
+COMMENT ON COLUMN batchjob.expanded_count IS 'Number of prompts already materialized as image rows';
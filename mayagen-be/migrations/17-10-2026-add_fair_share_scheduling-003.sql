@@ -0,0 +1,22 @@
+-- Migration: Per-user fair-share scheduling
+-- Date: 2026-10-17
+
+-- Scheduling key for the claim query (virtual time in epoch seconds).
+-- A constant default is a catalog-only change: no table rewrite, no long lock.
+-- Finished rows keep 0, which the scheduler never reads (should one be retried,
+-- 0 puts it first in line, as the oldest job it is).
+ALTER TABLE image ADD COLUMN IF NOT EXISTS fair_key DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+-- Only live jobs need their real enqueue time: a small set, not the whole table
+UPDATE image SET fair_key = EXTRACT(EPOCH FROM created_at) WHERE status IN ('QUEUED', 'PROCESSING') AND fair_key = 0;
+
+-- New rows default to their enqueue time (FIFO)
+ALTER TABLE image ALTER COLUMN fair_key SET DEFAULT EXTRACT(EPOCH FROM timezone('utc', now()));
+
+-- Per-user share of the queue and virtual clock used to stamp fair_key
+ALTER TABLE "user" ADD COLUMN IF NOT EXISTS queue_weight DOUBLE PRECISION NOT NULL DEFAULT 1.0;
+ALTER TABLE "user" ADD COLUMN IF NOT EXISTS queue_vtime DOUBLE PRECISION NULL;
+
+COMMENT ON COLUMN image.fair_key IS 'Claim order within a priority class: enqueue time (FIFO) or weighted fair-queuing virtual time';
+COMMENT ON COLUMN "user".queue_weight IS 'Relative fair-share weight of the user in the image queue';
+COMMENT ON COLUMN "user".queue_vtime IS 'Virtual time of the last job reserved for the user';
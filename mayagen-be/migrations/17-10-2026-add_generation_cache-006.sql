@@ -0,0 +1,13 @@
+-- Migration: Content-addressed generation cache
+-- Date: 2026-10-17
+
+-- SHA-256 of the final ComfyUI workflow + model, set on completed ComfyUI renders
+ALTER TABLE image ADD COLUMN IF NOT EXISTS cache_key VARCHAR;
+ALTER TABLE image ADD COLUMN IF NOT EXISTS use_cache BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE batchjob ADD COLUMN IF NOT EXISTS use_cache BOOLEAN NOT NULL DEFAULT TRUE;
+
+-- Lookups only ever want a completed render with a key
+CREATE INDEX IF NOT EXISTS idx_image_cache_key ON image(cache_key) WHERE cache_key IS NOT NULL AND status = 'COMPLETED';
+
+COMMENT ON COLUMN image.cache_key IS 'Generation cache key: identical renders reuse this image''s file';
+COMMENT ON COLUMN image.use_cache IS 'False forces a fresh render even when a cached one exists';
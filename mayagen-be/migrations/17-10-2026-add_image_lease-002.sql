@@ -0,0 +1,11 @@
+-- Migration: Lease-based job ownership
+-- Date: 2026-10-17
+
+ALTER TABLE image ADD COLUMN IF NOT EXISTS worker_id VARCHAR;
+ALTER TABLE image ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP NULL;
+
+-- The reaper scans only PROCESSING rows for expired leases
+CREATE INDEX IF NOT EXISTS idx_image_processing_lease ON image(lease_expires_at) WHERE status = 'PROCESSING';
+
+COMMENT ON COLUMN image.worker_id IS 'Worker process holding the job while PROCESSING';
+COMMENT ON COLUMN image.lease_expires_at IS 'UTC time after which the reaper requeues the job unless the worker renews it';
@@ -0,0 +1,11 @@
+-- Migration: Automatic retries with backoff and a dead-letter state
+-- Date: 2026-10-17
+
+-- Retryable failures that exhaust their attempts end up here instead of FAILED
+ALTER TYPE jobstatus ADD VALUE IF NOT EXISTS 'DEAD_LETTER';
+
+ALTER TABLE image ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE image ADD COLUMN IF NOT EXISTS not_before TIMESTAMP WITHOUT TIME ZONE;
+
+COMMENT ON COLUMN image.attempts IS 'Failed generation attempts so far';
+COMMENT ON COLUMN image.not_before IS 'Retry backoff: the job is not claimed before this time (UTC)';
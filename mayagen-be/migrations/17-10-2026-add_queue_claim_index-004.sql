@@ -0,0 +1,13 @@
+-- Migration: Scheduling class for the queue claim and queue-position queries
+-- Date: 2026-10-17
+
+-- Scheduling class: 0 = interactive, 1 = batch. An ordinary column set by the
+-- insert paths (job_queue.queued_image_row): a constant default is a catalog-only
+-- change, where a generated column would rewrite the whole table under an
+-- ACCESS EXCLUSIVE lock.
+ALTER TABLE image ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0;
+
+-- Completed rows are never scheduled again, so only the rest are backfilled
+UPDATE image SET priority = 1 WHERE batch_job_id IS NOT NULL AND status <> 'COMPLETED' AND priority = 0;
+
+COMMENT ON COLUMN image.priority IS 'Scheduling class: 0 for interactive jobs, 1 for batch jobs';
@@ -0,0 +1,9 @@
+-- no-transaction
+-- Migration: Partial index for the queue claim and queue-position queries
+-- Date: 2026-10-17
+
+-- Only QUEUED rows, in scheduler order. Completed rows never enter the index,
+-- so claim and position latency depend on the queue length, not the table size.
+-- Built CONCURRENTLY so inserts and claims keep running while it builds. If the
+-- build fails it leaves an INVALID index behind: DROP INDEX CONCURRENTLY it, then rerun.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_image_queue_claim ON image(provider, priority, fair_key, id) WHERE status = 'QUEUED';
@@ -0,0 +1,286 @@
+"""
+Mock ComfyUI: a fake ComfyUI server for load testing the generation pipeline without a GPU.
+
+Implements the parts of the ComfyUI API the workers use: POST /prompt, the /ws
+progress websocket (execution_start, executing, progress, execution_error,
+execution_interrupted, execution_success), GET /history/{id}, GET /view,
+GET/POST /queue and POST /interrupt. Prompts run one at a time per "GPU"
+(--gpus), taking --latency ± --jitter seconds. Outputs are noise PNGs at the
+workflow's EmptyLatentImage size (or --image-size). SaveImageWebsocket nodes
+get their PNG pushed over the websocket, as with COMFYUI_WS_IMAGES=true.
+
+Usage:
+    uv run python mock_comfyui.py --port 8188 --latency 1.5
+    uv run python mock_comfyui.py --port 8189 --latency 0.2 --jitter 0 --failure-rate 0.05 --http-error-rate 0.01
+
+Then point the workers at it, e.g.:
+    COMFYUI_NODES=127.0.0.1:8188=1,127.0.0.1:8189=1 uv run python main.py worker --roles comfy,batch-manager
+"""
+
+import argparse
+import asyncio
+import random
+import struct
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response
+
+# Finished prompts kept for /history and /view
+HISTORY_LIMIT = 10000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake ComfyUI server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--gpus", type=int, default=1, help="Prompts executed in parallel (real ComfyUI: 1)")
+    parser.add_argument("--latency", type=float, default=2.0, help="Mean render time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Render time varies by up to ± this many seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of prompts that end in execution_error")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="Share of /prompt calls answered with HTTP 500")
+    parser.add_argument("--image-size", default=None, help="Output WIDTHxHEIGHT (default: the workflow's latent size)")
+    return parser.parse_args()
+
+
+def noise_png(width: int, height: int) -> bytes:
+    """An RGB PNG of random pixels: the size of a real render, no image library needed."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    row_bytes = width * 3
+    noise = random.randbytes(row_bytes * height)
+    # Filter byte 0 (none) in front of every row
+    raw = b"".join(b"\x00" + noise[y * row_bytes:(y + 1) * row_bytes] for y in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _node_order(node_id: str):
+    return (0, int(node_id)) if node_id.isdigit() else (1, node_id)
+
+
+class MockComfy:
+    def __init__(self, args):
+        self.args = args
+        self.image_size = tuple(int(v) for v in args.image_size.lower().split("x")) if args.image_size else None
+        self.number = 0
+        self.pending: "OrderedDict[str, dict]" = OrderedDict()
+        self.running: "dict[str, dict]" = {}
+        self.history: "OrderedDict[str, dict]" = OrderedDict()
+        self.images: "dict[str, bytes]" = {}       # filename -> PNG
+        self._pngs: "dict[tuple, bytes]" = {}      # (width, height) -> PNG, reused across prompts
+        self.clients: "dict[str, set]" = {}        # client_id -> websockets
+        self.work = asyncio.Queue()
+
+    # --- Websocket ---
+
+    async def send(self, client_id: Optional[str], message=None, binary: bytes = None):
+        for ws in list(self.clients.get(client_id, ())):
+            try:
+                if binary is not None:
+                    await ws.send_bytes(binary)
+                else:
+                    await ws.send_json(message)
+            except Exception:
+                self.clients.get(client_id, set()).discard(ws)
+
+    def queue_status(self) -> dict:
+        return {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": len(self.pending) + len(self.running)}}}}
+
+    # --- Queue ---
+
+    def submit(self, workflow: dict, client_id: Optional[str]) -> dict:
+        self.number += 1
+        prompt_id = str(uuid.uuid4())
+        self.pending[prompt_id] = {
+            "number": self.number,
+            "prompt_id": prompt_id,
+            "workflow": workflow,
+            "client_id": client_id,
+            "interrupted": False,
+        }
+        self.work.put_nowait(prompt_id)
+        return {"prompt_id": prompt_id, "number": self.number, "node_errors": {}}
+
+    def queue_entry(self, entry: dict) -> list:
+        return [entry["number"], entry["prompt_id"], entry["workflow"], {"client_id": entry["client_id"]}, []]
+
+    def png_for(self, workflow: dict) -> bytes:
+        size = self.image_size
+        if size is None:
+            latent = next((n for n in workflow.values() if n.get("class_type") == "EmptyLatentImage"), None)
+            inputs = latent["inputs"] if latent else {}
+            size = (int(inputs.get("width", 512)), int(inputs.get("height", 512)))
+        if size not in self._pngs:
+            self._pngs[size] = noise_png(*size)
+        return self._pngs[size]
+
+    def record(self, prompt_id: str, outputs: dict, status: str, messages: list):
+        self.history[prompt_id] = {
+            "outputs": outputs,
+            "status": {"status_str": status, "completed": status == "success", "messages": messages},
+        }
+        while len(self.history) > HISTORY_LIMIT:
+            old_id, old = self.history.popitem(last=False)
+            for node_output in old["outputs"].values():
+                for image in node_output.get("images", []):
+                    self.images.pop(image["filename"], None)
+
+    async def executor(self):
+        while True:
+            prompt_id = await self.work.get()
+            entry = self.pending.pop(prompt_id, None)
+            if entry is None:
+                continue # Deleted from the queue before it ran
+            self.running[prompt_id] = entry
+            try:
+                await self.execute(entry)
+            finally:
+                self.running.pop(prompt_id, None)
+                await self.send(entry["client_id"], self.queue_status())
+
+    async def execute(self, entry: dict):
+        prompt_id, client_id, workflow = entry["prompt_id"], entry["client_id"], entry["workflow"]
+        started = time.time()
+        await self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id, "timestamp": int(started * 1000)}})
+
+        render_time = max(0.0, self.args.latency + random.uniform(-self.args.jitter, self.args.jitter))
+        fails = random.random() < self.args.failure_rate
+        outputs = {}
+
+        for node_id in sorted(workflow, key=_node_order):
+            node = workflow[node_id]
+            class_type = node.get("class_type", "")
+            await self.send(client_id, {"type": "executing", "data": {"node": node_id, "display_node": node_id, "prompt_id": prompt_id}})
+
+            if class_type.startswith("KSampler") or class_type.startswith("SamplerCustom"):
+                steps = max(1, min(50, int(node.get("inputs", {}).get("steps", 10))))
+                for step in range(1, steps + 1):
+                    await asyncio.sleep(render_time / steps)
+                    if entry["interrupted"]:
+                        await self.send(client_id, {"type": "execution_interrupted", "data": {"prompt_id": prompt_id, "node_id": node_id}})
+                        self.record(prompt_id, {}, "error", [["execution_interrupted", {"prompt_id": prompt_id}]])
+                        return
+                    await self.send(client_id, {"type": "progress", "data": {"value": step, "max": steps, "prompt_id": prompt_id, "node": node_id}})
+                if fails:
+                    error = {
+                        "prompt_id": prompt_id,
+                        "node_id": node_id,
+                        "node_type": class_type,
+                        "exception_type": "RuntimeError",
+                        "exception_message": "Injected failure (mock ComfyUI)",
+                    }
+                    await self.send(client_id, {"type": "execution_error", "data": error})
+                    self.record(prompt_id, {}, "error", [["execution_error", error]])
+                    return
+
+            elif class_type == "SaveImage":
+                filename = f"{node.get('inputs', {}).get('filename_prefix', 'ComfyUI')}_{prompt_id[:8]}_{node_id}.png"
+                self.images[filename] = self.png_for(workflow)
+                outputs[node_id] = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+                await self.send(client_id, {"type": "executed", "data": {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id}})
+
+            elif class_type == "SaveImageWebsocket":
+                # Event 1 (preview image), format 2 (PNG), then the bytes
+                await self.send(client_id, binary=struct.pack(">II", 1, 2) + self.png_for(workflow))
+
+        await self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+        await self.send(client_id, {"type": "execution_success", "data": {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}})
+        self.record(prompt_id, outputs, "success", [])
+
+
+def create_app(args) -> FastAPI:
+    app = FastAPI(title="Mock ComfyUI")
+    comfy = MockComfy(args)
+
+    @app.on_event("startup")
+    async def on_startup():
+        app.state.executors = [asyncio.create_task(comfy.executor()) for _ in range(max(1, args.gpus))]
+
+    @app.post("/prompt")
+    async def post_prompt(request: Request):
+        if random.random() < args.http_error_rate:
+            return JSONResponse({"error": "Injected HTTP error (mock ComfyUI)"}, status_code=500)
+        body = await request.json()
+        workflow = body.get("prompt")
+        if not isinstance(workflow, dict) or not workflow or not all(
+            isinstance(node, dict) and "class_type" in node for node in workflow.values()
+        ):
+            return JSONResponse({"error": {"type": "invalid_prompt", "message": "Invalid prompt"}, "node_errors": {}}, status_code=400)
+        result = comfy.submit(workflow, body.get("client_id"))
+        await comfy.send(body.get("client_id"), comfy.queue_status())
+        return result
+
+    @app.get("/history/{prompt_id}")
+    async def get_history(prompt_id: str):
+        return {prompt_id: comfy.history[prompt_id]} if prompt_id in comfy.history else {}
+
+    @app.get("/view")
+    async def view(filename: str, subfolder: str = "", type: str = "output"):
+        image = comfy.images.get(filename)
+        if image is None:
+            return Response(status_code=404)
+        return Response(content=image, media_type="image/png")
+
+    @app.get("/queue")
+    async def get_queue():
+        return {
+            "queue_running": [comfy.queue_entry(entry) for entry in comfy.running.values()],
+            "queue_pending": [comfy.queue_entry(entry) for entry in comfy.pending.values()],
+        }
+
+    @app.post("/queue")
+    async def post_queue(request: Request):
+        body = await request.json()
+        if body.get("clear"):
+            comfy.pending.clear()
+        for prompt_id in body.get("delete", []):
+            comfy.pending.pop(prompt_id, None)
+        return Response(status_code=200)
+
+    @app.post("/interrupt")
+    async def interrupt(request: Request):
+        body = await request.json() if await request.body() else {}
+        prompt_id = body.get("prompt_id")
+        for running_id, entry in comfy.running.items():
+            if prompt_id is None or prompt_id == running_id:
+                entry["interrupted"] = True
+        return Response(status_code=200)
+
+    @app.websocket("/ws")
+    async def ws(websocket: WebSocket, clientId: Optional[str] = None):
+        client_id = clientId or uuid.uuid4().hex
+        await websocket.accept()
+        comfy.clients.setdefault(client_id, set()).add(websocket)
+        status = comfy.queue_status()
+        status["data"]["sid"] = client_id
+        await websocket.send_json(status)
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            comfy.clients.get(client_id, set()).discard(websocket)
+
+    return app
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(
+        f"[Mock ComfyUI] http://{args.host}:{args.port} | {args.gpus} GPU(s), "
+        f"{args.latency}s ± {args.jitter}s per prompt, failure rate {args.failure_rate}, "
+        f"HTTP error rate {args.http_error_rate}"
+    )
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
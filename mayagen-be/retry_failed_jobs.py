@@ -5,6 +5,7 @@ from sqlmodel import select
 from app.database import init_db, get_session
 from app.models import Image, EditBatchJob, JobStatus, BatchJobStatus
 from app.core import config
+from app.services.worker import reconcile_batch_progress
 
 async def fix_and_retry():
     print(f"Checking for failed jobs...")
@@ -56,5 +57,8 @@ async def fix_and_retry():
         await session.commit()
         print(f"Successfully reset {len(batches)} batches and {count} images to QUEUED.")
 
+    # Counters are incremental now; recount so requeued images are not double counted
+    await reconcile_batch_progress()
+
 if __name__ == "__main__":
     asyncio.run(fix_and_retry())
@@ -11,6 +11,38 @@ MIGRATION_DIR = "migrations"
 # Example: 06-02-2026-add_is_public-001.sql
 FILENAME_PATTERN = re.compile(r"^(\d{2})-(\d{2})-(\d{4})-(.+)-(\d+)\.sql$")
 
+# A migration whose first line is this marker runs on its own, outside any
+# transaction (e.g. CREATE INDEX CONCURRENTLY, which Postgres refuses inside one).
+# Migrations before and after it are applied in separate transactions.
+NO_TRANSACTION_MARKER = "-- no-transaction"
+
+def split_statements(sql_content):
+    # Basic semicolon splitting (naive but works for simple migrations):
+    # never put a semicolon inside a comment or a string literal
+    return [s.strip() for s in sql_content.split(';') if s.strip()]
+
+def runs_outside_transaction(sql_content):
+    return sql_content.lstrip().startswith(NO_TRANSACTION_MARKER)
+
+async def apply_migration(conn, migration):
+    print(f"Applying {migration['filename']}...")
+    try:
+        # Execute SQL statements one by one
+        for stmt in split_statements(migration["sql"]):
+            # print(f"Executing: {stmt[:50]}...")
+            await conn.execute(text(stmt))
+        
+        # Record migration
+        await conn.execute(
+            text("INSERT INTO schema_migrations (filename) VALUES (:filename)"),
+            {"filename": migration["filename"]}
+        )
+        print(f"✅ Applied {migration['filename']}")
+        
+    except Exception as e:
+        print(f"❌ Failed to apply {migration['filename']}: {e}")
+        raise e # Stop on error
+
 async def run_migrations():
     if not os.path.exists(MIGRATION_DIR):
         print(f"Directory {MIGRATION_DIR} not found.")
@@ -29,55 +61,46 @@ async def run_migrations():
         result = await conn.execute(text("SELECT filename FROM schema_migrations"))
         applied_files = {row[0] for row in result.all()}
         
-        # 3. List and sort migration files
-        files = []
-        for f in os.listdir(MIGRATION_DIR):
-            match = FILENAME_PATTERN.match(f)
-            if match:
-                day, month, year, name, seq = match.groups()
-                # Create a sort key: (date object, sequence int)
-                dt = datetime(int(year), int(month), int(day))
-                files.append({
-                    "filename": f,
-                    "date": dt,
-                    "seq": int(seq),
-                    "path": os.path.join(MIGRATION_DIR, f)
-                })
-        
-        # Sort by Date then Sequence
-        files.sort(key=lambda x: (x["date"], x["seq"]))
-        
-        # 4. Apply new migrations
-        for migration in files:
-            if migration["filename"] not in applied_files:
-                print(f"Applying {migration['filename']}...")
-                try:
-                    with open(migration["path"], "r") as sql_file:
-                        sql_content = sql_file.read()
-                        
-                    # Execute SQL statements one by one
-                    # Basic semicolon splitting (naive but works for simple migrations)
-                    statements = [s.strip() for s in sql_content.split(';') if s.strip()]
-                    
-                    for stmt in statements:
-                        # print(f"Executing: {stmt[:50]}...")
-                        await conn.execute(text(stmt))
-                    
-                    # Record migration
-                    await conn.execute(
-                        text("INSERT INTO schema_migrations (filename) VALUES (:filename)"),
-                        {"filename": migration["filename"]}
-                    )
-                    print(f"✅ Applied {migration['filename']}")
-                    
-                except Exception as e:
-                    print(f"❌ Failed to apply {migration['filename']}: {e}")
-                    raise e # Stop on error
-            else:
-                # print(f"Skipping {migration['filename']} (already applied)")
-                pass
+    # 3. List and sort migration files
+    files = []
+    for f in os.listdir(MIGRATION_DIR):
+        match = FILENAME_PATTERN.match(f)
+        if match:
+            day, month, year, name, seq = match.groups()
+            # Create a sort key: (date object, sequence int)
+            dt = datetime(int(year), int(month), int(day))
+            files.append({
+                "filename": f,
+                "date": dt,
+                "seq": int(seq),
+                "path": os.path.join(MIGRATION_DIR, f)
+            })
+    
+    # Sort by Date then Sequence
+    files.sort(key=lambda x: (x["date"], x["seq"]))
+    
+    # 4. Apply new migrations: consecutive ones share a transaction,
+    #    no-transaction ones run alone in autocommit mode
+    pending = [migration for migration in files if migration["filename"] not in applied_files]
+    for migration in pending:
+        with open(migration["path"], "r") as sql_file:
+            migration["sql"] = sql_file.read()
+
+    index = 0
+    while index < len(pending):
+        if runs_outside_transaction(pending[index]["sql"]):
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                await apply_migration(conn, pending[index])
+            index += 1
+            continue
+
+        async with engine.begin() as conn:
+            while index < len(pending) and not runs_outside_transaction(pending[index]["sql"]):
+                await apply_migration(conn, pending[index])
+                index += 1
 
-        print("Migration process completed.")
+    print("Migration process completed.")
 
 if __name__ == "__main__":
     asyncio.run(run_migrations())
@@ -7,6 +7,7 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy import text
 from sqlmodel import SQLModel
 
+from app import database
 from app.api.server import app
 from app.database import get_session
 from app.models import User
@@ -81,6 +82,19 @@ async def session(setup_test_db) -> AsyncGenerator[AsyncSession, None]:
     await transaction.rollback()
     await connection.close()
 
+@pytest.fixture(scope="function")
+async def services_db(setup_test_db, monkeypatch):
+    """
+    Point the services' own sessions (get_session_context) at the test DB.
+    Unlike `session`, their commits are real (needed for SKIP LOCKED and NOTIFY),
+    so every table is emptied afterwards.
+    """
+    monkeypatch.setattr(database, "async_session", TestingSessionLocal)
+    yield TestingSessionLocal
+    async with test_engine.begin() as conn:
+        tables = ", ".join(f'"{table.name}"' for table in SQLModel.metadata.sorted_tables)
+        await conn.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+
 @pytest.fixture(scope="function")
 async def client(session: AsyncSession) -> AsyncGenerator[AsyncClient, None]:
     """Provide an authenticated client."""
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from app.services import atomic_files
+
+
+async def _chunks(*parts, fail=False):
+    for part in parts:
+        yield part
+    if fail:
+        raise ConnectionError("download dropped")
+
+
+async def test_stream_to_file(tmp_path):
+    path = tmp_path / "out.png"
+    size = await atomic_files.stream_to_file(_chunks(b"abc", b"", b"defg"), str(path))
+    assert size == 7
+    assert path.read_bytes() == b"abcdefg"
+    assert os.listdir(tmp_path) == ["out.png"]
+
+
+async def test_failed_stream_leaves_nothing_behind(tmp_path):
+    path = tmp_path / "out.png"
+    path.write_bytes(b"previous")
+    with pytest.raises(ConnectionError):
+        await atomic_files.stream_to_file(_chunks(b"partial", fail=True), str(path))
+    # The old file is untouched and no temp file is left
+    assert path.read_bytes() == b"previous"
+    assert os.listdir(tmp_path) == ["out.png"]
+
+
+def test_write_bytes(tmp_path):
+    path = tmp_path / "out.png"
+    atomic_files.write_bytes(str(path), b"data")
+    assert path.read_bytes() == b"data"
+    assert os.listdir(tmp_path) == ["out.png"]
+
+
+def test_link_file(tmp_path):
+    source = tmp_path / "source.png"
+    source.write_bytes(b"cached")
+    path = tmp_path / "out.png"
+    path.write_bytes(b"previous")
+    atomic_files.link_file(str(source), str(path))
+    assert path.read_bytes() == b"cached"
+    assert os.path.samefile(source, path)
+    assert sorted(os.listdir(tmp_path)) == ["out.png", "source.png"]
+
+
+def test_copy_file(tmp_path):
+    source = tmp_path / "source.png"
+    source.write_bytes(b"cached")
+    path = tmp_path / "out.png"
+    atomic_files.copy_file(str(source), str(path))
+    assert path.read_bytes() == b"cached"
+    assert not os.path.samefile(source, path)
+    assert sorted(os.listdir(tmp_path)) == ["out.png", "source.png"]
+
+
+def test_failed_copy_leaves_nothing_behind(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        atomic_files.copy_file(str(tmp_path / "missing.png"), str(tmp_path / "out.png"))
+    assert os.listdir(tmp_path) == []
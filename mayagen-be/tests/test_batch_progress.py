@@ -0,0 +1,84 @@
+import asyncio
+
+from sqlalchemy import text
+
+from app.models import BatchJob, BatchJobStatus, JobStatus, User
+from app.services import job_queue, worker
+
+
+async def create_batch(session, total_images: int) -> BatchJob:
+    user = User(username="batch_user", email="batch_user@example.com", hashed_password="x")
+    session.add(user)
+    await session.commit()
+    batch = BatchJob(
+        user_id=user.id, category="tests", target_subject="cat",
+        total_images=total_images, status=BatchJobStatus.GENERATING
+    )
+    session.add(batch)
+    await session.commit()
+    return batch
+
+
+async def batch_state(session, batch_id: int):
+    result = await session.execute(
+        text("SELECT status, generated_count, failed_count FROM batchjob WHERE id = :id"), {"id": batch_id}
+    )
+    return tuple(result.one())
+
+
+async def finish_one(services_db, batch_id: int, success: bool):
+    async with services_db() as session:
+        await worker.update_batch_progress(session, batch_id, success=success)
+        await session.commit()
+
+
+async def test_concurrent_progress_updates_are_not_lost(services_db):
+    async with services_db() as session:
+        batch = await create_batch(session, total_images=10)
+
+    outcomes = [True] * 7 + [False] * 3
+    await asyncio.gather(*(finish_one(services_db, batch.id, success) for success in outcomes))
+
+    async with services_db() as session:
+        assert await batch_state(session, batch.id) == ("COMPLETED", 7, 3)
+
+
+async def test_batch_stays_generating_until_every_image_is_counted(services_db):
+    async with services_db() as session:
+        batch = await create_batch(session, total_images=3)
+
+    await finish_one(services_db, batch.id, True)
+    await finish_one(services_db, batch.id, False)
+    async with services_db() as session:
+        assert await batch_state(session, batch.id) == ("GENERATING", 1, 1)
+
+    await finish_one(services_db, batch.id, True)
+    async with services_db() as session:
+        assert await batch_state(session, batch.id) == ("COMPLETED", 2, 1)
+
+
+async def test_reconcile_recounts_from_image_rows(services_db):
+    async with services_db() as session:
+        batch = await create_batch(session, total_images=4)
+        outcomes = [JobStatus.COMPLETED, JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.DEAD_LETTER]
+        await job_queue.enqueue_images(session, [
+            job_queue.queued_image_row(
+                prompt="cat", width=512, height=512, model="sd15", provider="comfyui",
+                user_id=batch.user_id, batch_job_id=batch.id, status=status
+            )
+            for status in outcomes
+        ])
+        # Drift, e.g. a crash between a render and its counter update
+        await session.execute(text("UPDATE batchjob SET generated_count = 9, failed_count = 0 WHERE id = :id"), {"id": batch.id})
+        await session.commit()
+
+    reconciled = await worker.reconcile_batch_progress(batch_id=batch.id)
+
+    assert reconciled == {"batchjob": 1}
+    async with services_db() as session:
+        assert await batch_state(session, batch.id) == ("COMPLETED", 2, 2)
+
+    # Idempotent
+    await worker.reconcile_batch_progress(batch_id=batch.id)
+    async with services_db() as session:
+        assert await batch_state(session, batch.id) == ("COMPLETED", 2, 2)
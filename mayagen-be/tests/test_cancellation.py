@@ -0,0 +1,75 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import config
+from app.database import get_session_context
+from app.services import job_events, job_queue, worker
+from conftest import TEST_DATABASE_URL
+
+
+@pytest.fixture
+async def listener(services_db, monkeypatch):
+    """A running JOB_CANCELLED listener on the test database, wired to the worker's handler."""
+    monkeypatch.setattr(config, "DATABASE_URL", TEST_DATABASE_URL)
+    ready = job_events.subscribe(job_events.IMAGE_QUEUED)
+    job_events.add_handler(job_events.JOB_CANCELLED, worker._on_job_cancelled)
+    task = asyncio.create_task(job_events.listen_forever())
+    # The listener wakes every loop once it is listening
+    assert await ready.wait(10)
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    job_events.remove_handler(job_events.JOB_CANCELLED, worker._on_job_cancelled)
+    ready.close()
+
+
+def running_job(job_id: int, batch_job_id=None) -> worker.RunningJob:
+    job = SimpleNamespace(id=job_id, batch_job_id=batch_job_id, edit_batch_job_id=None, provider="comfyui")
+    running = worker.RunningJob(job, asyncio.current_task())
+    worker._running_jobs[job_id] = running
+    return running
+
+
+async def cancel(payload: str):
+    # What the cancel/delete routes do: notify in the transaction that cancels the rows
+    async with get_session_context() as session:
+        await job_events.notify(session, job_events.JOB_CANCELLED, payload)
+        await session.commit()
+
+
+async def wait_until(predicate, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "notification not delivered"
+        await asyncio.sleep(0.01)
+
+
+async def test_batch_cancel_stops_running_and_buffered_jobs(listener):
+    in_batch = running_job(1, batch_job_id=7)
+    other = running_job(2, batch_job_id=8)
+    buffer = job_queue.ClaimBuffer("test", job_queue.COMFY_PROVIDERS, batch_size=4)
+    buffer._job_ids.extend([(3, "sd15", 7, None), (4, "sd15", 8, None)])
+    try:
+        await cancel("batch:7")
+        await wait_until(in_batch.cancel_event.is_set)
+
+        assert not other.cancel_event.is_set()
+        # Claimed but unstarted jobs of the batch are dropped, not released
+        assert [entry[0] for entry in buffer._job_ids] == [4]
+    finally:
+        worker._running_jobs.clear()
+
+
+async def test_image_cancel_stops_only_that_job(listener):
+    target = running_job(11)
+    other = running_job(12)
+    try:
+        await cancel("image:11")
+        await wait_until(target.cancel_event.is_set)
+        assert not other.cancel_event.is_set()
+    finally:
+        worker._running_jobs.clear()
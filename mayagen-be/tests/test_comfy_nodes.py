@@ -0,0 +1,80 @@
+import types
+
+import pytest
+
+from app.services import comfy_nodes
+from app.services.comfy_nodes import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(comfy_nodes, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def breaker(clock, opened):
+    return CircuitBreaker("node-a", failure_threshold=3, reset_timeout=30, on_open=lambda: opened.append(True))
+
+
+def test_opens_after_threshold_failures(breaker, opened):
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert opened == [True]
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_after_reset_timeout(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 29
+    assert breaker.state == OPEN
+    clock.now += 1
+    assert breaker.state == HALF_OPEN
+
+
+def test_success_does_not_close_an_open_breaker(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == OPEN
+    clock.now += 30
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_failure_reopens(breaker, clock, opened):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert len(opened) == 2
+    # The reset timeout starts over
+    clock.now += 29
+    assert breaker.state == OPEN
+
+
+def test_failures_while_open_do_not_reopen(breaker, opened):
+    for _ in range(5):
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    assert opened == [True]
@@ -0,0 +1,57 @@
+import os
+
+from sqlalchemy import text
+
+from app.models import Image, JobStatus, User
+from app.services import generation_cache
+
+WORKFLOW = {"3": {"class_type": "KSampler", "inputs": {"seed": 42}}}
+
+
+async def add_render(session, file_path: str, key: str) -> int:
+    user = User(username="cache_user", email="cache_user@example.com", hashed_password="x")
+    session.add(user)
+    await session.commit()
+    image = Image(
+        prompt="cat", width=512, height=512, model="sd15", provider="comfyui", user_id=user.id,
+        status=JobStatus.COMPLETED, file_path=file_path, cache_key=key
+    )
+    session.add(image)
+    await session.commit()
+    return image.id
+
+
+def test_cache_key_depends_on_workflow_and_model():
+    key = generation_cache.cache_key(WORKFLOW, "sd15")
+    assert key == generation_cache.cache_key({"3": {"inputs": {"seed": 42}, "class_type": "KSampler"}}, "sd15")
+    assert key != generation_cache.cache_key(WORKFLOW, "flux")
+    assert key != generation_cache.cache_key({"3": {"class_type": "KSampler", "inputs": {"seed": 43}}}, "sd15")
+
+
+async def test_hit_links_the_earlier_render(services_db, tmp_path):
+    source = tmp_path / "first.png"
+    source.write_bytes(b"rendered")
+    key = generation_cache.cache_key(WORKFLOW, "sd15")
+    async with services_db() as session:
+        image_id = await add_render(session, str(source), key)
+
+    output = tmp_path / "second.png"
+    assert await generation_cache.fetch(key, str(output)) == image_id
+    assert output.read_bytes() == b"rendered"
+    assert os.path.samefile(source, output)
+
+    assert await generation_cache.fetch(generation_cache.cache_key(WORKFLOW, "flux"), str(tmp_path / "miss.png")) is None
+    assert not (tmp_path / "miss.png").exists()
+
+
+async def test_entry_with_missing_file_is_evicted(services_db, tmp_path):
+    key = generation_cache.cache_key(WORKFLOW, "sd15")
+    async with services_db() as session:
+        image_id = await add_render(session, str(tmp_path / "deleted.png"), key)
+
+    assert await generation_cache.fetch(key, str(tmp_path / "out.png")) is None
+
+    async with services_db() as session:
+        result = await session.execute(text("SELECT cache_key FROM image WHERE id = :id"), {"id": image_id})
+        assert result.scalar_one() is None
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,107 @@
+import httpx
+import pytest
+
+from app.core import config
+from app.services import job_errors
+from app.services.comfy_client import ComfyUIProvider, _PromptWaiter
+
+
+def _status_error(status_code: int, headers: dict = None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://comfy.local/prompt")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status_code}", request=request, response=response)
+
+
+@pytest.mark.parametrize("error, expected", [
+    (job_errors.RetryableError("busy", retry_after=7), (True, 7)),
+    (job_errors.NodeUnavailable("node down"), (True, None)),
+    (job_errors.PermanentError("rejected prompt"), (False, None)),
+    (ConnectionError("reset"), (True, None)),
+    (TimeoutError(), (True, None)),
+    (httpx.ConnectError("refused"), (True, None)),
+    (FileNotFoundError("input.png"), (False, None)),
+    (ValueError("bad workflow"), (False, None)),
+    (KeyError("images"), (False, None)),
+    (RuntimeError("unknown"), (False, None)),
+    (Exception("No image found in output"), (False, None)),
+])
+def test_classify(error, expected):
+    assert job_errors.classify(error) == expected
+
+
+def test_classify_http_status():
+    assert job_errors.classify(_status_error(429, {"Retry-After": "30"})) == (True, 30.0)
+    assert job_errors.classify(_status_error(503)) == (True, None)
+    assert job_errors.classify(_status_error(400)) == (False, None)
+    assert job_errors.classify(_status_error(404)) == (False, None)
+
+
+def test_comfy_execution_error_is_permanent():
+    waiter = _PromptWaiter("p1")
+    waiter.handle({"type": "execution_error", "data": {
+        "prompt_id": "p1", "node_id": "4", "exception_type": "FileNotFoundError",
+        "exception_message": "missing.safetensors",
+    }})
+    assert isinstance(waiter.error, job_errors.PermanentError)
+    assert "node 4" in str(waiter.error)
+    assert job_errors.classify(waiter.error) == (False, None)
+
+
+def test_comfy_interrupted_prompt_is_retryable():
+    waiter = _PromptWaiter("p1")
+    waiter.handle({"type": "execution_interrupted", "data": {"prompt_id": "p1"}})
+    assert job_errors.classify(waiter.error) == (True, None)
+
+
+async def test_comfy_validation_error_is_permanent():
+    def reject(request):
+        return httpx.Response(400, json={
+            "error": {"type": "prompt_outputs_failed_validation", "message": "Prompt outputs failed validation"},
+            "node_errors": {"4": {"class_type": "CheckpointLoaderSimple", "errors": [
+                {"type": "value_not_in_list", "message": "Value not in list", "details": "ckpt_name: 'x' not in []"},
+            ]}},
+        })
+
+    async with httpx.AsyncClient(base_url="http://comfy.local", transport=httpx.MockTransport(reject)) as http:
+        provider = ComfyUIProvider("comfy.local", http=http)
+        with pytest.raises(job_errors.PermanentError, match="node 4 \\(CheckpointLoaderSimple\\): Value not in list"):
+            await provider.queue_prompt({})
+
+
+def test_throttled_only_for_429():
+    assert job_errors.RetryableError("slow down", status_code=429).throttled
+    assert not job_errors.RetryableError("bad gateway", status_code=502).throttled
+    assert not job_errors.RetryableError("no status").throttled
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("12", 12.0),
+    ("0", 0.0),
+    ("-5", 0.0),
+    (None, None),
+    ("", None),
+    ("Wed, 21 Oct 2026 07:28:00 GMT", None),
+])
+def test_parse_retry_after(value, expected):
+    assert job_errors.parse_retry_after(value) == expected
+
+
+def test_backoff_delay_grows_exponentially_within_jitter():
+    base = config.RETRY["base_delay"]
+    for attempts in range(1, 5):
+        full = min(config.RETRY["max_delay"], base * 2 ** (attempts - 1))
+        for _ in range(50):
+            delay = job_errors.backoff_delay(attempts)
+            assert full / 2 <= delay <= full
+
+
+def test_backoff_delay_is_capped():
+    for _ in range(50):
+        assert job_errors.backoff_delay(100) <= config.RETRY["max_delay"]
+
+
+def test_backoff_delay_honours_retry_after():
+    retry_after = config.RETRY["max_delay"] * 2
+    assert job_errors.backoff_delay(1, retry_after) == retry_after
+    # A hint shorter than the backoff does not shorten it
+    assert job_errors.backoff_delay(1, 0.0) >= config.RETRY["base_delay"] / 2
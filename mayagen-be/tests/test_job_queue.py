@@ -0,0 +1,185 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from app.core import config
+from app.models import BatchJob, BatchJobStatus, User
+from app.services import job_queue, worker
+
+
+@pytest.fixture(autouse=True)
+def clear_held_jobs():
+    yield
+    job_queue._held_jobs.clear()
+    job_queue._claimed_at.clear()
+
+
+async def create_user(session, username: str = "queue_user", weight: float = 1.0) -> int:
+    user = User(username=username, email=f"{username}@example.com", hashed_password="x", queue_weight=weight)
+    session.add(user)
+    await session.commit()
+    return user.id
+
+
+async def enqueue(session, user_id: int, count: int, provider: str = "comfyui", **fields) -> list:
+    """Commits `count` QUEUED jobs, one fair_key apart; returns their ids in queue order."""
+    base = fields.pop("fair_key", 1000.0)
+    rows = [
+        job_queue.queued_image_row(
+            prompt=f"job {i}", width=512, height=512, model="sd15", provider=provider,
+            user_id=user_id, fair_key=base + i, **fields
+        )
+        for i in range(count)
+    ]
+    await job_queue.enqueue_images(session, rows)
+    await session.commit()
+    result = await session.execute(text(
+        "SELECT id FROM image WHERE user_id = :user_id AND provider = :provider ORDER BY fair_key, id"
+    ), {"user_id": user_id, "provider": provider})
+    return [row.id for row in result.all()]
+
+
+async def statuses(session, ids) -> dict:
+    result = await session.execute(text("SELECT id, status, worker_id FROM image WHERE id = ANY(:ids)"), {"ids": list(ids)})
+    return {row.id: (row.status, row.worker_id) for row in result.all()}
+
+
+async def test_claim_takes_the_queue_head(services_db):
+    async with services_db() as session:
+        user_id = await create_user(session)
+        ids = await enqueue(session, user_id, 5)
+        await enqueue(session, user_id, 2, provider="azure_foundry", fair_key=0.0)
+
+    claimed = await job_queue.claim_jobs(job_queue.COMFY_PROVIDERS, 3)
+
+    assert [job[0] for job in claimed] == ids[:3]
+    async with services_db() as session:
+        rows = await statuses(session, ids)
+    assert [rows[job_id] for job_id in ids] == (
+        [("PROCESSING", job_queue.WORKER_ID)] * 3 + [("QUEUED", None)] * 2
+    )
+    assert set(job_queue.held_jobs()) == set(ids[:3])
+
+
+async def test_claim_skips_rows_locked_by_another_claim(services_db):
+    async with services_db() as session:
+        user_id = await create_user(session)
+        ids = await enqueue(session, user_id, 4)
+
+    # Another worker's claim transaction holds the head of the queue
+    async with services_db() as locker:
+        await locker.execute(text("SELECT id FROM image WHERE id = :id FOR UPDATE"), {"id": ids[0]})
+        claimed = await job_queue.claim_jobs(job_queue.COMFY_PROVIDERS, 2)
+        await locker.rollback()
+
+    assert [job[0] for job in claimed] == ids[1:3]
+
+
+async def test_concurrent_claims_never_overlap(services_db):
+    async with services_db() as session:
+        user_id = await create_user(session)
+        ids = await enqueue(session, user_id, 20)
+
+    results = await asyncio.gather(*(job_queue.claim_jobs(job_queue.COMFY_PROVIDERS, 4) for _ in range(6)))
+
+    claimed = [job[0] for result in results for job in result]
+    assert len(claimed) == len(set(claimed)) == 20
+    assert set(claimed) == set(ids)
+
+
+async def test_release_puts_jobs_back(services_db):
+    async with services_db() as session:
+        user_id = await create_user(session)
+        ids = await enqueue(session, user_id, 2)
+
+    claimed = await job_queue.claim_jobs(job_queue.COMFY_PROVIDERS, 2)
+    await job_queue.release_jobs([job[0] for job in claimed])
+
+    async with services_db() as session:
+        assert set((await statuses(session, ids)).values()) == {("QUEUED", None)}
+    assert job_queue.held_jobs() == []
+
+
+async def test_reaper_requeues_only_expired_leases(services_db):
+    async with services_db() as session:
+        user_id = await create_user(session)
+        expired, live = await enqueue(session, user_id, 2)
+        await session.execute(text("""
+            UPDATE image SET status = 'PROCESSING', worker_id = 'crashed-node',
+                lease_expires_at = timezone('utc', now()) + make_interval(secs => :offset)
+            WHERE id = :id
+        """), [{"id": expired, "offset": -5}, {"id": live, "offset": 60}])
+        await session.commit()
+
+    assert await job_queue.reap_expired_leases() == 1
+
+    async with services_db() as session:
+        rows = await statuses(session, [expired, live])
+    assert rows == {expired: ("QUEUED", None), live: ("PROCESSING", "crashed-node")}
+
+
+async def test_renew_reports_leases_lost_to_another_worker(services_db):
+    async with services_db() as session:
+        user_id = await create_user(session)
+        await enqueue(session, user_id, 2)
+    kept, lost = [job[0] for job in await job_queue.claim_jobs(job_queue.COMFY_PROVIDERS, 2)]
+
+    async with services_db() as session:
+        # Reaped while this worker was partitioned, then claimed by someone else
+        await session.execute(text("UPDATE image SET worker_id = 'other-node' WHERE id = :id"), {"id": lost})
+        await session.execute(text("UPDATE image SET lease_expires_at = NULL WHERE id = :id"), {"id": kept})
+        await session.commit()
+
+    assert await job_queue.renew_leases() == [lost]
+
+    async with services_db() as session:
+        result = await session.execute(text("SELECT lease_expires_at FROM image WHERE id = :id"), {"id": kept})
+        assert result.scalar_one() is not None
+
+
+async def expand_batch(session, user_id: int, total_images: int) -> int:
+    batch = BatchJob(
+        user_id=user_id, category="tests", target_subject="cat",
+        total_images=total_images, status=BatchJobStatus.GENERATING
+    )
+    session.add(batch)
+    await session.commit()
+    await worker.expand_batch_chunk(session, batch)
+    await session.commit()
+    return batch.id
+
+
+async def claim_order(limit: int) -> list:
+    """Batch ids of the next `limit` jobs, in claim order."""
+    return [job[2] for job in await job_queue.claim_jobs(job_queue.COMFY_PROVIDERS, limit)]
+
+
+async def test_fair_scheduler_interleaves_users(services_db, monkeypatch):
+    monkeypatch.setitem(config.QUEUE, "scheduler", "fair")
+    async with services_db() as session:
+        heavy = await expand_batch(session, await create_user(session, "heavy"), 10)
+        # Submitted after the whole 10-image batch, yet not stuck behind it
+        light = await expand_batch(session, await create_user(session, "light"), 2)
+
+    assert await claim_order(6) == [heavy, light, heavy, light, heavy, heavy]
+
+
+async def test_fair_scheduler_honours_queue_weight(services_db, monkeypatch):
+    monkeypatch.setitem(config.QUEUE, "scheduler", "fair")
+    async with services_db() as session:
+        normal = await expand_batch(session, await create_user(session, "normal"), 6)
+        double = await expand_batch(session, await create_user(session, "double", weight=2.0), 6)
+
+    # Twice the weight, twice the share while both are backlogged
+    order = await claim_order(6)
+    assert order.count(double) == 4 and order.count(normal) == 2
+
+
+async def test_fifo_scheduler_keeps_submit_order(services_db, monkeypatch):
+    monkeypatch.setitem(config.QUEUE, "scheduler", "fifo")
+    async with services_db() as session:
+        first = await expand_batch(session, await create_user(session, "first"), 4)
+        second = await expand_batch(session, await create_user(session, "second"), 2)
+
+    assert await claim_order(6) == [first] * 4 + [second] * 2
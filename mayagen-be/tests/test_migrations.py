@@ -0,0 +1,52 @@
+import os
+from pathlib import Path
+
+from sqlalchemy import text
+
+import run_migrations
+from conftest import test_engine
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Applied on every database before the queue work; they add columns without
+# IF NOT EXISTS, so they cannot run again over the schema the models create
+BASELINE_MIGRATIONS = [
+    "06-02-2026-add_is_public-001.sql",
+    "07-02-2026-add_share_token-001.sql",
+    "09-02-2026-add_activity_logs-001.sql",
+    "10-02-2026-add_blocked_ip-002.sql",
+    "10-02-2026-add_role-001.sql",
+    "13-02-2026-add_edit_batch_job-004.sql",
+    "13-02-2026-add_google_auth-003.sql",
+    "13-02-2026-add_image_edit_fields-001.sql",
+    "13-02-2026-add_image_type-002.sql",
+    "14-02-2026-update_edit_batch_wizard_fields-001.sql",
+]
+
+
+async def test_every_migration_applies(setup_test_db, monkeypatch):
+    """run_migrations.py splits files on ';': a migration it cannot parse must fail here, not on deploy."""
+    monkeypatch.chdir(BACKEND_DIR)
+    monkeypatch.setattr(run_migrations, "engine", test_engine)
+
+    async with test_engine.begin() as conn:
+        await conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                filename VARCHAR(255) PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """))
+        await conn.execute(text("DELETE FROM schema_migrations"))
+        for filename in BASELINE_MIGRATIONS:
+            await conn.execute(text("INSERT INTO schema_migrations (filename) VALUES (:filename)"), {"filename": filename})
+
+    await run_migrations.run_migrations()
+
+    expected = {
+        name for name in os.listdir(BACKEND_DIR / run_migrations.MIGRATION_DIR)
+        if run_migrations.FILENAME_PATTERN.match(name)
+    }
+    async with test_engine.connect() as conn:
+        result = await conn.execute(text("SELECT filename FROM schema_migrations"))
+        applied = {row[0] for row in result.all()}
+    assert applied == expected
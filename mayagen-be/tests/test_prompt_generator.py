@@ -0,0 +1,65 @@
+import pytest
+
+from app.services.prompt_generator import estimate_unique_combinations, generate_prompt_range
+
+VARIATIONS = {
+    "colors": ["red", "blue", "green"],
+    "environments": ["indoor", "outdoor", "forest", "beach"],
+    "actions": ["sitting", "running"],
+    "styles": ["cinematic", "photorealistic", "artistic", "studio", "macro"],
+}
+
+
+@pytest.mark.parametrize("seed", [0, 1, 42, 9999])
+def test_full_cycle_is_a_bijection(seed):
+    total = estimate_unique_combinations(VARIATIONS)
+    prompts = generate_prompt_range("cat", VARIATIONS, start=0, count=total, seed=seed)
+    assert len(prompts) == total == 120
+    # Every combination exactly once before any repeats
+    assert len(set(prompts)) == total
+
+
+def test_sequence_repeats_after_a_full_cycle():
+    total = estimate_unique_combinations(VARIATIONS)
+    first = generate_prompt_range("cat", VARIATIONS, start=0, count=10, seed=7)
+    second = generate_prompt_range("cat", VARIATIONS, start=total, count=10, seed=7)
+    assert first == second
+
+
+def test_chunks_match_the_whole_sequence():
+    whole = generate_prompt_range("dog", VARIATIONS, start=0, count=100, seed=3)
+    chunks = []
+    for start in range(0, 100, 17):
+        chunks += generate_prompt_range("dog", VARIATIONS, start=start, count=min(17, 100 - start), seed=3)
+    assert chunks == whole
+
+
+def test_variation_key_order_does_not_matter():
+    # JSONB hands the variations back in its own key order
+    reordered = dict(reversed(list(VARIATIONS.items())))
+    assert (
+        generate_prompt_range("cat", VARIATIONS, start=5, count=20, seed=11)
+        == generate_prompt_range("cat", reordered, start=5, count=20, seed=11)
+    )
+
+
+def test_seed_selects_the_permutation():
+    a = generate_prompt_range("cat", VARIATIONS, start=0, count=20, seed=1)
+    b = generate_prompt_range("cat", VARIATIONS, start=0, count=20, seed=2)
+    assert a != b
+    assert sorted(generate_prompt_range("cat", VARIATIONS, count=120, seed=1)) == sorted(
+        generate_prompt_range("cat", VARIATIONS, count=120, seed=2)
+    )
+
+
+@pytest.mark.parametrize("variations", [
+    {},
+    {"colors": ["red"]},
+    {"colors": ["red", "blue"]},
+    {"colors": ["red", "blue"], "actions": []},
+])
+def test_small_variation_sets(variations):
+    total = estimate_unique_combinations(variations)
+    prompts = generate_prompt_range("bird", variations, start=0, count=total, seed=5)
+    assert len(set(prompts)) == total
+    assert all("bird" in prompt for prompt in prompts)
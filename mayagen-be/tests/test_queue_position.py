@@ -0,0 +1,53 @@
+from sqlmodel import select
+
+from app.api.images import calculate_queue_position
+from app.models import BatchJob, Image, JobStatus, User
+from app.services import job_queue
+
+
+async def add_job(session, user: User, fair_key: float, batch: BatchJob = None, provider: str = "comfyui", status=JobStatus.QUEUED) -> Image:
+    image = Image(
+        prompt="cat", width=512, height=512, model="sd15", provider=provider, user_id=user.id,
+        fair_key=fair_key, status=status, batch_job_id=batch.id if batch else None,
+        priority=job_queue.PRIORITY_BATCH if batch else job_queue.PRIORITY_INTERACTIVE
+    )
+    session.add(image)
+    await session.flush()
+    return image
+
+
+async def test_queue_position_follows_claim_order(session):
+    user = User(username="position_user", email="position_user@example.com", hashed_password="x")
+    session.add(user)
+    await session.flush()
+    batch = BatchJob(user_id=user.id, category="tests", target_subject="cat", total_images=3)
+    session.add(batch)
+    await session.flush()
+
+    batch_jobs = [await add_job(session, user, fair_key, batch) for fair_key in (10.0, 20.0, 30.0)]
+    # Submitted last, but interactive jobs go before batch jobs
+    interactive = await add_job(session, user, 40.0)
+    # Other worker queues and jobs that left the queue do not count
+    await add_job(session, user, 1.0, provider="azure_foundry")
+    await add_job(session, user, 1.0, status=JobStatus.COMPLETED)
+    running = await add_job(session, user, 1.0, status=JobStatus.PROCESSING)
+
+    assert await calculate_queue_position(session, interactive) == 1
+    assert [await calculate_queue_position(session, job) for job in batch_jobs] == [2, 3, 4]
+    assert await calculate_queue_position(session, running) == 0
+
+    # Same order the worker claims in
+    result = await session.execute(
+        select(Image.id)
+        .where(Image.status == JobStatus.QUEUED, Image.provider == "comfyui")
+        .order_by(Image.priority, Image.fair_key, Image.id)
+    )
+    assert result.scalars().all() == [interactive.id] + [job.id for job in batch_jobs]
+
+
+async def test_finished_jobs_have_no_position(session):
+    user = User(username="finished_user", email="finished_user@example.com", hashed_password="x")
+    session.add(user)
+    await session.flush()
+    done = await add_job(session, user, 1.0, status=JobStatus.COMPLETED)
+    assert await calculate_queue_position(session, done) is None
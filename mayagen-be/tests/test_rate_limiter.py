@@ -0,0 +1,75 @@
+import time
+
+from app.services.rate_limiter import AdaptiveRateLimiter
+
+
+def make_limiter(**overrides) -> AdaptiveRateLimiter:
+    options = dict(rate=10.0, min_rate=1.0, max_rate=12.0, increase=1.0, decrease_factor=0.5)
+    options.update(overrides)
+    return AdaptiveRateLimiter("test", **options)
+
+
+def test_additive_increase_is_capped():
+    limiter = make_limiter()
+    limiter.on_success()
+    assert limiter.rate == 11.0
+    for _ in range(5):
+        limiter.on_success()
+    assert limiter.rate == 12.0
+
+
+def test_multiplicative_decrease_is_floored():
+    limiter = make_limiter()
+    limiter.on_throttle()
+    assert limiter.rate == 5.0
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.rate == 1.0
+
+
+async def test_burst_is_available_immediately():
+    limiter = make_limiter(burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+        await limiter.acquire()
+    assert time.monotonic() - started < 0.05
+
+
+async def test_acquire_is_paced_by_the_rate():
+    limiter = make_limiter(rate=20.0, max_rate=20.0, burst=1)
+    await limiter.acquire()
+    started = time.monotonic()
+    for _ in range(3):
+        await limiter.acquire()
+    # Three more tokens at 20/s
+    assert time.monotonic() - started >= 0.14
+
+
+async def test_retry_after_pauses_every_caller():
+    limiter = make_limiter(rate=1000.0, max_rate=1000.0, burst=10)
+    limiter.on_throttle(retry_after=0.2)
+    started = time.monotonic()
+    await limiter.acquire()
+    assert time.monotonic() - started >= 0.2
+
+
+async def test_throttle_drains_the_bucket():
+    limiter = make_limiter(rate=20.0, burst=10)
+    limiter.on_throttle()
+    started = time.monotonic()
+    await limiter.acquire()
+    # Rate halved to 10/s and no tokens left: the next one takes ~0.1s
+    assert time.monotonic() - started >= 0.09
+
+
+def test_concurrent_throttles_decrease_once():
+    limiter = make_limiter()
+    # Four requests in flight when the API starts throttling
+    sent_at = [time.monotonic() - 0.1 for _ in range(4)]
+    for started in sent_at:
+        limiter.on_throttle(sent_at=started)
+    assert limiter.rate == 5.0
+
+    # A request sent after the decrease is throttled again: the new rate is still too high
+    limiter.on_throttle(sent_at=time.monotonic() + 0.1)
+    assert limiter.rate == 2.5
@@ -0,0 +1,124 @@
+import copy
+from pathlib import Path
+
+import pytest
+
+from app.core import config
+from app.services import workflow_templates
+from app.services.workflow_templates import compile_plan
+
+
+def sd15_workflow() -> dict:
+    return {
+        "3": {"class_type": "KSampler", "inputs": {
+            "seed": 1, "steps": 20, "cfg": 7,
+            "model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": ["5", 0],
+        }},
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd15.safetensors"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["4", 1]}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry", "clip": ["4", 1]}},
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}},
+    }
+
+
+def flux_workflow() -> dict:
+    # The positive prompt reaches the sampler through FluxGuidance; the negative one directly
+    return {
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["30", 1]}},
+        "26": {"class_type": "FluxGuidance", "inputs": {"guidance": 3.5, "conditioning": ["6", 0]}},
+        "27": {"class_type": "EmptySD3LatentImage", "inputs": {"width": 1024, "height": 1024, "batch_size": 1}},
+        "30": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "flux1-dev-fp8.safetensors"}},
+        "31": {"class_type": "KSampler", "inputs": {
+            "seed": 1, "steps": 20, "cfg": 1,
+            "model": ["30", 0], "positive": ["26", 0], "negative": ["33", 0], "latent_image": ["27", 0],
+        }},
+        "33": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["30", 1]}},
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["31", 0], "vae": ["30", 2]}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}},
+    }
+
+
+def test_sd15_plan():
+    assert compile_plan(sd15_workflow()) == {
+        "seed": ("3", "seed"),
+        "steps": ("3", "steps"),
+        "prompt": ("6", "text"),
+        "negative_prompt": ("7", "text"),
+        "width": ("5", "width"),
+        "height": ("5", "height"),
+        "batch_size": ("5", "batch_size"),
+    }
+
+
+def test_flux_prompt_follows_conditioning_through_guidance():
+    plan = compile_plan(flux_workflow())
+    assert plan["prompt"] == ("6", "text")
+    assert plan["negative_prompt"] == ("33", "text")
+    assert plan["width"] == ("27", "width")
+
+
+def test_noise_seed_of_advanced_samplers():
+    workflow = sd15_workflow()
+    inputs = workflow["3"]["inputs"]
+    workflow["3"]["class_type"] = "KSamplerAdvanced"
+    inputs["noise_seed"] = inputs.pop("seed")
+    assert compile_plan(workflow)["seed"] == ("3", "noise_seed")
+
+
+def test_no_sampler():
+    workflow = sd15_workflow()
+    del workflow["3"]
+    with pytest.raises(ValueError, match="no sampler"):
+        compile_plan(workflow)
+
+
+def test_missing_required_field():
+    workflow = sd15_workflow()
+    workflow["3"]["inputs"]["positive"] = ["8", 0]  # Not a text encoder
+    with pytest.raises(ValueError, match="prompt"):
+        compile_plan(workflow)
+
+
+def test_prompt_and_negative_sharing_an_encoder_is_rejected():
+    workflow = sd15_workflow()
+    workflow["3"]["inputs"]["negative"] = ["6", 0]
+    with pytest.raises(ValueError, match="both resolve"):
+        compile_plan(workflow)
+
+
+def test_conditioning_cycle_terminates():
+    workflow = flux_workflow()
+    workflow["26"]["inputs"]["conditioning"] = ["26", 0]
+    with pytest.raises(ValueError, match="prompt"):
+        compile_plan(workflow)
+
+
+def test_instantiate_leaves_the_template_untouched():
+    workflow = sd15_workflow()
+    original = copy.deepcopy(workflow)
+    template = workflow_templates.WorkflowTemplate(Path("sd15.json"), 0.0, workflow, compile_plan(workflow))
+
+    result = template.instantiate(prompt="a dog", width=768, seed=None)
+
+    assert result["6"]["inputs"]["text"] == "a dog"
+    assert result["5"]["inputs"]["width"] == 768
+    assert result["3"]["inputs"]["seed"] == 1  # None keeps the default
+    assert result["4"] is workflow["4"]  # Untouched nodes are shared
+    assert workflow == original
+
+
+@pytest.mark.parametrize("name", sorted(config.WORKFLOWS))
+def test_shipped_workflows_compile(name):
+    template = workflow_templates.get(config.WORKFLOWS[name])
+    for field in workflow_templates.REQUIRED_FIELDS:
+        assert field in template.plan
+
+
+def test_with_websocket_output():
+    workflow = sd15_workflow()
+    patched, output_nodes = workflow_templates.with_websocket_output(workflow)
+    assert output_nodes == {"9"}
+    assert patched["9"] == {"class_type": "SaveImageWebsocket", "inputs": {"images": ["8", 0]}}
+    assert workflow["9"]["class_type"] == "SaveImage"